@@ -0,0 +1,75 @@
+import concurrent.futures
+import itertools
+import os
+import time
+from erdos.agent import Agent
+from erdos.channel import Channel
+from .common import latency_metrics, result
+
+# Conversation ids of distinct runs don't overlap, since the agent keys
+# session histories by conversation id
+conversation_ids = itertools.count(1)
+
+
+def run(db_dir: str, channels: int, conversations: int, depth: int) -> dict:
+    """Send depth messages to each conversation of each channel at once, and measure the
+    throughput and the latency of the turns
+
+    Args:
+        db_dir (str): directory of the database
+        channels (int): number of channels
+        conversations (int): number of conversations per channel
+        depth (int): number of messages queued per conversation
+
+    Returns:
+        dict: benchmark record
+    """
+    agent = Agent.instance
+    db_path = os.path.join(db_dir, "channels.db")
+    channel_objects = [Channel(f"bench-{channel}", None, max_conversations=conversations,
+                               db_path=db_path)
+                       for channel in range(channels)]
+    conversation_objects = [channel.add_conversation(next(conversation_ids))
+                            for channel in channel_objects for _ in range(conversations)]
+    latencies = []
+
+    def record(sent_at: float):
+        return lambda reply: latencies.append(time.perf_counter() - sent_at)
+
+    start = time.perf_counter()
+    replies = []
+    for depth_index in range(depth):
+        for conversation in conversation_objects:
+            reply = conversation.add_message(
+                f"Tell me about the number {conversation._conversation_id + depth_index}")
+            reply.add_done_callback(record(time.perf_counter()))
+            replies.append(reply)
+    concurrent.futures.wait(replies)
+    elapsed = time.perf_counter() - start
+
+    for channel in channel_objects:
+        channel.close(timeout=60)
+    for conversation in conversation_objects:
+        del agent.history[conversation._conversation_id]
+    messages = len(replies)
+    return result("channels", {"channels": channels, "conversations": conversations,
+                               "depth": depth},
+                  {"messages": messages,
+                   "messages_per_second": round(messages / elapsed, 1),
+                   **latency_metrics(latencies)})
+
+
+def suite(db_dir: str, quick: bool) -> list[dict]:
+    """Run the channel benchmarks
+
+    Args:
+        db_dir (str): directory of the database
+        quick (bool): whether to run the smallest configurations only
+
+    Returns:
+        list[dict]: benchmark records
+    """
+    configurations = [(1, 10, 1), (1, 100, 1), (4, 100, 1), (1, 100, 5)]
+    if not quick:
+        configurations += [(1, 500, 1), (4, 500, 1), (1, 500, 5), (8, 500, 2)]
+    return [run(db_dir, *configuration) for configuration in configurations]
@@ -0,0 +1,65 @@
+import math
+import time
+from typing import Callable
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Get a percentile of values, by the nearest rank method
+
+    Args:
+        values (list[float]): measured values
+        q (float): percentile, between 0 and 100
+
+    Returns:
+        float: percentile, None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+def latency_metrics(latencies: list[float]) -> dict:
+    """Summarise latencies, in milliseconds
+
+    Args:
+        latencies (list[float]): latencies, in seconds
+
+    Returns:
+        dict: p50, p95, p99 and max latencies
+    """
+    return {f"p{q}_ms": round(percentile(latencies, q) * 1000, 3) for q in (50, 95, 99)} | {
+        "max_ms": round(max(latencies) * 1000, 3)}
+
+
+def time_per_call(fn: Callable[[], object], min_seconds: float = 0.2) -> float:
+    """Time a function, calling it repeatedly for at least min_seconds
+
+    Args:
+        fn (Callable[[], object]): function to time
+        min_seconds (float, optional): minimum total duration. Defaults to 0.2.
+
+    Returns:
+        float: seconds per call
+    """
+    calls, start = 0, time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return elapsed / calls
+
+
+def result(benchmark: str, params: dict, metrics: dict) -> dict:
+    """Record of a benchmark run, as written to the output
+
+    Args:
+        benchmark (str): name of the benchmark
+        params (dict): parameters of the run
+        metrics (dict): measurements
+
+    Returns:
+        dict: record
+    """
+    return {"benchmark": benchmark, "params": params, "metrics": metrics}
@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+from .common import percentile, result
+
+# Measures the import in a fresh interpreter, as the benchmarks' own process
+# has erdos imported already
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": len(sys.modules)}}))
+"""
+
+
+def run(module: str, repeat: int) -> dict:
+    """Measure the time to import a module, in fresh interpreters
+
+    Args:
+        module (str): module imported
+        repeat (int): number of interpreters started
+
+    Returns:
+        dict: benchmark record
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        filter(None, [root, os.environ.get("PYTHONPATH")])))
+    samples = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", SCRIPT.format(module=module)],
+            env=env, capture_output=True, text=True, check=True).stdout
+        samples.append(json.loads(output))
+    seconds = [sample["seconds"] for sample in samples]
+    return result("imports", {"module": module},
+                  {"p50_ms": round(percentile(seconds, 50) * 1000, 3),
+                   "max_ms": round(max(seconds) * 1000, 3),
+                   "modules": samples[-1]["modules"]})
+
+
+def suite(db_dir: str, quick: bool) -> list[dict]:
+    """Run the import benchmarks
+
+    Args:
+        db_dir (str): directory of the database, unused
+        quick (bool): whether to run the smallest configurations only
+
+    Returns:
+        list[dict]: benchmark records
+    """
+    repeat = 3 if quick else 10
+    modules = ["erdos", "erdos.channel"]
+    if not quick:
+        modules.append("erdos.agent")
+    return [run(module, repeat) for module in modules]
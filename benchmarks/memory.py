@@ -0,0 +1,56 @@
+import gc
+import itertools
+import tracemalloc
+from erdos.agent import Agent
+from erdos.conversation import Conversation
+from erdos.db import DB
+from .common import result
+from .persistence import history
+
+conversation_ids = itertools.count(10 ** 9)
+
+
+def run(db_dir: str, conversations: int, length: int) -> dict:
+    """Measure the memory taken by resident conversations, with their session history
+
+    Args:
+        db_dir (str): directory of the database
+        conversations (int): number of conversations
+        length (int): number of messages of each conversation
+
+    Returns:
+        dict: benchmark record
+    """
+    agent = Agent.instance
+    db = DB(f"{db_dir}/memory.db")
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    resident = []
+    for _ in range(conversations):
+        conversation = Conversation(next(conversation_ids), None, None, db=db)
+        agent.history[conversation._conversation_id] = history(length)
+        resident.append(conversation)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    for conversation in resident:
+        del agent.history[conversation._conversation_id]
+    return result("memory", {"conversations": conversations, "messages": length},
+                  {"bytes_per_conversation": (after - before) // conversations})
+
+
+def suite(db_dir: str, quick: bool) -> list[dict]:
+    """Run the memory benchmarks
+
+    Args:
+        db_dir (str): directory of the database
+        quick (bool): whether to run the smallest configurations only
+
+    Returns:
+        list[dict]: benchmark records
+    """
+    configurations = [(100, 0), (100, 20)]
+    if not quick:
+        configurations += [(500, 100), (500, 1000)]
+    return [run(db_dir, *configuration) for configuration in configurations]
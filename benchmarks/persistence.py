@@ -0,0 +1,97 @@
+import itertools
+import json
+import os
+from erdos.agent import Agent
+from erdos.db import DB
+from erdos.history import CompactHistory
+from langchain_core.messages import AIMessage, HumanMessage, message_to_dict
+from .common import result, time_per_call
+
+
+def history(length: int) -> CompactHistory:
+    """History of a conversation, of length messages
+
+    Args:
+        length (int): number of messages
+
+    Returns:
+        CompactHistory: conversation history
+    """
+    messages = []
+    for turn in range(length // 2):
+        messages += [HumanMessage(content=f"What is {turn}*{turn}?"),
+                     AIMessage(content=f"{turn}*{turn} = {turn * turn}")]
+    return CompactHistory(messages)
+
+
+def run(db_dir: str, length: int) -> list[dict]:
+    """Measure storing, retrieving and stringifying a conversation, against its history length
+
+    Args:
+        db_dir (str): directory of the database
+        length (int): number of messages of the conversation
+
+    Returns:
+        list[dict]: benchmark records
+    """
+    db = DB(os.path.join(db_dir, "persistence.db"))
+    conversation_history = history(length)
+    messages = Agent.dump_messages(conversation_history.messages)
+    conversation_ids = itertools.count(length * 1000)
+    # Appending a turn to a stored conversation, as incremental stores do
+    db.store(length, messages)
+    seqs = itertools.count(length, 2)
+
+    def append_turn():
+        db.store(length, messages[:2], start=next(seqs))
+
+    # Appending a turn to a session history and rendering the prompt's
+    # history, as each turn does
+    session_history = history(length)
+    turn = history(2).messages
+
+    def render_turn():
+        session_history.add_messages(turn)
+        Agent.render_messages(session_history, session_history.messages)
+
+    # Bytes stored per message, against the pydantic JSON text they used to be
+    # stored as
+    stored_bytes = db.connection().execute(
+        "SELECT SUM(LENGTH(message)) FROM messages WHERE conversation_id = (?)",
+        (length,)).fetchone()[0]
+    text_bytes = sum(len(json.dumps(message_to_dict(message)))
+                     for message in conversation_history.messages)
+
+    params = {"messages": length}
+    records = [
+        result("db_footprint", params, {
+            "bytes_per_message": round(stored_bytes / length, 1),
+            "compression_ratio": round(text_bytes / stored_bytes, 2)}),
+        result("db_store", params, {"ms_per_call": round(1000 * time_per_call(
+            lambda: db.store(next(conversation_ids), messages)), 4)}),
+        result("db_store_turn", params, {"ms_per_call": round(1000 * time_per_call(
+            append_turn), 4)}),
+        result("db_retrieve", params, {"ms_per_call": round(1000 * time_per_call(
+            lambda: db.retrieve(length * 1000)), 4)}),
+        result("db_retrieve_last", params, {"ms_per_call": round(1000 * time_per_call(
+            lambda: db.retrieve(length * 1000, last=20)), 4)}),
+        result("stringify_messages", params, {"ms_per_call": round(1000 * time_per_call(
+            lambda: Agent.stringify_messages(conversation_history)), 4)}),
+        result("render_turn", params, {"ms_per_call": round(1000 * time_per_call(
+            render_turn), 4)}),
+    ]
+    return records
+
+
+def suite(db_dir: str, quick: bool) -> list[dict]:
+    """Run the persistence benchmarks
+
+    Args:
+        db_dir (str): directory of the database
+        quick (bool): whether to run the smallest configurations only
+
+    Returns:
+        list[dict]: benchmark records
+    """
+    lengths = [10, 100] if quick else [10, 100, 1000, 5000]
+    return [record for length in lengths for record in run(db_dir, length)]
@@ -0,0 +1,61 @@
+"""Benchmarks of erdos against a fake LLM backend, writing their results as JSON
+
+Usage:
+    python -m benchmarks.run [--quick] [--only channels,persistence,memory,imports] [--output results.json]
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from erdos.agent import Agent
+from erdos.backend import FakeBackend
+from . import channels, imports, memory, persistence
+
+SUITES = {"channels": channels.suite,
+          "persistence": persistence.suite,
+          "memory": memory.suite,
+          "imports": imports.suite}
+
+
+def main(argv: list[str] = None) -> dict:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true",
+                        help="run the smallest configurations only")
+    parser.add_argument("--only", default=",".join(SUITES),
+                        help="comma separated suites to run")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="median seconds of the fake LLM calls")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the fake LLM")
+    parser.add_argument(
+        "--output",
+        help="file to write the results to, instead of stdout")
+    args = parser.parse_args(argv)
+
+    # The agent is shared, it must be built on the fake backend before any
+    # channel is
+    Agent(None, backend=FakeBackend(
+        latency=FakeBackend.lognormal(args.latency, 0.5), seed=args.seed))
+    results = []
+    with tempfile.TemporaryDirectory() as db_dir:
+        for name in args.only.split(","):
+            print(f"Running {name} benchmarks", file=sys.stderr)
+            results += SUITES[name](db_dir, args.quick)
+    report = {"created": time.time(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "fake_latency": args.latency,
+              "results": results}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,15 @@
-from erdos.channel import Channel
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from erdos.channel import Channel
+
+__all__ = ["Channel"]
+
+
+def __getattr__(name: str):
+    # Channel is imported on first access, so that importing erdos stays cheap
+    # and free of side effects
+    if name == "Channel":
+        from erdos.channel import Channel
+        return Channel
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1,15 +1,36 @@
-from langchain_community.chat_models import ChatOpenAI
-from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, HumanMessage, messages_from_dict
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain.prompts.prompt import PromptTemplate
-from langchain_openai import ChatOpenAI
+from langchain_core.prompts import PromptTemplate
+from .backend import LLMBackend
+from .cache import ResponseCache
+from .client_pool import ClientPool
+from .calculator import ArithmeticRouter
+from .history import CompactHistory, HistoryStore
+from .limiter import RateLimiter
+from .metrics import MetricsRegistry
+from .resilience import CircuitBreaker, LLMError, LLMTimeoutError, ResilientModel, RetryPolicy
+from .scheduler import WeightedFairScheduler
+from .window import HistoryWindow
+from typing import Callable, Hashable, Union
 import asyncio
+import contextlib
+import functools
 import json
+import time
 
 
 class Agent:
 
-    LLM_API_TIMEOUT = 60 * 3
+    # Prompt folding older messages into the rolling summary of a
+    # conversation, keeping the numbers it relies on
+    SUMMARY_PROMPT = (
+        "Update the summary of a conversation between a user and a math assistant with the "
+        "messages below. Keep every question asked, and every number and result given.\n"
+        "Summary so far: {summary}\n"
+        "Messages:\n{messages}\n"
+        "Updated summary:")
 
     # Singleton instance
     instance = None
@@ -19,55 +40,150 @@ class Agent:
             cls.instance = super(Agent, cls).__new__(cls)
         return cls.instance
 
-    def __init__(self, llm_api_key: str):
+    def __init__(self, llm_api_key: str, response_cache: ResponseCache = None,
+                 router: ArithmeticRouter = None, limiter: RateLimiter = None,
+                 scheduler: WeightedFairScheduler = None, history: HistoryStore = None,
+                 window: HistoryWindow = None, backend: LLMBackend = None,
+                 retry: RetryPolicy = None, breaker: CircuitBreaker = None):
+        """
+        Args:
+            llm_api_key (str): OpenAI API key
+            response_cache (ResponseCache, optional): cache of LLM responses. Defaults to None.
+            router (ArithmeticRouter, optional): router answering plain arithmetic locally.
+            Defaults to None, for ArithmeticRouter(). ArithmeticRouter(enabled=False) sends every
+            message to the LLM.
+            limiter (RateLimiter, optional): limiter of LLM calls, shared by all channels.
+            Defaults to None.
+            scheduler (WeightedFairScheduler, optional): scheduler ordering LLM calls of
+            competing channels by their weight. Defaults to None.
+            history (HistoryStore, optional): store of the session histories, which can bound the
+            memory they take by evicting the least recently used to SQLite. Defaults to
+            HistoryStore(), with no bound.
+            window (HistoryWindow, optional): window bounding the history injected into
+            prompts. Defaults to None, for the whole history.
+            backend (LLMBackend, optional): backend creating the chat models of the LLM chains.
+            Defaults to ClientPool([llm_api_key]), which the keys the agent is initialised with
+            later join.
+            retry (RetryPolicy, optional): timeouts, retries and hedging of LLM calls.
+            Defaults to RetryPolicy().
+            breaker (CircuitBreaker, optional): circuit breaker failing LLM calls fast while the
+            provider is down. Defaults to None.
+        """
         if hasattr(self, '_init') and self._init:
+            # Keys of later channels join the pool instead of being ignored
+            if llm_api_key is not None and isinstance(
+                    self.backend, ClientPool):
+                self.backend.add(llm_api_key)
             return
-        self.llm = self.__initialize_llm__(llm_api_key)
-        self.history = {}
+        self.backend = backend or ClientPool([llm_api_key])
+        # Set before the chains, whose model steps use them
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker
+        self.llm = self.__initialize_llm__()
+        # LLM chains of models other than the backend's default, by name
+        self._chains = {}
+        self.history = history if history is not None else HistoryStore()
+        if self.history.on_discard is None:
+            # Summaries of the window go with the histories they summarize
+            self.history.on_discard = self.forget_window
+        self.response_cache = response_cache
+        self.router = router or ArithmeticRouter()
+        self.limiter = limiter
+        self.scheduler = scheduler
+        self.window = window
+        self.metrics = MetricsRegistry.default()
         self._init = True
 
-    def get_session_history(self, conversation_id: str) -> ChatMessageHistory:
+    def get_session_history(self, conversation_id: str) -> CompactHistory:
         """Get conversation history based on conversation_id. Helper for RunnableWithMessageHistory
 
         Args:
             conversation_id (str): conversation id
 
         Returns:
-            ChatMessageHistory: conversation history
+            CompactHistory: conversation history
         """
-        if conversation_id not in self.history:
-            self.history[conversation_id] = ChatMessageHistory()
-        return self.history[conversation_id]
+        try:
+            return self.history[conversation_id]
+        except KeyError:
+            history = self.history[conversation_id] = CompactHistory()
+            return history
+
+    async def aget_session_history(
+            self, conversation_id: str) -> CompactHistory:
+        """Get conversation history based on conversation_id, as get_session_history does,
+        reloading it off the event loop if it was evicted
+
+        Args:
+            conversation_id (str): conversation id
+
+        Returns:
+            CompactHistory: conversation history
+        """
+        try:
+            return await self.history.aget(conversation_id)
+        except KeyError:
+            return self.get_session_history(conversation_id)
 
     def add_to_session_history(self, conversation_id: str,
-                               conversation_history: ChatMessageHistory):
+                               messages: list[str]):
         """Adding conversation history to agent's session history
 
         Args:
             conversation_id (str): conversation id
-            message (ChatMessageHistory): conversation history
+            messages (list[str]): serialized conversation messages
+        """
+        self.history[conversation_id] = CompactHistory(
+            self.load_messages(messages))
+
+    @staticmethod
+    def dump_messages(messages: list[BaseMessage]) -> list[str]:
+        """Serialize messages, one compact JSON document per message. Fields left to their
+        empty default are dropped, as is the type repeated in the message data
+
+        Args:
+            messages (list[BaseMessage]): messages
+
+        Returns:
+            list[str]: serialized messages
         """
-        conversation_history = ChatMessageHistory.model_validate(
-            json.loads(conversation_history))
-        self.history[conversation_id] = conversation_history
+        return [json.dumps({"type": message.type, "data": {
+            "content": message.content, **CompactHistory.fields(message)}},
+            separators=(",", ":")) for message in messages]
+
+    @staticmethod
+    def load_messages(messages: list[str]) -> list[BaseMessage]:
+        """Deserialize messages serialized with dump_messages
+
+        Args:
+            messages (list[str]): serialized messages
+
+        Returns:
+            list[BaseMessage]: messages
+        """
+        return messages_from_dict([json.loads(message)
+                                  for message in messages])
 
     def __initialize_llm__(
-            self, llm_api_key: str) -> RunnableWithMessageHistory:
-        """Initialise LLM chain with custom prompt
+            self, model: str = None) -> RunnableWithMessageHistory:
+        """Initialise LLM chain with custom prompt, on a chat model of the agent's backend
+
+        Args:
+            model (str, optional): name of the model. Defaults to None, for the backend's
+            default model.
 
         Returns:
             runnable_with_history (RunnableWithMessageHistory): LLM chain object
         """
 
-        # Temperature set to 0 to get deterministic responses, since it's a math
-        # assistant
-        llm = ChatOpenAI(
-            model="gpt-4",
-            temperature=0,
-            openai_api_key=llm_api_key)
+        # Calls to the model are retried and hedged within the chain, so that
+        # RunnableWithMessageHistory records the turn once whatever the
+        # attempts
+        llm = ResilientModel(self.backend.chat_model(model), model or LLMBackend.DEFAULT_MODEL,
+                             self.retry, self.breaker)
 
         # Define a custom prompt
-        prompt = PromptTemplate(
+        prompt = self.prompt = PromptTemplate(
             input_variables=["history", "input"],
             template=(
                 """You are a helpful assistant.
@@ -81,7 +197,12 @@ class Agent:
             ),
         )
 
-        runnable = prompt | llm  # Connect the prompt to the LLm chain
+        if model is None:
+            self.chat_model = llm
+
+        # Connect the history window and the prompt to the LLm chain
+        runnable = (RunnableLambda(self._prepare_inputs) | RunnableLambda(self._render_inputs)
+                    | prompt | llm)
 
         runnable_with_history = RunnableWithMessageHistory(
             runnable,
@@ -93,26 +214,390 @@ class Agent:
         # Define a conversation chain with custom prompt
         return runnable_with_history
 
-    async def send_message(self, conversation_id: int, message: str) -> str:
+    def chain(self, model: str = None) -> RunnableWithMessageHistory:
+        """Get the LLM chain of a model, initialising it on first use
+
+        Args:
+            model (str, optional): name of the model. Defaults to None, for the backend's
+            default model.
+
+        Returns:
+            RunnableWithMessageHistory: LLM chain object
+        """
+        if model is None:
+            return self.llm
+        if model not in self._chains:
+            self._chains[model] = self.__initialize_llm__(model)
+        return self._chains[model]
+
+    async def send_message(self, conversation_id: int, message: str,
+                           channel: Hashable = None, weight: float = 1.0,
+                           on_chunk: Callable[[str], None] = None, model: str = None,
+                           client: str = None) -> str:
         """Send message to the LLM chain, with conversation_id identifying a conversation as context
 
         Args:
             conversation_id (int): conversation id
             message (str): prompt
+            channel (Hashable, optional): channel the conversation belongs to, for the scheduler.
+            Defaults to None.
+            weight (float, optional): weight of the channel, for the scheduler. Defaults to 1.0.
+            on_chunk (Callable[[str], None], optional): callback streaming the response, called
+            with each chunk as the LLM produces it. Responses answered without the LLM come as a
+            single chunk. Defaults to None, for waiting for the whole response.
+            model (str, optional): name of the model answering, e.g. the conversation's
+            channel's. Defaults to None, for the backend's default model.
+            client (str, optional): name of the client of the agent's ClientPool the LLM call is
+            pinned to. Defaults to None, for any client.
 
         Returns:
             responses.content: LLM chain response
+
+        Raises:
+            LLMError: the LLM call failed, the turn isn't recorded in the session history
+        """
+        # The turn appends to the history, which mustn't be evicted meanwhile
+        with self.history.pinned(conversation_id):
+            return await self._send_message(
+                conversation_id, message, channel, weight, on_chunk, model, client)
+
+    async def send_messages(self, conversation_id: int, messages: list[str],
+                            channel: Hashable = None, weight: float = 1.0,
+                            on_chunk: Callable[[str], None] = None,
+                            model: str = None, client: str = None) -> str:
+        """Send several messages to the LLM chain as a single turn, as send_message does. Each
+        message is recorded in the session history, followed by the single response
+
+        Args:
+            conversation_id (int): conversation id
+            messages (list[str]): prompts
+            channel (Hashable, optional): channel the conversation belongs to, for the scheduler.
+            Defaults to None.
+            weight (float, optional): weight of the channel, for the scheduler. Defaults to 1.0.
+            on_chunk (Callable[[str], None], optional): callback streaming the response.
+            Defaults to None.
+            model (str, optional): name of the model answering. Defaults to None, for the
+            backend's default model.
+            client (str, optional): name of the client the LLM call is pinned to. Defaults to
+            None, for any client.
+
+        Returns:
+            responses.content: LLM chain response
+        """
+        if len(messages) == 1:
+            return await self.send_message(
+                conversation_id, messages[0], channel, weight, on_chunk, model, client)
+        with self.history.pinned(conversation_id):
+            return await self._send_message(
+                conversation_id, messages, channel, weight, on_chunk, model, client)
+
+    async def _send_message(self, conversation_id: int, message: Union[str, list[str]],
+                            channel: Hashable, weight: float,
+                            on_chunk: Callable[[str], None], model: str,
+                            client: str = None) -> str:
+        """Send message, or messages as a single turn, to the LLM chain, with the conversation's
+        history pinned in memory
         """
+        history = await self.aget_session_history(conversation_id)
+        router = self.router
+        # The router answers single questions only
+        if router and isinstance(message, str):
+            answer = router.route(message, history)
+            if answer is not None:
+                self.metrics.inc("erdos_local_answers_total")
+                self.record_turn(history, message, answer)
+                if on_chunk:
+                    on_chunk(answer)
+                return answer
+
+        response_cache, limiter = self.response_cache, self.limiter
+        prompt = None
+        if response_cache or limiter or self.window:
+            # Windowed before the LLM call takes its slots, so that summaries
+            # are dispatched and limited for the channel, and the chain step
+            # finds the summary up to date
+            messages = await self.window_messages(
+                conversation_id, history.messages, channel, weight)
+        if response_cache or limiter:
+            # Render the history canonically, since the messages returned by
+            # the LLM carry ids and metadata unique to each call
+            prompt = self.prompt.format(
+                history=self.render_messages(history, messages),
+                input=self.join_messages(message))
+            if model is not None:
+                # Responses of other models are cached apart
+                prompt = f"{model}\n{prompt}"
+        if response_cache:
+            cached_response = await response_cache.get(prompt)
+            self.metrics.inc("erdos_cache_requests_total",
+                             result="miss" if cached_response is None else "hit")
+            if cached_response is not None:
+                self.record_turn(history, message, cached_response)
+                if on_chunk:
+                    on_chunk(cached_response)
+                return cached_response
+
         try:
-            response = await asyncio.wait_for(self.llm.ainvoke(
-                {"input": message},
-                config={"configurable": {"session_id": conversation_id}},
-            ), timeout=Agent.LLM_API_TIMEOUT)
+            scheduler = self.scheduler
+            if scheduler:
+                start = time.monotonic()
+                async with scheduler.slot(channel, weight):
+                    self.metrics.observe("erdos_scheduler_wait_seconds",
+                                         time.monotonic() - start, channel=channel)
+                    response = await self._invoke_limited(
+                        conversation_id, message, limiter, prompt, on_chunk, model, client)
+            else:
+                response = await self._invoke_limited(
+                    conversation_id, message, limiter, prompt, on_chunk, model, client)
 
         except Exception as e:
-            return "LLM API is not responsive at the moment. Following error occured: {e}"
+            error = self.llm_error(e, model or LLMBackend.DEFAULT_MODEL)
+            self.metrics.inc(
+                "erdos_llm_errors_total",
+                model=error.model,
+                kind=error.kind)
+            raise error from e
+        if response_cache:
+            await response_cache.put(prompt, response.content)
         return response.content
 
+    async def _invoke(self, conversation_id: int, message: Union[str, list[str]],
+                      on_chunk: Callable[[str], None] = None, model: str = None,
+                      client: str = None):
+        """Invoke the LLM chain
+
+        Args:
+            conversation_id (int): conversation id
+            message (Union[str, list[str]]): prompt, or prompts of a single turn
+            on_chunk (Callable[[str], None], optional): callback streaming the response.
+            Defaults to None.
+            model (str, optional): name of the model. Defaults to None, for the backend's
+            default model.
+            client (str, optional): name of the client of the agent's ClientPool the call is
+            pinned to. Defaults to None, for any client.
+
+        Returns:
+            response: LLM chain response
+        """
+        chain = self.chain(model)
+        config = {"configurable": {"session_id": conversation_id}}
+        if client is not None:
+            # Read by the pool's model step
+            config["configurable"]["client"] = client
+        if not isinstance(message, str):
+            # RunnableWithMessageHistory records each message of the list
+            message = [HumanMessage(content=content) for content in message]
+        if on_chunk:
+            call = self._stream(chain, {"input": message}, config, on_chunk)
+        else:
+            call = chain.ainvoke({"input": message}, config=config)
+        with self.metrics.span("erdos_llm_seconds", model=model or LLMBackend.DEFAULT_MODEL):
+            # The model step enforces the deadline of the LLM call, this one
+            # bounds the whole chain
+            return await asyncio.wait_for(call, timeout=self.retry.deadline)
+
+    @staticmethod
+    def llm_error(error: Exception, model: str) -> LLMError:
+        """Get the structured error a failed turn raises
+
+        Args:
+            error (Exception): error raised by the LLM chain
+            model (str): name of the model
+
+        Returns:
+            LLMError: the error if it's already one, else an LLMError describing it
+        """
+        if isinstance(error, LLMError):
+            return error
+        if isinstance(error, asyncio.TimeoutError):
+            return LLMTimeoutError(
+                f"LLM API is not responsive at the moment, {model} timed out", model)
+        return LLMError(
+            f"LLM API is not responsive at the moment. Following error occured: {error}", model)
+
+    @staticmethod
+    async def _stream(chain: RunnableWithMessageHistory, inputs: dict, config: dict,
+                      on_chunk: Callable[[str], None]):
+        """Stream the LLM chain response. The chain records the whole response in the session
+        history once the stream ends
+
+        Args:
+            chain (RunnableWithMessageHistory): LLM chain object
+            inputs (dict): chain inputs
+            config (dict): chain config
+            on_chunk (Callable[[str], None]): callback called with each chunk
+
+        Returns:
+            response: LLM chain response, as the sum of its chunks
+
+        Raises:
+            ValueError: the stream has no chunks, and the chain recorded no turn
+        """
+        response = None
+        async for chunk in chain.astream(inputs, config=config):
+            if chunk.content:
+                on_chunk(chunk.content)
+            response = chunk if response is None else response + chunk
+        if response is None:
+            raise ValueError("LLM streamed an empty response")
+        return response
+
+    async def _invoke_limited(self, conversation_id: int, message: Union[str, list[str]],
+                              limiter: RateLimiter, prompt: str,
+                              on_chunk: Callable[[str], None] = None, model: str = None,
+                              client: str = None):
+        """Invoke the LLM chain once the limiter allows it, then charge the limiter for the
+        tokens actually used
+
+        Args:
+            conversation_id (int): conversation id
+            message (Union[str, list[str]]): prompt, or prompts of a single turn
+            limiter (RateLimiter): limiter of LLM calls, None for no limits
+            prompt (str): rendered prompt, to estimate the tokens of the call
+            on_chunk (Callable[[str], None], optional): callback streaming the response.
+            Defaults to None.
+            model (str, optional): name of the model. Defaults to None.
+            client (str, optional): name of the client the call is pinned to. Defaults to None.
+
+        Returns:
+            response: LLM chain response
+        """
+        if not limiter:
+            return await self._invoke(conversation_id, message, on_chunk, model, client)
+        tokens = RateLimiter.estimate_tokens(prompt)
+        start = time.monotonic()
+        async with limiter.slot(tokens):
+            self.metrics.observe(
+                "erdos_limiter_wait_seconds",
+                time.monotonic() - start)
+            response = await self._invoke(conversation_id, message, on_chunk, model, client)
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            limiter.adjust(usage["total_tokens"] - tokens)
+        return response
+
+    async def window_messages(self, conversation_id: int, messages: list[BaseMessage],
+                              channel: Hashable = None, weight: float = 1.0,
+                              limited: bool = True) -> list[BaseMessage]:
+        """Window the history injected into the prompt, with the agent's history window
+
+        Args:
+            conversation_id (int): conversation id
+            messages (list[BaseMessage]): whole history
+            channel (Hashable, optional): channel the conversation belongs to, for the
+            summaries' scheduling. Defaults to None.
+            weight (float, optional): weight of the channel. Defaults to 1.0.
+            limited (bool, optional): whether summaries take a slot of the scheduler and the
+            limiter. Defaults to True.
+
+        Returns:
+            list[BaseMessage]: messages to inject into the prompt
+        """
+        window = self.window
+        if not window:
+            return messages
+        return await window.apply(conversation_id, messages, functools.partial(
+            self.summarize, channel=channel, weight=weight, limited=limited))
+
+    def forget_window(self, conversation_id: int):
+        """Drop the rolling summary of the agent's history window for a conversation, once its
+        history is deleted, replaced or evicted
+
+        Args:
+            conversation_id (int): conversation id
+        """
+        window = self.window
+        if window:
+            window.forget(conversation_id)
+
+    async def _prepare_inputs(self, inputs: dict,
+                              config: RunnableConfig) -> dict:
+        """Window the history injected by RunnableWithMessageHistory, and join the messages of a
+        single turn. Step of the LLM chain
+        """
+        conversation_id = config["configurable"]["session_id"]
+        message = inputs["input"]
+        if not isinstance(message, str):
+            message = self.join_messages([m.content for m in message])
+        # The turn holds its slots already, and summarized its window before
+        # taking them
+        return {**inputs, "input": message, "history": await self.window_messages(
+            conversation_id, inputs["history"], limited=False)}
+
+    async def _render_inputs(self, inputs: dict,
+                             config: RunnableConfig) -> dict:
+        """Render the windowed history for the prompt, reusing the transcript of the session
+        history. Step of the LLM chain
+        """
+        history = config["configurable"].get("message_history")
+        return {
+            **inputs, "history": self.render_messages(history, inputs["history"])}
+
+    async def summarize(self, summary: str, messages: list[BaseMessage],
+                        channel: Hashable = None, weight: float = 1.0,
+                        limited: bool = True) -> str:
+        """Fold messages into the rolling summary of a conversation, with the LLM. The call is
+        dispatched by the agent's scheduler for the conversation's channel, and counted by its
+        limiter, as turns are
+
+        Args:
+            summary (str): summary so far
+            messages (list[BaseMessage]): messages to fold in
+            channel (Hashable, optional): channel the conversation belongs to, for the
+            scheduler. Defaults to None.
+            weight (float, optional): weight of the channel, for the scheduler. Defaults to 1.0.
+            limited (bool, optional): whether to take a slot of the scheduler and the limiter,
+            False if the caller holds them already. Defaults to True.
+
+        Returns:
+            str: updated summary
+        """
+        prompt = Agent.SUMMARY_PROMPT.format(
+            summary=summary or "None",
+            messages=self.render_messages(None, messages))
+        scheduler, limiter = (
+            self.scheduler, self.limiter) if limited else (
+            None, None)
+        tokens = RateLimiter.estimate_tokens(prompt)
+        async with contextlib.AsyncExitStack() as slots:
+            if scheduler:
+                await slots.enter_async_context(scheduler.slot(channel, weight))
+            if limiter:
+                await slots.enter_async_context(limiter.slot(tokens))
+            # The chat model enforces the retry policy's deadline
+            response = await self.chat_model.ainvoke(prompt)
+        usage = getattr(response, "usage_metadata", None)
+        if limiter and usage:
+            limiter.adjust(usage["total_tokens"] - tokens)
+        return response.content
+
+    @staticmethod
+    def join_messages(message: Union[str, list[str]]) -> str:
+        """Join the messages of a single turn into the prompt input
+
+        Args:
+            message (Union[str, list[str]]): user message, or messages of a single turn
+
+        Returns:
+            str: prompt input
+        """
+        return message if isinstance(message, str) else "\n".join(message)
+
+    @staticmethod
+    def record_turn(history: BaseChatMessageHistory, message: Union[str, list[str]],
+                    response: str):
+        """Record a turn answered without the LLM chain in the session history, as
+        RunnableWithMessageHistory would
+
+        Args:
+            history (BaseChatMessageHistory): conversation history
+            message (Union[str, list[str]]): user message, or messages of a single turn
+            response (str): assistant response
+        """
+        for content in [message] if isinstance(message, str) else message:
+            history.add_user_message(content)
+        history.add_ai_message(response)
+
     def get_messages(self, conversation_id: int, stringified: bool = False):
         """Return the conversation history based on the conversation_id
 
@@ -126,8 +611,27 @@ class Agent:
         return self.stringify_messages(messages) if stringified else messages
 
     @staticmethod
-    def stringify_messages(message_history: ChatMessageHistory) -> str:
+    def stringify_messages(message_history: BaseChatMessageHistory) -> str:
         if not message_history or not message_history.messages:
             return ""
-        return "\n".join(
-            [f"{msg.type.capitalize()}: {msg.content}" for msg in message_history.messages])
+        if isinstance(message_history, CompactHistory):
+            return message_history.transcript()
+        return "\n".join(CompactHistory.line(msg)
+                         for msg in message_history.messages)
+
+    @staticmethod
+    def render_messages(history: BaseChatMessageHistory,
+                        messages: list[BaseMessage]) -> str:
+        """Render messages of a history for the prompt, as stringify_messages does
+
+        Args:
+            history (BaseChatMessageHistory): conversation history the messages belong to, whose
+            transcript is reused if it's a CompactHistory. None for none
+            messages (list[BaseMessage]): messages, e.g. a window of the history
+
+        Returns:
+            str: transcript of the messages
+        """
+        if isinstance(history, CompactHistory):
+            return history.render(messages)
+        return "\n".join(CompactHistory.line(message) for message in messages)
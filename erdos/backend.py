@@ -0,0 +1,218 @@
+import abc
+import asyncio
+import random
+import threading
+import time
+import zlib
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from typing import Any, AsyncIterator, Callable, Iterator
+
+
+class LLMBackend(abc.ABC):
+
+    DEFAULT_MODEL = "gpt-4"
+
+    @abc.abstractmethod
+    def chat_model(self, model: str = None) -> BaseChatModel:
+        """Create the chat model the agent's LLM chain is built on
+
+        Args:
+            model (str, optional): name of the model. Defaults to None, for DEFAULT_MODEL.
+
+        Returns:
+            BaseChatModel: chat model
+        """
+
+
+class OpenAIBackend(LLMBackend):
+
+    def __init__(self, llm_api_key: str, organization: str = None):
+        """Chat models of the OpenAI API
+
+        Args:
+            llm_api_key (str): OpenAI API key
+            organization (str, optional): OpenAI organization billed. Defaults to None, for the
+            key's default organization.
+        """
+        self.llm_api_key = llm_api_key
+        self.organization = organization
+
+    def chat_model(self, model: str = None) -> BaseChatModel:
+        # Imported on first use, the OpenAI client being slow to import
+        from langchain_openai import ChatOpenAI
+
+        # Temperature set to 0 to get deterministic responses, since it's a
+        # math assistant
+        return ChatOpenAI(
+            model=model or LLMBackend.DEFAULT_MODEL,
+            temperature=0,
+            openai_api_key=self.llm_api_key,
+            openai_organization=self.organization,
+            # Report token usage of streamed calls too, for the limiter
+            stream_usage=True)
+
+
+class FakeBackendError(Exception):
+    """Error injected by the fake backend"""
+
+
+class FakeBackend(LLMBackend):
+
+    # Rough number of characters per token, for the usage reported
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, latency: Callable[[random.Random], float] = None,
+                 chunk_latency: float = 0.0, error_rate: float = 0.0,
+                 chunk_size: int = 1, seed: int = 0,
+                 responder: Callable[[str, str], str] = None):
+        """Deterministic in-process chat models, to drive the pipeline offline. Responses,
+        latencies and errors are drawn from a random generator seeded with seed
+
+        Args:
+            latency (Callable[[random.Random], float], optional): distribution of the seconds
+            before the first token, e.g. FakeBackend.lognormal(0.8, 0.5). Defaults to None, for
+            no latency.
+            chunk_latency (float, optional): seconds between chunks. Defaults to 0.0.
+            error_rate (float, optional): probability of a call raising FakeBackendError.
+            Defaults to 0.0.
+            chunk_size (int, optional): number of words per streamed chunk. Defaults to 1.
+            seed (int, optional): seed of the random generator. Defaults to 0.
+            responder (Callable[[str, str], str], optional): function of the model name and the
+            prompt returning the response. Defaults to FakeBackend.respond.
+        """
+        self.latency = latency or FakeBackend.constant(0.0)
+        self.chunk_latency = chunk_latency
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.responder = responder or FakeBackend.respond
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def chat_model(self, model: str = None) -> BaseChatModel:
+        return FakeChatModel(
+            backend=self, model=model or LLMBackend.DEFAULT_MODEL)
+
+    @staticmethod
+    def constant(seconds: float) -> Callable[[random.Random], float]:
+        """Latency distribution of a constant number of seconds"""
+        return lambda generator: seconds
+
+    @staticmethod
+    def uniform(low: float, high: float) -> Callable[[random.Random], float]:
+        """Latency distribution uniform between low and high seconds"""
+        return lambda generator: generator.uniform(low, high)
+
+    @staticmethod
+    def lognormal(
+            median: float, sigma: float) -> Callable[[random.Random], float]:
+        """Latency distribution log-normal around a median number of seconds, with the long
+        tail of real LLM APIs
+        """
+        return lambda generator: median * generator.lognormvariate(0, sigma)
+
+    @staticmethod
+    def respond(model: str, prompt: str) -> str:
+        """Default responder, deterministic in the prompt
+
+        Args:
+            model (str): name of the model
+            prompt (str): rendered prompt
+
+        Returns:
+            str: response
+        """
+        return f"Response {zlib.crc32(prompt.encode()):08x} of the fake {model} model."
+
+    def call(self, model: str,
+             messages: list[BaseMessage]) -> tuple[list[str], float, dict]:
+        """Draw the outcome of a call
+
+        Args:
+            model (str): name of the model
+            messages (list[BaseMessage]): prompt messages
+
+        Returns:
+            tuple[list[str], float, dict]: response chunks, seconds before the first one, and
+            token usage
+
+        Raises:
+            FakeBackendError: injected error
+        """
+        prompt = "\n".join(str(message.content) for message in messages)
+        with self._lock:
+            self.calls += 1
+            latency = self.latency(self._random)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if failed:
+            raise FakeBackendError(f"Injected error of the fake {model} model")
+        words = self.responder(model, prompt).split(" ")
+        chunks = [" ".join(words[i:i + self.chunk_size]) + " "
+                  for i in range(0, len(words), self.chunk_size)]
+        chunks[-1] = chunks[-1][:-1]
+        input_tokens = len(prompt) // FakeBackend.CHARS_PER_TOKEN + 1
+        output_tokens = sum(
+            map(len, chunks)) // FakeBackend.CHARS_PER_TOKEN + 1
+        usage = {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                 "total_tokens": input_tokens + output_tokens}
+        return chunks, latency, usage
+
+    def stats(self) -> dict:
+        """Get the backend metrics
+
+        Returns:
+            dict: number of calls and of injected errors
+        """
+        with self._lock:
+            return {"calls": self.calls, "errors": self.errors}
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model of FakeBackend"""
+
+    backend: Any
+    model: str
+
+    @property
+    def _llm_type(self) -> str:
+        return "erdos-fake"
+
+    def _generate(self, messages: list[BaseMessage], stop: list[str] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        chunks, latency, usage = self.backend.call(self.model, messages)
+        time.sleep(latency + self.backend.chunk_latency * (len(chunks) - 1))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(
+            content="".join(chunks), usage_metadata=usage))])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: list[str] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        chunks, latency, usage = self.backend.call(self.model, messages)
+        await asyncio.sleep(latency + self.backend.chunk_latency * (len(chunks) - 1))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(
+            content="".join(chunks), usage_metadata=usage))])
+
+    def _stream(self, messages: list[BaseMessage], stop: list[str] = None,
+                run_manager: Any = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        chunks, latency, usage = self.backend.call(self.model, messages)
+        time.sleep(latency)
+        for position, chunk in enumerate(chunks):
+            if position:
+                time.sleep(self.backend.chunk_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
+
+    async def _astream(self, messages: list[BaseMessage], stop: list[str] = None,
+                       run_manager: Any = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        chunks, latency, usage = self.backend.call(self.model, messages)
+        await asyncio.sleep(latency)
+        for position, chunk in enumerate(chunks):
+            if position:
+                await asyncio.sleep(self.backend.chunk_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=chunk))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=usage))
@@ -0,0 +1,114 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from .db import DB
+
+
+class ResponseCache:
+
+    MAX_SIZE = 1024
+    TTL = 60 * 60
+
+    def __init__(self, max_size: int = MAX_SIZE, ttl: float = TTL,
+                 db_path: str = None):
+        """Cache of LLM responses, keyed by a hash of the rendered prompt. Responses are kept in
+        memory, evicting the least recently used ones, and optionally in a SQLite database
+
+        Args:
+            max_size (int, optional): maximum number of responses kept in memory. Defaults to
+            MAX_SIZE.
+            ttl (float, optional): number of seconds a response stays valid. Defaults to TTL.
+            db_path (str, optional): path of the database to also keep responses in, e.g.
+            DB.DEFAULT_PATH. Defaults to None, for keeping them in memory only.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.db = DB(db_path) if db_path else None
+        # Responses and their timestamp by key, least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(prompt: str) -> str:
+        """Get the cache key of a prompt
+
+        Args:
+            prompt (str): rendered prompt
+
+        Returns:
+            str: cache key
+        """
+        return hashlib.sha256(prompt.encode()).hexdigest()
+
+    async def get(self, prompt: str) -> str:
+        """Get the cached response to a prompt
+
+        Args:
+            prompt (str): rendered prompt
+
+        Returns:
+            str: LLM response, None on a cache miss
+        """
+        key = ResponseCache.key(prompt)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < now - self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        entry = None
+        if self.db:
+            entry = await self.db.aio.run(
+                self.db.retrieve_response, key, now - self.ttl)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._put_in_memory(key, *entry)
+        return entry[0]
+
+    async def put(self, prompt: str, response: str):
+        """Cache the response to a prompt
+
+        Args:
+            prompt (str): rendered prompt
+            response (str): LLM response
+        """
+        key = ResponseCache.key(prompt)
+        now = time.time()
+        self._put_in_memory(key, response, now)
+        if self.db:
+            await self.db.aio.run(self.db.store_response, key, response, now)
+
+    def _put_in_memory(self, key: str, response: str, created: float):
+        """Keep a response in memory, evicting the least recently used ones beyond max_size
+
+        Args:
+            key (str): cache key
+            response (str): LLM response
+            created (float): timestamp of the response
+        """
+        with self._lock:
+            self._entries[key] = (response, created)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """Get the cache counters
+
+        Returns:
+            dict: number of hits, misses and responses kept in memory
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries)}
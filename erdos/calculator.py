@@ -0,0 +1,212 @@
+import ast
+import math
+import operator
+import re
+import threading
+from typing import TYPE_CHECKING, Optional, Union
+
+if TYPE_CHECKING:
+    from langchain_core.chat_history import BaseChatMessageHistory
+
+
+class ArithmeticRouter:
+
+    # Largest exponent and operand magnitude evaluated locally, bigger ones
+    # are left to the LLM
+    MAX_EXPONENT = 64
+    MAX_MAGNITUDE = 10 ** 15
+
+    OPERATORS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.Div: operator.truediv,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.Pow: operator.pow,
+        ast.UAdd: operator.pos,
+        ast.USub: operator.neg,
+    }
+
+    NUMBER = r"-?\d+(?:\.\d+)?"
+    PREVIOUS = r"(?:the )?(?:(?:previous|last) )?(?:result|response|answer)"
+    # Plain arithmetic questions, e.g. "What is 2+2?"
+    EXPRESSION = re.compile(
+        r"^(?:(?:what is|what's|calculate|compute|evaluate)\s+)?"
+        r"(?P<expression>[\d\s.+\-*/%^()×÷]+?)\s*[?.!]?$",
+        re.IGNORECASE)
+    # Follow-ups on the previous result, with the operator they apply
+    FOLLOW_UPS = [
+        (re.compile(
+            rf"^add (?P<operand>{NUMBER}) to {PREVIOUS}[?.!]?$", re.IGNORECASE), "+"),
+        (re.compile(
+            rf"^subtract (?P<operand>{NUMBER}) from {PREVIOUS}[?.!]?$", re.IGNORECASE), "-"),
+        (re.compile(
+            rf"^multiply {PREVIOUS} by (?P<operand>{NUMBER})[?.!]?$", re.IGNORECASE), "*"),
+        (re.compile(
+            rf"^divide {PREVIOUS} by (?P<operand>{NUMBER})[?.!]?$", re.IGNORECASE), "/"),
+    ]
+    # Numeric result ending an assistant reply, e.g. "2 + 2 = 4" or "The
+    # result is 4."
+    RESULT = re.compile(
+        rf"(?:=|\bis|\bequals)\s*(?P<result>{NUMBER})\s*[.!]?\s*$", re.IGNORECASE)
+
+    def __init__(self, enabled: bool = True, follow_ups: bool = True):
+        """Answers plain arithmetic questions locally, and follow-ups on the previous result, so
+        that they don't need an LLM call
+
+        Args:
+            enabled (bool, optional): whether to answer locally. Defaults to True.
+            follow_ups (bool, optional): whether to answer follow-ups on the previous result.
+            Defaults to True.
+        """
+        self.enabled = enabled
+        self.follow_ups = follow_ups
+        self.short_circuited = 0
+        self.fell_through = 0
+        self._lock = threading.Lock()
+
+    def route(self, message: str,
+              history: 'BaseChatMessageHistory') -> Optional[str]:
+        """Answer the message locally, if it can be answered confidently
+
+        Args:
+            message (str): user message
+            history (BaseChatMessageHistory): conversation history
+
+        Returns:
+            Optional[str]: answer, None if the message should be sent to the LLM
+        """
+        if not self.enabled:
+            return None
+        expression = self.parse(message.strip(), history)
+        result = self.evaluate(expression) if expression else None
+        with self._lock:
+            if result is None:
+                self.fell_through += 1
+                return None
+            self.short_circuited += 1
+        return f"{expression} = {self.format_number(result)}"
+
+    def parse(self, message: str,
+              history: 'BaseChatMessageHistory') -> Optional[str]:
+        """Get the arithmetic expression a message asks for
+
+        Args:
+            message (str): user message
+            history (BaseChatMessageHistory): conversation history
+
+        Returns:
+            Optional[str]: expression, None if the message isn't plain arithmetic
+        """
+        match = ArithmeticRouter.EXPRESSION.match(message)
+        if match and re.search(r"\d", match["expression"]):
+            return " ".join(match["expression"].split())
+
+        if not self.follow_ups:
+            return None
+        for pattern, symbol in ArithmeticRouter.FOLLOW_UPS:
+            match = pattern.match(message)
+            if match:
+                previous = self.previous_result(history)
+                if previous is None:
+                    return None
+                return f"{previous} {symbol} {match['operand']}"
+        return None
+
+    @staticmethod
+    def previous_result(history: 'BaseChatMessageHistory') -> Optional[str]:
+        """Get the numeric result ending the last assistant reply
+
+        Args:
+            history (BaseChatMessageHistory): conversation history
+
+        Returns:
+            Optional[str]: previous result, None if the last reply doesn't end with one
+        """
+        for message in reversed(history.messages):
+            if message.type == "ai":
+                match = ArithmeticRouter.RESULT.search(str(message.content))
+                return match["result"] if match else None
+        return None
+
+    @staticmethod
+    def evaluate(expression: str) -> Optional[Union[int, float]]:
+        """Safely evaluate an arithmetic expression
+
+        Args:
+            expression (str): arithmetic expression
+
+        Returns:
+            Optional[Union[int, float]]: result, None if it can't be evaluated confidently
+        """
+        expression = expression.replace("^", "**").replace(
+            "×", "*").replace("÷", "/")
+        try:
+            tree = ast.parse(expression, mode="eval")
+            # Bare numbers aren't questions
+            if not any(isinstance(node, ast.BinOp)
+                       for node in ast.walk(tree)):
+                return None
+            result = ArithmeticRouter._evaluate_node(tree.body)
+            # Negative numbers raised to fractional powers are complex, and
+            # integers too large for a float overflow the finiteness check
+            if isinstance(result, complex) or not math.isfinite(result) or abs(
+                    result) > ArithmeticRouter.MAX_MAGNITUDE:
+                return None
+        except (SyntaxError, ValueError, ArithmeticError, RecursionError):
+            return None
+        return result
+
+    @staticmethod
+    def _evaluate_node(node: ast.AST) -> Union[int, float]:
+        """Evaluate a node of an arithmetic expression, rejecting anything but numbers and
+        arithmetic operators
+
+        Args:
+            node (ast.AST): expression node
+
+        Returns:
+            Union[int, float]: result
+        """
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            return node.value
+        if isinstance(node, ast.UnaryOp) and type(
+                node.op) in ArithmeticRouter.OPERATORS:
+            return ArithmeticRouter.OPERATORS[type(node.op)](
+                ArithmeticRouter._evaluate_node(node.operand))
+        if isinstance(node, ast.BinOp) and type(
+                node.op) in ArithmeticRouter.OPERATORS:
+            left = ArithmeticRouter._evaluate_node(node.left)
+            right = ArithmeticRouter._evaluate_node(node.right)
+            if isinstance(node.op, ast.Pow) and abs(
+                    right) > ArithmeticRouter.MAX_EXPONENT:
+                raise ValueError(f"Exponent too large: {right}")
+            if max(abs(left), abs(right)) > ArithmeticRouter.MAX_MAGNITUDE:
+                raise ValueError("Operand too large")
+            return ArithmeticRouter.OPERATORS[type(node.op)](left, right)
+        raise ValueError(f"Unsupported expression: {ast.dump(node)}")
+
+    @staticmethod
+    def format_number(number: Union[int, float]) -> str:
+        """Format a result, without a fractional part when it's a whole number
+
+        Args:
+            number (Union[int, float]): result
+
+        Returns:
+            str: formatted result
+        """
+        if float(number).is_integer():
+            return str(int(number))
+        return f"{number:.12g}"
+
+    def stats(self) -> dict:
+        """Get the router counters
+
+        Returns:
+            dict: number of messages answered locally, and sent to the LLM
+        """
+        with self._lock:
+            return {"short_circuited": self.short_circuited,
+                    "fell_through": self.fell_through}
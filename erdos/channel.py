@@ -1,50 +1,88 @@
-import threading
-import asyncio
+import concurrent.futures
+from typing import TYPE_CHECKING, Callable
 from .conversation import Conversation
+from .db import DB
+from .event_loop_pool import EventLoopPool
+from .flusher import Flusher
+from .worker_pool import WorkerPool
+
+if TYPE_CHECKING:
+    from .agent import Agent
 
 
 class Channel:
 
     def __init__(self, name: str, llm_api_key: str,
-                 max_conversations: int = 500):
+                 max_conversations: int = 500,
+                 db_path: str = DB.DEFAULT_PATH,
+                 auto_persist: bool = False,
+                 flush_interval: float = Flusher.FLUSH_INTERVAL,
+                 flush_batch_size: int = Flusher.FLUSH_BATCH_SIZE,
+                 weight: float = 1.0,
+                 event_loop_pool: EventLoopPool = None,
+                 processes: int = None,
+                 coalesce: int = 1,
+                 linger: float = 0.0,
+                 model: str = None,
+                 pin_key: bool = False,
+                 agent_factory: Callable[[str], 'Agent'] = None):
         """
         Args:
             name (str):
             is_closed (bool, optional): Defaults to False.
             max_conversations (int, optional): maximum allowed concurrent conversations. Defaults to 500.
+            db_path (str, optional): path of the database conversations are stored in. Defaults to
+            DB.DEFAULT_PATH.
+            auto_persist (bool, optional): whether to store conversations in the background after
+            each turn. Defaults to False.
+            flush_interval (float, optional): maximum number of seconds a turn waits to be
+            stored, with auto_persist. Defaults to Flusher.FLUSH_INTERVAL.
+            flush_batch_size (int, optional): number of conversations with unstored turns
+            triggering a store, with auto_persist. Defaults to Flusher.FLUSH_BATCH_SIZE.
+            weight (float, optional): priority of the channel, as its share of LLM calls when
+            channels compete for them, with the agent's scheduler. Defaults to 1.0.
+            event_loop_pool (EventLoopPool, optional): event loops the channel and its
+            conversations run on. Defaults to EventLoopPool.default(), shared by all channels.
+            processes (int, optional): number of worker processes to fan conversations out to,
+            each owning its own Agent and the histories of the conversations pinned to it.
+            Defaults to None, for processing conversations in this process.
+            coalesce (int, optional): maximum number of pending messages of a conversation sent
+            as a single turn. Defaults to 1, for a turn per message.
+            linger (float, optional): seconds a conversation waits for more messages once one
+            is pending, with coalesce. Defaults to 0.0.
+            model (str, optional): name of the model answering the channel's conversations.
+            Defaults to None, for the agent's default model.
+            pin_key (bool, optional): whether to send the LLM calls of the channel's
+            conversations with its own llm_api_key only, rather than with any key of the
+            agent's ClientPool. Defaults to False.
+            agent_factory (Callable[[str], Agent], optional): picklable function creating the
+            agent of each worker from llm_api_key, with processes. Defaults to None, for Agent.
+
+        Raises:
+            ValueError: weight isn't positive
         """
+        if not weight > 0:
+            raise ValueError(f"Channel weight must be positive: {weight}")
         self._name = name
         self.max_conversations = max_conversations
-        self.event_loop = self.__init_event_loop__()
-        self.event_loop_thread = None
+        self.event_loop_pool = event_loop_pool or EventLoopPool.default()
+        self.event_loop = self.event_loop_pool.get_loop(name)
         self.conversations = {}
         self.llm_api_key = llm_api_key
-
-    @staticmethod
-    def start_event_loop(loop):
-        """Start the event loop
-
-        Args:
-            loop (asyncio.AbstractEventLoop): event loop to handle LLM calls
-        """
-        asyncio.set_event_loop(loop)
-        loop.run_forever()
-
-    def __init_event_loop__(self):
-        """Initialize event loop for the channel to run in a separate thread
-
-        Returns:
-            Conversation: conversation object
-        """
-        loop = asyncio.new_event_loop()
-        # Start the event loop in a separate thread, make thread daemonic to allow
-        # for clean exit
-        thread = threading.Thread(
-            target=self.start_event_loop, args=(
-                loop,), daemon=True)
-        thread.start()
-
-        return loop
+        self.weight = weight
+        self.coalesce = coalesce
+        self.linger = linger
+        self.model = model
+        self.client = None
+        if pin_key:
+            # Imported here, the pool depends on the LLM stack
+            from .client_pool import ClientPool
+            self.client = ClientPool.name_of(llm_api_key)
+        self.db = DB(db_path)
+        self.flusher = Flusher(
+            self.db, flush_interval, flush_batch_size) if auto_persist else None
+        self.worker_pool = WorkerPool(
+            processes, llm_api_key, agent_factory) if processes else None
 
     def add_conversation(self, conversation_id: int = None) -> Conversation:
         """Add a new conversation to the channel
@@ -71,8 +109,16 @@ class Channel:
         # Use the provided conversation_id or the next available id if not
         # provided
         conversation_id = conversation_id or new_conversation_id
+        # Spread conversations over the pool's event loops
+        event_loop = self.event_loop_pool.get_loop(
+            (self._name, conversation_id))
         self.conversations[conversation_id] = Conversation(
-            conversation_id, self.event_loop, self.llm_api_key)
+            conversation_id, event_loop, self.llm_api_key,
+            db=self.db, flusher=self.flusher,
+            channel=self._name, weight=self.weight,
+            agent=self.worker_pool.agent if self.worker_pool else None,
+            coalesce=self.coalesce, linger=self.linger, model=self.model,
+            client=self.client)
         return self.conversations[conversation_id]
 
     def get_conversation(self, conversation_id) -> Conversation:
@@ -93,3 +139,85 @@ class Channel:
             list[Conversation]: all conversations within channel
         """
         return self.conversations
+
+    def gather(self, conversation_ids: list[int] = None,
+               timeout: float = None) -> dict[int, str]:
+        """Wait for the messages added so far to the given conversations to be answered. Since
+        messages within a conversation are processed sequentially, waiting on a conversation's
+        last reply covers all its earlier messages
+
+        Args:
+            conversation_ids (list[int], optional): conversations to wait on. Defaults to all
+            conversations of the channel.
+            timeout (float, optional): maximum number of seconds to wait. Defaults to None.
+        Returns:
+            dict[int, str]: last assistant reply for each conversation that has messages
+        """
+        if conversation_ids is None:
+            conversation_ids = list(self.conversations)
+
+        replies = {
+            conversation_id: self.conversations[conversation_id].last_reply
+            for conversation_id in conversation_ids
+            if self.conversations[conversation_id].last_reply is not None
+        }
+        _, pending = concurrent.futures.wait(replies.values(), timeout)
+        if pending:
+            raise TimeoutError(
+                f"{len(pending)} conversations did not reply within {timeout} seconds")
+        return {conversation_id: reply.result()
+                for conversation_id, reply in replies.items()}
+
+    def store_all(self):
+        """Store messages of all conversations of the channel, in a single transaction"""
+        Conversation.store_many(self.db, list(self.conversations.values()))
+
+    def retrieve_many(self, conversation_ids: list[int] = None,
+                      last: int = None) -> list[Conversation]:
+        """Retrieve stored conversations into the channel, adding the conversations it doesn't
+        have yet. Messages of all conversations are retrieved at once
+
+        Args:
+            conversation_ids (list[int], optional): ids of the conversations. Defaults to all
+            stored conversations.
+            last (int, optional): only retrieve the last messages of each conversation. Defaults
+            to None.
+        Returns:
+            list[Conversation]: conversation objects
+        """
+        if conversation_ids is None:
+            conversation_ids = self.db.conversation_ids()
+        stored = self.db.retrieve_many(conversation_ids, last=last)
+
+        conversations = []
+        for conversation_id in conversation_ids:
+            conversation = self.conversations.get(
+                conversation_id) or self.add_conversation(conversation_id)
+            rows = stored.get(conversation_id, [])
+            with conversation._store_lock:
+                # Retrieved messages always include the last stored one
+                conversation._load(rows, rows[-1][0] + 1 if rows else 0)
+            conversations.append(conversation)
+        return conversations
+
+    def flush(self):
+        """Store the turns not yet stored by auto_persist, e.g. on shutdown"""
+        if self.flusher:
+            self.flusher.flush()
+
+    def close(self, timeout: float = None):
+        """Close the channel: stop its conversations, failing their pending messages, and store
+        the turns not yet stored by auto_persist. Must not be called from an event loop of the
+        channel
+
+        Args:
+            timeout (float, optional): maximum number of seconds to wait for each conversation
+            to stop. Defaults to None.
+        """
+        for conversation in self.conversations.values():
+            conversation.close().result(timeout)
+        if self.flusher:
+            self.flusher.close()
+        if self.worker_pool:
+            self.worker_pool.close()
+        self.conversations = {}
@@ -0,0 +1,359 @@
+import contextlib
+import hashlib
+import threading
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.runnables import Runnable, RunnableConfig
+from .backend import LLMBackend, OpenAIBackend
+from .limiter import RateLimiter
+from .metrics import MetricsRegistry
+from .resilience import CircuitBreaker, CircuitOpenError, LLMError, RetryPolicy
+from typing import Any, AsyncIterator, Iterable
+
+
+class PooledClient:
+
+    def __init__(self, name: str, backend: LLMBackend, limiter: RateLimiter,
+                 breaker: CircuitBreaker):
+        """LLM client of a ClientPool, with the quota and health of its key
+
+        Args:
+            name (str): name of the client
+            backend (LLMBackend): backend of the key
+            limiter (RateLimiter): limits of the key
+            breaker (CircuitBreaker): health of the key
+        """
+        self.name = name
+        self.backend = backend
+        self.limiter = limiter
+        self.breaker = breaker
+        # Chat models of the client, by model name
+        self._models = {}
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+
+    def chat_model(self, model: str) -> BaseChatModel:
+        """Get the chat model of a model, creating it on first use
+
+        Args:
+            model (str): name of the model
+
+        Returns:
+            BaseChatModel: chat model
+        """
+        with self._lock:
+            if model not in self._models:
+                self._models[model] = self.backend.chat_model(model)
+            return self._models[model]
+
+    def count(self, in_flight: int = 0, calls: int = 0, errors: int = 0):
+        """Update the counters of the client, which calls of every event loop share"""
+        with self._lock:
+            self.in_flight += in_flight
+            self.calls += calls
+            self.errors += errors
+
+    def stats(self) -> dict:
+        """Get the client metrics
+
+        Returns:
+            dict: calls in flight, calls and errors so far, share of the limits left, and state
+            of the circuit
+        """
+        return {"in_flight": self.in_flight, "calls": self.calls, "errors": self.errors,
+                "headroom": self.limiter.headroom(), "state": self.breaker.state}
+
+
+class ClientPool(LLMBackend):
+
+    def __init__(self, llm_api_keys: Iterable[str] = (), requests_per_minute: int = None,
+                 tokens_per_minute: int = None, max_concurrent: int = None,
+                 failure_threshold: int = 3, reset_timeout: float = 30.0):
+        """Pool of LLM clients, one per API key or organization, multiplying the throughput of
+        a single key. Each call goes to the healthy client with the most quota left, and fails
+        over to the next one on transient errors. Conversations can be pinned to a client
+
+        Args:
+            llm_api_keys (Iterable[str], optional): OpenAI API keys, None for the key of the
+            environment. Defaults to ().
+            requests_per_minute (int, optional): requests per minute of each key. Defaults to
+            None, for no limit.
+            tokens_per_minute (int, optional): tokens per minute of each key. Defaults to None,
+            for no limit.
+            max_concurrent (int, optional): calls in flight per key. Defaults to None, for no
+            limit.
+            failure_threshold (int, optional): consecutive transient errors taking a client out
+            of the pool. Defaults to 3.
+            reset_timeout (float, optional): seconds before an unhealthy client is probed again.
+            Defaults to 30.0.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrent = max_concurrent
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.metrics = MetricsRegistry.default()
+        # Clients by name, in the order they were added
+        self._clients = {}
+        self._lock = threading.Lock()
+        for llm_api_key in llm_api_keys:
+            self.add(llm_api_key)
+
+    @staticmethod
+    def name_of(llm_api_key: str) -> str:
+        """Get the name of the client of a key, which doesn't reveal the key
+
+        Args:
+            llm_api_key (str): API key, None for the key of the environment
+
+        Returns:
+            str: name of the client
+        """
+        if llm_api_key is None:
+            return "default"
+        return f"key-{hashlib.sha256(llm_api_key.encode()).hexdigest()[:8]}"
+
+    def add(self, llm_api_key: str, organization: str = None, name: str = None,
+            backend: LLMBackend = None, requests_per_minute: int = None,
+            tokens_per_minute: int = None, max_concurrent: int = None) -> str:
+        """Add a client to the pool, unless it already has one of that name
+
+        Args:
+            llm_api_key (str): API key, None for the key of the environment
+            organization (str, optional): OpenAI organization of the key. Defaults to None.
+            name (str, optional): name of the client. Defaults to None, for
+            ClientPool.name_of(llm_api_key).
+            backend (LLMBackend, optional): backend of the client. Defaults to None, for an
+            OpenAIBackend of the key.
+            requests_per_minute (int, optional): requests per minute of the key. Defaults to
+            None, for the pool's.
+            tokens_per_minute (int, optional): tokens per minute of the key. Defaults to None,
+            for the pool's.
+            max_concurrent (int, optional): calls in flight of the key. Defaults to None, for
+            the pool's.
+
+        Returns:
+            str: name of the client
+        """
+        name = name or self.name_of(llm_api_key)
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = PooledClient(
+                    name, backend or OpenAIBackend(llm_api_key, organization),
+                    RateLimiter(max_concurrent or self.max_concurrent,
+                                requests_per_minute or self.requests_per_minute,
+                                tokens_per_minute or self.tokens_per_minute),
+                    CircuitBreaker(self.failure_threshold, self.reset_timeout))
+        return name
+
+    def remove(self, name: str):
+        """Remove a client from the pool. Its calls in flight complete
+
+        Args:
+            name (str): name of the client
+        """
+        with self._lock:
+            self._clients.pop(name, None)
+
+    def chat_model(self, model: str = None) -> BaseChatModel:
+        return PooledChatModel(self, model or LLMBackend.DEFAULT_MODEL)
+
+    def select(self, pinned: str = None,
+               tried: Iterable[str] = ()) -> PooledClient:
+        """Select the client of a call: the healthy one with the most quota left, then with
+        the fewest calls in flight and so far
+
+        Args:
+            pinned (str, optional): name of the only client allowed. Defaults to None.
+            tried (Iterable[str], optional): names of the clients the call failed on.
+            Defaults to ().
+
+        Returns:
+            PooledClient: client, None if none is left
+
+        Raises:
+            LLMError: no client of the pool has the pinned name
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+        if pinned is not None:
+            clients = [client for client in clients if client.name == pinned]
+            if not clients:
+                raise LLMError(f"No LLM client {pinned} in the pool")
+        candidates = sorted(
+            (client for client in clients if client.name not in tried),
+            key=lambda client: (-client.limiter.headroom(), client.in_flight, client.calls))
+        for client in candidates:
+            # Takes the probe slot of a client recovering
+            if client.breaker.allow():
+                return client
+        return None
+
+    def stats(self) -> dict:
+        """Get the pool metrics
+
+        Returns:
+            dict: metrics of each client, by name
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+        return {client.name: client.stats() for client in clients}
+
+
+class PooledChatModel(Runnable):
+
+    def __init__(self, pool: ClientPool, model: str):
+        """Chat model of ClientPool, calling the model on a client of the pool. The client is
+        pinned by the "client" key of the call's configurable config
+
+        Args:
+            pool (ClientPool): client pool
+            model (str): name of the model
+        """
+        self.pool = pool
+        self.model = model
+
+    def invoke(self, input: Any, config: RunnableConfig = None,
+               **kwargs: Any) -> Any:
+        # The limiters of the clients are asynchronous, synchronous calls are
+        # sent to a client without them
+        client = self._select(config, ())
+        return client.chat_model(self.model).invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Any,
+                      config: RunnableConfig = None, **kwargs: Any) -> Any:
+        tokens = RateLimiter.estimate_tokens(self._prompt(input))
+        tried, error = [], None
+        while (client := self._select(config, tried, error)) is not None:
+            tried.append(client.name)
+            try:
+                async with self._call(client, tokens):
+                    response = await client.chat_model(self.model).ainvoke(
+                        input, config, **kwargs)
+            except Exception as e:
+                error = self._failed(client, e)
+                continue
+            self._succeeded(client, tokens, response)
+            return response
+        raise error
+
+    async def astream(self, input: Any, config: RunnableConfig = None,
+                      **kwargs: Any) -> AsyncIterator[Any]:
+        tokens = RateLimiter.estimate_tokens(self._prompt(input))
+        tried, error = [], None
+        while (client := self._select(config, tried, error)) is not None:
+            tried.append(client.name)
+            async with self._call(client, tokens):
+                stream = client.chat_model(
+                    self.model).astream(
+                    input, config, **kwargs)
+                try:
+                    # Fails over until the first chunk only, later chunks
+                    # would repeat the ones passed on
+                    chunk = await stream.__anext__()
+                except StopAsyncIteration:
+                    self._succeeded(client, tokens, None)
+                    return
+                except Exception as e:
+                    error = self._failed(client, e)
+                    continue
+                self._succeeded(client, tokens, None)
+                usage = None
+                try:
+                    while True:
+                        usage = getattr(chunk, "usage_metadata", None) or usage
+                        yield chunk
+                        chunk = await stream.__anext__()
+                except StopAsyncIteration:
+                    pass
+                finally:
+                    await stream.aclose()
+                if usage:
+                    client.limiter.adjust(usage["total_tokens"] - tokens)
+                return
+        raise error
+
+    def _select(self, config: RunnableConfig, tried: list[str],
+                error: Exception = None) -> PooledClient:
+        """Select the client of the next try of a call
+
+        Args:
+            config (RunnableConfig): config of the call
+            tried (list[str]): names of the clients already tried
+            error (Exception, optional): error of the last try, None for the first.
+            Defaults to None.
+
+        Returns:
+            PooledClient: client, None to raise error
+
+        Raises:
+            CircuitOpenError: no client is healthy
+        """
+        if error is not None and not RetryPolicy.is_retryable(error):
+            return None
+        pinned = (config or {}).get("configurable", {}).get("client")
+        client = self.pool.select(pinned, tried)
+        if client is None and error is None:
+            raise CircuitOpenError(
+                f"No healthy LLM client left for {self.model}", self.model)
+        if client is not None and tried:
+            self.pool.metrics.inc(
+                "erdos_llm_failovers_total",
+                model=self.model)
+        return client
+
+    @staticmethod
+    @contextlib.asynccontextmanager
+    async def _call(client: PooledClient, tokens: int) -> AsyncIterator[None]:
+        """Hold a call slot of a client, within its limits"""
+        # Counted while waiting too, so that concurrent calls spread
+        client.count(in_flight=1, calls=1)
+        try:
+            async with client.limiter.slot(tokens):
+                yield
+        finally:
+            client.count(in_flight=-1)
+
+    def _failed(self, client: PooledClient, error: Exception) -> Exception:
+        """Record a failed try of a call on a client
+
+        Args:
+            client (PooledClient): client
+            error (Exception): error raised
+
+        Returns:
+            Exception: the error
+        """
+        client.count(errors=1)
+        self.pool.metrics.inc("erdos_llm_client_calls_total",
+                              client=client.name, result="error")
+        if RetryPolicy.is_retryable(error):
+            client.breaker.record_failure()
+        else:
+            # The provider answered, the key is healthy
+            client.breaker.record_success()
+        return error
+
+    def _succeeded(self, client: PooledClient, tokens: int, response: Any):
+        """Record a successful try of a call on a client, charging its limiter for the tokens
+        actually used
+
+        Args:
+            client (PooledClient): client
+            tokens (int): estimated tokens of the call
+            response (Any): response, None for a stream
+        """
+        client.breaker.record_success()
+        self.pool.metrics.inc(
+            "erdos_llm_client_calls_total",
+            client=client.name,
+            result="ok")
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            client.limiter.adjust(usage["total_tokens"] - tokens)
+
+    @staticmethod
+    def _prompt(input: Any) -> str:
+        """Get the text of a prompt, to estimate its tokens"""
+        return input.to_string() if hasattr(input, "to_string") else str(input)
@@ -1,69 +1,297 @@
 import asyncio
+import concurrent.futures
 import threading
-from langchain_community.chat_message_histories import ChatMessageHistory
-from .agent import Agent
+import time
 from .db import DB
-from queue import Queue
-from typing import Union
+from .metrics import MetricsRegistry
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Union
 
+if TYPE_CHECKING:
+    from .agent import Agent
+    from .flusher import Flusher
+    from .history import CompactHistory
 
-class Conversation:
 
-    LOCK_ACQUIRE_DELAY = 0.1
-    MAX_NUM_RETRIES = 12
+class Conversation:
 
     def __init__(self, conversation_id: int,
                  event_loop: asyncio.AbstractEventLoop,
-                 llm_api_key: str):
+                 llm_api_key: str, db: DB = None, flusher: 'Flusher' = None,
+                 channel: str = None, weight: float = 1.0, agent: 'Agent' = None,
+                 coalesce: int = 1, linger: float = 0.0, model: str = None,
+                 client: str = None):
         """
         Args:
             conversation_id (int): id of the conversation
+            db (DB, optional): database the conversation is stored in. Defaults to DB().
+            flusher (Flusher, optional): flusher to persist the conversation after each turn.
+            Defaults to None, for storing it on store() calls only.
+            channel (str, optional): name of the channel the conversation belongs to. Defaults
+            to None.
+            weight (float, optional): weight of the channel, when scheduling LLM calls of
+            competing channels. Defaults to 1.0.
+            agent (Agent, optional): agent holding the session history. Defaults to the Agent
+            singleton.
+            coalesce (int, optional): maximum number of pending messages sent as a single turn,
+            each resolving to the turn's reply. Defaults to 1, for a turn per message.
+            linger (float, optional): seconds to wait for more messages once one is pending,
+            with coalesce. Defaults to 0.0, for sending the messages already pending.
+            model (str, optional): name of the model answering. Defaults to None, for the
+            agent's default model.
+            client (str, optional): name of the client of the agent's ClientPool the LLM calls
+            are pinned to. Defaults to None, for any client.
         """
         self._conversation_id = conversation_id
-        self.agent = Agent(llm_api_key).instance
+        if agent is None:
+            # The LLM stack is imported on first use, keeping erdos fast to
+            # import
+            from .agent import Agent
+            agent = Agent(llm_api_key).instance
+        self.agent = agent
+        self.db = db or DB()
+        self.flusher = flusher
+        self.channel = channel
+        self.weight = weight
+        self.coalesce = coalesce
+        self.linger = linger
+        self.model = model
+        self.client = client
+        self.metrics = MetricsRegistry.default()
+        # Number of session history messages already stored, and sequence
+        # number to store the next one under. The sequence number is unknown
+        # until the conversation is first stored or retrieved
+        self._num_stored = 0
+        self._next_seq = None
+        self._store_lock = threading.Lock()
         self.event_loop = event_loop
-        self.conversation_queue = Queue()
-        self.conversation_queue_lock = threading.Lock()
+        # Both are created lazily on the event loop thread, by
+        # _enqueue_message, since asyncio primitives belong to their loop
+        self.conversation_queue = None
+        self._consumer = None
+        self.last_reply = None
+
+    def add_message(self, message: str,
+                    on_chunk: Callable[[str], None] = None) -> concurrent.futures.Future:
+        """Add message to the conversation. This hands the message over to the event loop, where the
+        conversation's consumer task picks it up from the message queue
+
+        Args:
+            message (str): user message
+            on_chunk (Callable[[str], None], optional): callback streaming the assistant reply,
+            called on the conversation's event loop with each chunk. Defaults to None.
+        Returns:
+            concurrent.futures.Future: resolves to the assistant reply
+        """
+        reply = concurrent.futures.Future()
+        self.last_reply = reply
+        self.event_loop.call_soon_threadsafe(
+            self._enqueue_message, message, reply, on_chunk)
+        return reply
+
+    async def asend(self, message: str) -> str:
+        """Add message to the conversation and wait for the assistant reply. Can be awaited from
+        any event loop, including one other than the conversation's
 
-    def add_message(self, message: str):
-        """Add message to the conversation. This schedules message sending on the event loop, through the message queue
+        Args:
+            message (str): user message
+        Returns:
+            str: assistant reply
+        """
+        return await asyncio.wrap_future(self.add_message(message))
+
+    async def astream(self, message: str) -> AsyncIterator[str]:
+        """Add message to the conversation and iterate over the chunks of the assistant reply as
+        they are produced. Can be iterated from any event loop, including one other than the
+        conversation's
 
         Args:
             message (str): user message
+        Returns:
+            AsyncIterator[str]: chunks of the assistant reply
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        reply = self.add_message(
+            message, lambda chunk: loop.call_soon_threadsafe(chunks.put_nowait, chunk))
+        # Chunks are put before the reply resolves, so they all precede the
+        # end marker
+        reply.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(chunks.put_nowait, None))
+        while (chunk := await chunks.get()) is not None:
+            yield chunk
+        # Raise the error of a failed reply
+        reply.result()
+
+    def _enqueue_message(self, message: str,
+                         reply: concurrent.futures.Future,
+                         on_chunk: Callable[[str], None] = None):
+        """Put message in the message queue, starting the consumer task if it isn't running.
+        Must be called from the event loop thread
+
+        Args:
+            message (str): user message
+            reply (concurrent.futures.Future): future to resolve with the assistant reply
+            on_chunk (Callable[[str], None], optional): callback streaming the assistant reply.
+            Defaults to None.
+        """
+        if self.conversation_queue is None:
+            self.conversation_queue = asyncio.Queue()
+        if self._consumer is None or self._consumer.done():
+            self._consumer = self.event_loop.create_task(
+                self._consume_message())
+        self.conversation_queue.put_nowait(
+            (message, reply, on_chunk, time.monotonic()))
+        self.metrics.add("erdos_queue_depth", 1, channel=self.channel)
+
+    async def _consume_message(self):
+        """Consume messages from the message queue, and send them to the agent. A single consumer
+        runs per conversation, which ensures messages are processed serially
+        """
+        while True:
+            batch = await self._next_batch()
+            try:
+                # Skip messages whose caller cancelled the reply
+                pending = [(message, reply, on_chunk) for message, reply, on_chunk in batch
+                           if reply.set_running_or_notify_cancel()]
+                if not pending:
+                    continue
+                try:
+                    with self.metrics.span("erdos_turn_seconds", channel=self.channel):
+                        response = await self._send(pending)
+                except asyncio.CancelledError:
+                    # Conversation closed while the messages were processed
+                    for _, reply, _ in pending:
+                        reply.set_exception(
+                            concurrent.futures.CancelledError())
+                    raise
+                except Exception as e:
+                    # Keep consuming, a failing message shouldn't stall the
+                    # ones queued behind it
+                    self.metrics.inc(
+                        "erdos_turn_errors_total",
+                        channel=self.channel)
+                    for _, reply, _ in pending:
+                        reply.set_exception(e)
+                else:
+                    if self.flusher:
+                        self.flusher.mark_dirty(self)
+                    for _, reply, _ in pending:
+                        reply.set_result(response)
+            finally:
+                for _ in batch:
+                    self.conversation_queue.task_done()
+
+    async def _send(self, pending: list[tuple]) -> str:
+        """Send pending messages to the agent, as a single turn
+
+        Args:
+            pending (list[tuple]): messages, with their reply future and chunk callback
+
+        Returns:
+            str: assistant reply
+        """
+        if len(pending) == 1:
+            message, _, on_chunk = pending[0]
+            return await self.agent.send_message(
+                self._conversation_id, message,
+                channel=self.channel, weight=self.weight,
+                on_chunk=on_chunk, model=self.model, client=self.client)
+        return await self.agent.send_messages(
+            self._conversation_id, [message for message, _, _ in pending],
+            channel=self.channel, weight=self.weight,
+            on_chunk=self._fan_out([on_chunk for _, _, on_chunk in pending]),
+            model=self.model, client=self.client)
+
+    async def _next_batch(self) -> list[tuple]:
+        """Wait for a message, then take the pending messages to send with it as a single turn,
+        up to coalesce messages and waiting up to linger seconds for them
+
+        Returns:
+            list[tuple]: messages, with their reply future and chunk callback
+        """
+        queue = self.conversation_queue
+        batch = [self._dequeued(await queue.get())]
+        deadline = self.event_loop.time() + self.linger
+        try:
+            while len(batch) < self.coalesce:
+                if not queue.empty():
+                    batch.append(self._dequeued(queue.get_nowait()))
+                    continue
+                timeout = deadline - self.event_loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._dequeued(
+                        await asyncio.wait_for(queue.get(), timeout)))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Conversation closed while lingering
+            for _, reply, _ in batch:
+                reply.cancel()
+                queue.task_done()
+            raise
+        return batch
+
+    def _dequeued(self, item: tuple) -> tuple:
+        """Record the queue metrics of a message taken from the message queue
+
+        Args:
+            item (tuple): message, reply future, chunk callback and enqueue time
+
+        Returns:
+            tuple: message, reply future and chunk callback
+        """
+        *item, enqueued_at = item
+        self.metrics.add("erdos_queue_depth", -1, channel=self.channel)
+        self.metrics.observe("erdos_queue_wait_seconds",
+                             time.monotonic() - enqueued_at, channel=self.channel)
+        return tuple(item)
+
+    @staticmethod
+    def _fan_out(callbacks: list[Callable[[str], None]]
+                 ) -> Callable[[str], None]:
+        """Get a callback streaming the reply of a single turn to the callbacks of its messages
+
+        Args:
+            callbacks (list[Callable[[str], None]]): chunk callbacks, None for no callback
+
+        Returns:
+            Callable[[str], None]: callback, None if no message has one
         """
-        self.conversation_queue.put(message)
-        asyncio.run_coroutine_threadsafe(
-            self._consume_message(), self.event_loop
-        )
-
-    async def _consume_message(self, num_retries: int = MAX_NUM_RETRIES):
-        """Consume message from the message queue, and send it to the agent
-        """
-
-        if num_retries <= 0:
-            raise RecursionError(
-                f"Message could not be processed for conversation {self._conversation_id}.")
-
-        if not self.conversation_queue_lock.acquire(blocking=False):
-            # Wait for the lock to be released and retry
-            # Have an exponential backoff to avoid blocking the event loop
-            # Could potentially include queue size in the backoff calculation
-            backoff = 2 ** (Conversation.MAX_NUM_RETRIES -
-                            num_retries) * Conversation.LOCK_ACQUIRE_DELAY
-            await asyncio.sleep(backoff)
-            return await self._consume_message(num_retries - 1)
-
-        if self.conversation_queue.empty():
-            self.conversation_queue_lock.release()
-            return
-        # Get message from the queue
-        message = self.conversation_queue.get()
-        # Ensure messages are processed serially
-        await self.agent.send_message(self._conversation_id, message)
-        self.conversation_queue_lock.release()
+        callbacks = [callback for callback in callbacks if callback]
+        if not callbacks:
+            return None
+
+        def on_chunk(chunk: str):
+            for callback in callbacks:
+                callback(chunk)
+        return on_chunk
+
+    def close(self) -> concurrent.futures.Future:
+        """Stop the consumer task, cancelling the replies of pending messages
+
+        Returns:
+            concurrent.futures.Future: resolves once the consumer is stopped
+        """
+        return asyncio.run_coroutine_threadsafe(self._close(), self.event_loop)
+
+    async def _close(self):
+        """Stop the consumer task, cancelling the replies of pending messages"""
+        if self._consumer is not None:
+            self._consumer.cancel()
+            try:
+                await self._consumer
+            except asyncio.CancelledError:
+                pass
+            self._consumer = None
+        while self.conversation_queue is not None and not self.conversation_queue.empty():
+            _, reply, _ = self._dequeued(self.conversation_queue.get_nowait())
+            reply.cancel()
+            self.conversation_queue.task_done()
 
     def get_messages(
-            self, stringified: bool = False) -> Union[ChatMessageHistory, str]:
+            self, stringified: bool = False) -> Union['CompactHistory', str]:
         """Get messages tied to conversation
 
         Args:
@@ -74,13 +302,106 @@ class Conversation:
         return self.agent.get_messages(self._conversation_id, stringified)
 
     def store(self):
-        """Store conversation messages in the database"""
+        """Store conversation messages in the database. Only messages added since the conversation
+        was last stored or retrieved are written, the first store replaces whatever was stored
+        under the conversation id
+        """
+        Conversation.store_many(self.db, [self])
+
+    async def astore(self):
+        """Store conversation messages in the database, as store does, without blocking the event
+        loop. Conversations stored concurrently are written in a single transaction
+        """
+        await self.db.aio.run_batched(Conversation.store_many, self, self.db)
 
-        messages = self.get_messages()
-        DB.store(self._conversation_id, messages.model_dump_json())
+    @staticmethod
+    def store_many(db: DB, conversations: list['Conversation']):
+        """Store messages of many conversations in a single transaction, as store does
 
-    def retrieve(self):
-        """Retrieve conversation messages from the database
+        Args:
+            db (DB): database the conversations are stored in
+            conversations (list[Conversation]): conversation objects
+        """
+        # Lock each conversation once, in a consistent order, so concurrent
+        # calls can't deadlock
+        conversations = sorted(
+            dict.fromkeys(conversations),
+            key=lambda conversation: conversation._conversation_id)
+        start = time.monotonic()
+        for conversation in conversations:
+            conversation._store_lock.acquire()
+        db.metrics.observe("erdos_lock_wait_seconds", time.monotonic() - start,
+                           lock="store")
+        try:
+            unstored = [conversation._unstored_messages()
+                        for conversation in conversations]
+            db.store_many([unstored_messages[:4]
+                           for unstored_messages in unstored])
+            for conversation, unstored_messages in zip(
+                    conversations, unstored):
+                conversation._mark_stored(*unstored_messages)
+        finally:
+            for conversation in conversations:
+                conversation._store_lock.release()
+
+    def _unstored_messages(self) -> tuple[int, list[str], int, bool, int]:
+        """Get the messages to write on the next store. Must be called holding the store lock
+
+        Returns:
+            tuple[int, list[str], int, bool, int]: conversation id, serialized messages, sequence
+            number of the first message and whether to replace, as taken by DB.store, followed by
+            the number of session history messages once stored
+        """
+        from .agent import Agent
+        # Snapshot, the event loop appends to the history meanwhile
+        messages = list(self.get_messages().messages)
+        replace = self._next_seq is None
+        start, num_stored = (0, 0) if replace else (
+            self._next_seq, self._num_stored)
+        unstored = messages[num_stored:]
+        return (self._conversation_id, Agent.dump_messages(unstored),
+                start, replace, num_stored + len(unstored))
+
+    def _mark_stored(self, conversation_id: int, messages: list[str],
+                     start: int, replace: bool, num_stored: int):
+        """Record messages returned by _unstored_messages as written. Must be called holding the
+        store lock
+        """
+        self._num_stored = num_stored
+        self._next_seq = start + len(messages)
+
+    def retrieve(self, last: int = None, start: int = 0, end: int = None):
+        """Retrieve conversation messages from the database, replacing the session history
+
+        Args:
+            last (int, optional): only retrieve the last messages of the range. Defaults to None.
+            start (int, optional): sequence number of the first message of the range. Defaults
+            to 0.
+            end (int, optional): sequence number following the last message of the range.
+            Defaults to None, for no upper bound.
+        """
+        with self._store_lock:
+            rows = self.db.retrieve(
+                self._conversation_id, last=last, start=start, end=end)
+            self._load(rows, self.db.next_seq(self._conversation_id))
+
+    async def aretrieve(self, last: int = None,
+                        start: int = 0, end: int = None):
+        """Retrieve conversation messages from the database, as retrieve does, without blocking the
+        event loop
+        """
+        await self.db.aio.run(self.retrieve, last=last, start=start, end=end)
+
+    def _load(self, rows: list[tuple[int, str]], next_seq: int):
+        """Replace the session history with retrieved messages. Must be called holding the store
+        lock
+
+        Args:
+            rows (list[tuple[int, str]]): sequence numbers and serialized messages
+            next_seq (int): sequence number following the last stored message
         """
-        conversation = DB.retrieve(self._conversation_id)
-        self.agent.add_to_session_history(self._conversation_id, conversation)
+        self.agent.add_to_session_history(
+            self._conversation_id, [message for _, message in rows])
+        # Messages added from now on are stored after the last stored one
+        self._num_stored = len(rows)
+        self._next_seq = next_seq
@@ -1,62 +1,641 @@
+import asyncio
+import concurrent.futures
+import functools
+import json
 import sqlite3
+import threading
+import zlib
+from .metrics import MetricsRegistry
+from typing import Any, Callable, Hashable, Union
+
+try:
+    import zstandard
+except ImportError:
+    # zstd compression is optional, zlib is always available
+    zstandard = None
+
+
+def _timed(op: str) -> Callable:
+    """Decorator timing a database operation into the database's metrics registry
+
+    Args:
+        op (str): name of the operation
+    """
+    def decorator(method: Callable) -> Callable:
+        @functools.wraps(method)
+        def timed(self, *args, **kwargs):
+            with self.metrics.span("erdos_db_seconds", op=op):
+                return method(self, *args, **kwargs)
+        return timed
+    return decorator
 
 
 class DB:
 
-    tbl_is_initialized = False
+    DEFAULT_PATH = ".conversations.db"
 
-    i = 4
+    # Page cache size per connection, negative values are in KiB
+    CACHE_SIZE = -16 * 1024
+    # Seconds to wait on a locked database before failing
+    BUSY_TIMEOUT = 5
+    # Upper bound of message sequence numbers, SQLite's largest integer
+    MAX_SEQ = 2 ** 63 - 1
+    # Maximum number of conversation ids per IN (...) query, below SQLite's
+    # limit on the number of statement parameters
+    MAX_IDS_PER_QUERY = 500
 
-    @staticmethod
-    def _init_conversations_tbl():
-        if DB.tbl_is_initialized:
+    # Version of the storage format of messages, recorded as the database's
+    # user_version once rows of earlier versions are migrated. Each message is
+    # stored as a BLOB of the format version, the codec, and the payload
+    FORMAT_VERSION = 1
+    CODECS = {"none": 0, "zlib": 1, "zstd": 2}
+    DEFAULT_COMPRESSION = "zlib"
+    ZLIB_LEVEL = 6
+    ZSTD_LEVEL = 3
+    # Messages are compressed one by one, so that windows of a conversation are
+    # retrieved without decompressing the rest of it. Primed with the text
+    # messages repeat, short messages compress too. Changing it needs a new
+    # FORMAT_VERSION, stored messages can't be decompressed without it
+    DICTIONARY = (
+        b'"additional_kwargs": {}, "response_metadata": {}, "name": null, "id": null, '
+        b'"example": false, "tool_calls": [], "invalid_tool_calls": [], '
+        b'"usage_metadata": null}}{"type": "human", "data": {"content": "'
+        b'{"type": "ai", "data": {"content": "'
+        b'"usage_metadata":{"input_tokens":'
+        b',"output_tokens":,"total_tokens":}}}'
+        b'{"type":"system","data":{"content":"'
+        b'{"type":"ai","data":{"content":"'
+        b'{"type":"human","data":{"content":"What is ')
+
+    # Statements are kept as constants, so sqlite3's per connection statement
+    # cache reuses their prepared form across calls
+    CREATE_MESSAGES_TBL = """
+        CREATE TABLE IF NOT EXISTS messages (
+            conversation_id INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            message BLOB NOT NULL,
+            PRIMARY KEY (conversation_id, seq)
+        ) WITHOUT ROWID
+        """
+    STORE_MESSAGE = """
+        INSERT OR REPLACE INTO messages (conversation_id, seq, message)
+        VALUES (?, ?, ?)
+        """
+    DELETE_MESSAGES = """
+        DELETE FROM messages WHERE conversation_id = (?)
+        """
+    RETRIEVE_MESSAGES = """
+        SELECT seq, message FROM messages
+        WHERE conversation_id = (?) AND seq >= (?) AND seq < (?)
+        ORDER BY seq ASC
+        """
+    RETRIEVE_LAST_MESSAGES = """
+        SELECT seq, message FROM (
+            SELECT seq, message FROM messages
+            WHERE conversation_id = (?) AND seq >= (?) AND seq < (?)
+            ORDER BY seq DESC LIMIT (?)
+        ) ORDER BY seq ASC
+        """
+    RETRIEVE_MANY_MESSAGES = """
+        SELECT conversation_id, seq, message FROM messages
+        WHERE conversation_id IN ({ids})
+        ORDER BY conversation_id ASC, seq ASC
+        """
+    RETRIEVE_MANY_LAST_MESSAGES = """
+        SELECT conversation_id, seq, message FROM (
+            SELECT conversation_id, seq, message, ROW_NUMBER() OVER (
+                PARTITION BY conversation_id ORDER BY seq DESC) AS position
+            FROM messages
+            WHERE conversation_id IN ({ids})
+        ) WHERE position <= (?)
+        ORDER BY conversation_id ASC, seq ASC
+        """
+    CONVERSATION_IDS = """
+        SELECT DISTINCT conversation_id FROM messages
+        ORDER BY conversation_id ASC
+        """
+    NEXT_SEQ = """
+        SELECT COALESCE(MAX(seq) + 1, 0) FROM messages
+        WHERE conversation_id = (?)
+        """
+    CREATE_RESPONSES_TBL = """
+        CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY NOT NULL,
+            response TEXT NOT NULL,
+            created REAL NOT NULL
+        ) WITHOUT ROWID
+        """
+    STORE_RESPONSE = """
+        INSERT OR REPLACE INTO responses (key, response, created)
+        VALUES (?, ?, ?)
+        """
+    RETRIEVE_RESPONSE = """
+        SELECT response, created FROM responses
+        WHERE key = (?) AND created >= (?)
+        """
+    CREATE_EVICTED_HISTORIES_TBL = """
+        CREATE TABLE IF NOT EXISTS evicted_histories (
+            conversation_id PRIMARY KEY NOT NULL,
+            messages BLOB NOT NULL
+        )
+        """
+    STORE_EVICTED_HISTORY = """
+        INSERT OR REPLACE INTO evicted_histories (conversation_id, messages)
+        VALUES (?, ?)
+        """
+    RETRIEVE_EVICTED_HISTORY = """
+        SELECT messages FROM evicted_histories
+        WHERE conversation_id = (?)
+        """
+    DELETE_EVICTED_HISTORY = """
+        DELETE FROM evicted_histories WHERE conversation_id = (?)
+        """
+    CLEAR_EVICTED_HISTORIES = "DELETE FROM evicted_histories"
+    TEXT_CONVERSATION_IDS = """
+        SELECT DISTINCT conversation_id FROM messages
+        WHERE typeof(message) = 'text'
+        """
+    RETRIEVE_TEXT_MESSAGES = """
+        SELECT seq, message FROM messages
+        WHERE conversation_id = (?) AND typeof(message) = 'text'
+        """
+    # Whole conversations used to be stored as a single JSON document, in
+    # this table
+    LEGACY_CONVERSATIONS_TBL = "conversations"
+
+    # Instances per database path
+    instances = {}
+    instances_lock = threading.Lock()
+
+    def __new__(cls, path: str = DEFAULT_PATH, compression: str = None):
+        with cls.instances_lock:
+            if path not in cls.instances:
+                cls.instances[path] = super(DB, cls).__new__(cls)
+            return cls.instances[path]
+
+    def __init__(self, path: str = DEFAULT_PATH, compression: str = None):
+        """
+        Args:
+            path (str, optional): path of the SQLite database file. Defaults to DEFAULT_PATH.
+            compression (str, optional): codec of the messages stored, "zlib", "zstd" (needs
+            the zstandard package) or "none". Messages of every codec are read back. Defaults to
+            None, for DEFAULT_COMPRESSION.
+
+        Raises:
+            ValueError: unknown codec, zstd without the zstandard package, or a codec other than
+            the one the database of path was opened with
+        """
+        if hasattr(self, '_init') and self._init:
+            # Instances are shared per path, a codec can't be changed once set
+            if compression is not None and compression != self.compression:
+                raise ValueError(f"Database {path} is already open with {self.compression} "
+                                 f"compression, not {compression}")
             return
-        """Initialize the SQLite database and create the table if it doesn't exist."""
-        with sqlite3.connect(".conversations.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                CREATE TABLE IF NOT EXISTS conversations (
-                    conversation_id INTEGER PRIMARY KEY NOT NULL,
-                    conversation TEXT
-                )
-                """
-            )
-            conn.commit()
-            DB.tbl_is_initialized = True
+        compression = compression or DB.DEFAULT_COMPRESSION
+        if compression not in DB.CODECS:
+            raise ValueError(f"Unknown compression {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        self.path = path
+        self.compression = compression
+        # Connections are kept per thread, since sqlite3 connections can't be
+        # shared across threads
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._aio = None
+        self.metrics = MetricsRegistry.default()
+        self._init = True
+
+    @property
+    def aio(self) -> 'AsyncDB':
+        """Async facade of the database, created on first use
+
+        Returns:
+            AsyncDB: async facade
+        """
+        with self._connections_lock:
+            if self._aio is None:
+                self._aio = AsyncDB(self)
+        return self._aio
+
+    def connection(self) -> sqlite3.Connection:
+        """Get the calling thread's connection, opening it on first use
+
+        Returns:
+            sqlite3.Connection: connection to the database
+        """
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            # Only the owning thread uses the connection, but close() may be
+            # called from any thread
+            conn = sqlite3.connect(
+                self.path,
+                timeout=DB.BUSY_TIMEOUT,
+                check_same_thread=False)
+            # WAL lets readers proceed while a write is in progress, and only
+            # needs to fsync at checkpoints with synchronous=NORMAL
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA cache_size={DB.CACHE_SIZE}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._init_conversations_tbl(conn, self.compression)
+            self._local.connection = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        """Close the connections of all threads. Connections are opened again on next use"""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+            self._local = threading.local()
+
+    @staticmethod
+    def encode(message: str, compression: str = DEFAULT_COMPRESSION) -> bytes:
+        """Encode a message in the storage format. Messages compression doesn't shrink are
+        stored uncompressed
+
+        Args:
+            message (str): serialized message
+            compression (str, optional): codec. Defaults to DEFAULT_COMPRESSION.
+
+        Returns:
+            bytes: stored message
+        """
+        payload = message.encode()
+        if compression == "zlib":
+            compressor = zlib.compressobj(DB.ZLIB_LEVEL, zdict=DB.DICTIONARY)
+            compressed = compressor.compress(payload) + compressor.flush()
+        elif compression == "zstd":
+            compressed = zstandard.ZstdCompressor(
+                level=DB.ZSTD_LEVEL, dict_data=DB._zstd_dictionary(),
+                write_content_size=True, write_checksum=False,
+                write_dict_id=False).compress(payload)
+        else:
+            compressed = payload
+        if len(compressed) < len(payload):
+            return bytes(
+                (DB.FORMAT_VERSION, DB.CODECS[compression])) + compressed
+        return bytes((DB.FORMAT_VERSION, DB.CODECS["none"])) + payload
+
+    @staticmethod
+    def decode(stored: Union[bytes, str]) -> str:
+        """Decode a message stored in any version of the storage format
+
+        Args:
+            stored (Union[bytes, str]): stored message, text for messages stored before
+            FORMAT_VERSION 1
+
+        Returns:
+            str: serialized message
+
+        Raises:
+            ValueError: message of a later format version, or of an unknown codec
+        """
+        if isinstance(stored, str):
+            return stored
+        version, codec = stored[0], stored[1]
+        if version > DB.FORMAT_VERSION:
+            raise ValueError(f"Message stored in format version {version}, "
+                             f"this version of erdos reads up to {DB.FORMAT_VERSION}")
+        payload = memoryview(stored)[2:]
+        if codec == DB.CODECS["zlib"]:
+            decompressor = zlib.decompressobj(zdict=DB.DICTIONARY)
+            payload = decompressor.decompress(payload) + decompressor.flush()
+        elif codec == DB.CODECS["zstd"]:
+            if zstandard is None:
+                raise ValueError("Message compressed with zstd, which needs the zstandard "
+                                 "package")
+            payload = zstandard.ZstdDecompressor(
+                dict_data=DB._zstd_dictionary()).decompress(payload)
+        elif codec != DB.CODECS["none"]:
+            raise ValueError(f"Message stored with unknown codec {codec}")
+        return str(payload, "utf-8")
 
     @staticmethod
-    def store(conversation_id: int, conversation: str):
-        """"Store the conversation in the database."""
-
-        with sqlite3.connect(".conversations.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                INSERT OR REPLACE INTO conversations (conversation_id, conversation)
-                VALUES (?, ?)
-                """,
-                (conversation_id, conversation),
-            )
-            conn.commit()
+    @functools.lru_cache(maxsize=1)
+    def _zstd_dictionary() -> 'zstandard.ZstdCompressionDict':
+        """Get DICTIONARY as a zstd dictionary, loaded on first use"""
+        return zstandard.ZstdCompressionDict(
+            DB.DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
 
     @staticmethod
-    def retrieve(conversation_id: int) -> str:
-        """Retrieve all messages for the conversation from the database."""
-        with sqlite3.connect(".conversations.db") as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT conversation FROM conversations
-                WHERE conversation_id = (?)
-                ORDER BY conversation_id ASC
-                """,
-                (conversation_id,),
-            )
-            rows = cursor.fetchall()
-
-        # Extract messages from query results
-        return rows[0][0] if rows else None
-
-
-DB._init_conversations_tbl()
+    def _init_conversations_tbl(conn: sqlite3.Connection,
+                                compression: str = DEFAULT_COMPRESSION):
+        """Create the tables if they don't exist, and migrate conversations stored in the legacy
+        format or in earlier versions of the storage format.
+
+        Args:
+            conn (sqlite3.Connection): connection to the database
+            compression (str, optional): codec of the messages migrated. Defaults to
+            DEFAULT_COMPRESSION.
+        """
+        with conn:
+            conn.execute(DB.CREATE_MESSAGES_TBL)
+            conn.execute(DB.CREATE_RESPONSES_TBL)
+            conn.execute(DB.CREATE_EVICTED_HISTORIES_TBL)
+            if conn.execute("PRAGMA user_version").fetchone()[
+                    0] < DB.FORMAT_VERSION:
+                # Messages used to be stored as text, encoded one
+                # conversation at a time to bound memory
+                for conversation_id, in conn.execute(
+                        DB.TEXT_CONVERSATION_IDS).fetchall():
+                    conn.executemany(DB.STORE_MESSAGE, [
+                        (conversation_id, seq, DB.encode(message, compression))
+                        for seq, message in conn.execute(
+                            DB.RETRIEVE_TEXT_MESSAGES, (conversation_id,)).fetchall()])
+                conn.execute(f"PRAGMA user_version = {DB.FORMAT_VERSION}")
+            legacy_tbl = conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name = (?)",
+                (DB.LEGACY_CONVERSATIONS_TBL,)).fetchone()
+            if not legacy_tbl:
+                return
+            rows = conn.execute(
+                "SELECT conversation_id, conversation "
+                f"FROM {DB.LEGACY_CONVERSATIONS_TBL}").fetchall()
+            for conversation_id, conversation in rows:
+                messages = json.loads(conversation or '{"messages": []}')[
+                    "messages"]
+                conn.executemany(DB.STORE_MESSAGE, [
+                    (conversation_id, seq, DB.encode(json.dumps(
+                        {"type": message["type"], "data": message}), compression))
+                    for seq, message in enumerate(messages)])
+            conn.execute(f"DROP TABLE {DB.LEGACY_CONVERSATIONS_TBL}")
+
+    def store(self, conversation_id: int, messages: list[str],
+              start: int = 0, replace: bool = False):
+        """Store messages of the conversation in the database, numbered from start. Messages
+        already stored under the same numbers are overwritten.
+
+        Args:
+            conversation_id (int): id of the conversation
+            messages (list[str]): serialized messages
+            start (int, optional): sequence number of the first message. Defaults to 0.
+            replace (bool, optional): whether to delete the conversation's stored messages
+            first. Defaults to False.
+        """
+        self.store_many([(conversation_id, messages, start, replace)])
+
+    @_timed("store_many")
+    def store_many(
+            self, conversations: list[tuple[int, list[str], int, bool]]):
+        """Store messages of many conversations in a single transaction.
+
+        Args:
+            conversations (list[tuple[int, list[str], int, bool]]): conversation id, serialized
+            messages, sequence number of the first message and whether to replace, as taken by
+            store, for each conversation
+        """
+        conn = self.connection()
+        with conn:
+            conn.executemany(DB.DELETE_MESSAGES, [
+                (conversation_id,)
+                for conversation_id, _, _, replace in conversations if replace])
+            conn.executemany(DB.STORE_MESSAGE, [
+                (conversation_id, seq, DB.encode(message, self.compression))
+                for conversation_id, messages, start, _ in conversations
+                for seq, message in enumerate(messages, start)])
+
+    @_timed("retrieve")
+    def retrieve(self, conversation_id: int, last: int = None,
+                 start: int = 0, end: int = None) -> list[tuple[int, str]]:
+        """Retrieve messages of the conversation from the database, in sequence order.
+
+        Args:
+            conversation_id (int): id of the conversation
+            last (int, optional): only retrieve the last messages of the range. Defaults to None.
+            start (int, optional): sequence number of the first message of the range. Defaults
+            to 0.
+            end (int, optional): sequence number following the last message of the range.
+            Defaults to None, for no upper bound.
+        Returns:
+            list[tuple[int, str]]: sequence numbers and serialized messages
+        """
+        end = end if end is not None else DB.MAX_SEQ
+        if last is not None:
+            # Only the rows of the window are read and decompressed
+            rows = self.connection().execute(
+                DB.RETRIEVE_LAST_MESSAGES, (conversation_id, start, end, last))
+        else:
+            rows = self.connection().execute(
+                DB.RETRIEVE_MESSAGES, (conversation_id, start, end))
+        return [(seq, DB.decode(message)) for seq, message in rows]
+
+    @_timed("retrieve_many")
+    def retrieve_many(self, conversation_ids: list[int],
+                      last: int = None) -> dict[int, list[tuple[int, str]]]:
+        """Retrieve messages of many conversations from the database, in sequence order.
+
+        Args:
+            conversation_ids (list[int]): ids of the conversations
+            last (int, optional): only retrieve the last messages of each conversation. Defaults
+            to None.
+        Returns:
+            dict[int, list[tuple[int, str]]]: sequence numbers and serialized messages, for each
+            conversation with stored messages
+        """
+        conversations = {}
+        conn = self.connection()
+        for i in range(0, len(conversation_ids), DB.MAX_IDS_PER_QUERY):
+            ids = conversation_ids[i:i + DB.MAX_IDS_PER_QUERY]
+            placeholders = ", ".join("?" * len(ids))
+            if last is not None:
+                rows = conn.execute(
+                    DB.RETRIEVE_MANY_LAST_MESSAGES.format(ids=placeholders),
+                    (*ids, last))
+            else:
+                rows = conn.execute(
+                    DB.RETRIEVE_MANY_MESSAGES.format(ids=placeholders), ids)
+            for conversation_id, seq, message in rows:
+                conversations.setdefault(
+                    conversation_id, []).append((seq, DB.decode(message)))
+        return conversations
+
+    @_timed("conversation_ids")
+    def conversation_ids(self) -> list[int]:
+        """Get the ids of all conversations with stored messages.
+
+        Returns:
+            list[int]: ids of the conversations
+        """
+        return [conversation_id for conversation_id, in self.connection().execute(
+            DB.CONVERSATION_IDS)]
+
+    @_timed("store_response")
+    def store_response(self, key: str, response: str, created: float):
+        """Store an LLM response in the database.
+
+        Args:
+            key (str): key of the prompt the response is for
+            response (str): LLM response
+            created (float): timestamp of the response
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute(DB.STORE_RESPONSE, (key, response, created))
+
+    @_timed("retrieve_response")
+    def retrieve_response(self, key: str,
+                          min_created: float = 0) -> tuple[str, float]:
+        """Retrieve an LLM response from the database.
+
+        Args:
+            key (str): key of the prompt the response is for
+            min_created (float, optional): oldest timestamp of the response. Defaults to 0.
+        Returns:
+            tuple[str, float]: LLM response and its timestamp, None if there isn't one
+        """
+        return self.connection().execute(
+            DB.RETRIEVE_RESPONSE, (key, min_created)).fetchone()
+
+    @_timed("store_evicted_history")
+    def store_evicted_history(self, conversation_id: Hashable, messages: str):
+        """Store the history of a conversation evicted from memory.
+
+        Args:
+            conversation_id (Hashable): id of the conversation
+            messages (str): serialized messages
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute(DB.STORE_EVICTED_HISTORY,
+                         (conversation_id, DB.encode(messages, self.compression)))
+
+    @_timed("pop_evicted_history")
+    def pop_evicted_history(self, conversation_id: Hashable) -> str:
+        """Retrieve and delete the history of a conversation evicted from memory.
+
+        Args:
+            conversation_id (Hashable): id of the conversation
+        Returns:
+            str: serialized messages, None if the conversation wasn't evicted
+        """
+        conn = self.connection()
+        with conn:
+            row = conn.execute(
+                DB.RETRIEVE_EVICTED_HISTORY, (conversation_id,)).fetchone()
+            conn.execute(DB.DELETE_EVICTED_HISTORY, (conversation_id,))
+        return DB.decode(row[0]) if row else None
+
+    def delete_evicted_history(self, conversation_id: Hashable):
+        """Delete the history of a conversation evicted from memory.
+
+        Args:
+            conversation_id (Hashable): id of the conversation
+        """
+        conn = self.connection()
+        with conn:
+            conn.execute(DB.DELETE_EVICTED_HISTORY, (conversation_id,))
+
+    def clear_evicted_histories(self):
+        """Delete the histories of all conversations evicted from memory."""
+        conn = self.connection()
+        with conn:
+            conn.execute(DB.CLEAR_EVICTED_HISTORIES)
+
+    @_timed("next_seq")
+    def next_seq(self, conversation_id: int) -> int:
+        """Get the sequence number following the last stored message of the conversation.
+
+        Args:
+            conversation_id (int): id of the conversation
+        Returns:
+            int: next sequence number
+        """
+        return self.connection().execute(
+            DB.NEXT_SEQ, (conversation_id,)).fetchone()[0]
+
+
+class AsyncDB:
+
+    def __init__(self, db: DB):
+        """Async facade of a database. SQLite work runs on a dedicated thread, so that awaiting it
+        never blocks the event loop, and calls of many conversations share its connection.
+
+        Args:
+            db (DB): database object
+        """
+        self.db = db
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="erdos-db")
+        # Items waiting for their batch function to run, by batch function and
+        # leading arguments
+        self._batches = {}
+        self._batches_lock = threading.Lock()
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """Run a function on the database thread
+
+        Args:
+            fn (Callable): function doing SQLite work
+
+        Returns:
+            Any: result of the function
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def run_batched(self, batch_fn: Callable[..., Any],
+                          item: Any, *args) -> Any:
+        """Run a function taking a list of items on the database thread. Items submitted while a
+        batch waits for the thread are coalesced into it, e.g. to store many conversations in
+        a single transaction
+
+        Args:
+            batch_fn (Callable[..., Any]): function doing SQLite work, called with args followed
+            by the list of items
+            item (Any): item to add to the batch
+            args: leading arguments of the function, items are only coalesced for equal ones
+
+        Returns:
+            Any: result of the function for the batch the item was part of
+        """
+        key = (batch_fn, *args)
+        future = concurrent.futures.Future()
+        with self._batches_lock:
+            batch = self._batches.get(key)
+            if batch is None:
+                batch = self._batches[key] = []
+                self.executor.submit(self._run_batch, key)
+            batch.append((item, future))
+        return await asyncio.wrap_future(future)
+
+    def _run_batch(self, key: tuple):
+        """Run the batch function on the items submitted so far
+
+        Args:
+            key (tuple): batch function followed by its leading arguments
+        """
+        with self._batches_lock:
+            batch = self._batches.pop(key)
+        batch_fn, *args = key
+        try:
+            result = batch_fn(*args, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+        else:
+            for _, future in batch:
+                future.set_result(result)
+
+    async def store(self, conversation_id: int, messages: list[str],
+                    start: int = 0, replace: bool = False):
+        """Store messages of the conversation, as DB.store does. Stores submitted while the
+        database thread is busy are written in a single transaction
+        """
+        await self.run_batched(
+            self.db.store_many, (conversation_id, messages, start, replace))
+
+    async def retrieve(self, conversation_id: int, last: int = None,
+                       start: int = 0, end: int = None) -> list[tuple[int, str]]:
+        """Retrieve messages of the conversation, as DB.retrieve does"""
+        return await self.run(self.db.retrieve, conversation_id,
+                              last=last, start=start, end=end)
+
+    async def retrieve_many(self, conversation_ids: list[int],
+                            last: int = None) -> dict[int, list[tuple[int, str]]]:
+        """Retrieve messages of many conversations, as DB.retrieve_many does"""
+        return await self.run(self.db.retrieve_many, conversation_ids, last=last)
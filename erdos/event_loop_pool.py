@@ -0,0 +1,80 @@
+import asyncio
+import os
+import threading
+from typing import Hashable
+
+
+class EventLoopPool:
+
+    # Shared instance, used by channels by default
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, size: int = None):
+        """Fixed number of event loops, each running in its own thread, that channels and
+        conversations are sharded onto. Loops are started on first use
+
+        Args:
+            size (int, optional): number of event loops. Defaults to the number of cores.
+        """
+        self.size = size or os.cpu_count() or 1
+        self._loops = [None] * self.size
+        self._threads = [None] * self.size
+        self._lock = threading.Lock()
+
+    @classmethod
+    def default(cls) -> 'EventLoopPool':
+        """Get the shared pool, creating it on first use
+
+        Returns:
+            EventLoopPool: shared pool
+        """
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = cls()
+            return cls.instance
+
+    @staticmethod
+    def start_event_loop(loop: asyncio.AbstractEventLoop):
+        """Start the event loop
+
+        Args:
+            loop (asyncio.AbstractEventLoop): event loop to handle LLM calls
+        """
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def get_loop(self, key: Hashable) -> asyncio.AbstractEventLoop:
+        """Get the event loop a key is sharded onto, e.g. a channel name or a conversation id
+
+        Args:
+            key (Hashable): key to shard
+
+        Returns:
+            asyncio.AbstractEventLoop: event loop
+        """
+        index = hash(key) % self.size
+        with self._lock:
+            if self._loops[index] is None:
+                loop = asyncio.new_event_loop()
+                # Start the event loop in a separate thread, make thread
+                # daemonic to allow for clean exit
+                thread = threading.Thread(
+                    target=self.start_event_loop, args=(
+                        loop,), daemon=True)
+                thread.start()
+                self._loops[index], self._threads[index] = loop, thread
+            return self._loops[index]
+
+    def close(self):
+        """Stop the event loops and their threads. Loops are started again on next use"""
+        with self._lock:
+            loops, threads = self._loops, self._threads
+            self._loops = [None] * self.size
+            self._threads = [None] * self.size
+        for loop, thread in zip(loops, threads):
+            if loop is None:
+                continue
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
@@ -0,0 +1,109 @@
+import logging
+import threading
+from .conversation import Conversation
+from .db import DB
+
+
+logger = logging.getLogger(__name__)
+
+
+class Flusher:
+
+    FLUSH_INTERVAL = 1.0
+    FLUSH_BATCH_SIZE = 64
+    # Upper bound of the seconds between retries of a failing flush
+    MAX_RETRY_INTERVAL = 60.0
+
+    def __init__(self, db: DB, flush_interval: float = FLUSH_INTERVAL,
+                 flush_batch_size: int = FLUSH_BATCH_SIZE):
+        """Write-behind persistence of conversations. Conversations are marked dirty after each
+        turn, and a background thread stores all dirty conversations in one transaction, once
+        flush_batch_size of them are dirty or flush_interval seconds after one was marked
+
+        Args:
+            db (DB): database conversations are stored in
+            flush_interval (float, optional): maximum number of seconds a dirty conversation
+            waits to be stored. Defaults to FLUSH_INTERVAL.
+            flush_batch_size (int, optional): number of dirty conversations triggering a
+            flush. Defaults to FLUSH_BATCH_SIZE.
+        """
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flush_batch_size = flush_batch_size
+        # Dirty conversations by id, guarded by the condition
+        self._dirty = {}
+        self._condition = threading.Condition()
+        # Ensure flushes don't interleave, between the thread and flush()
+        # calls
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def mark_dirty(self, conversation: Conversation):
+        """Mark conversation as having messages to store
+
+        Args:
+            conversation (Conversation): conversation object
+        """
+        with self._condition:
+            self._dirty[conversation._conversation_id] = conversation
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            # Wake the thread, which checks whether a batch filled up
+            self._condition.notify()
+
+    def _run(self):
+        """Flush dirty conversations whenever a batch fills up or the interval elapses. Failed
+        flushes are retried after flush_interval, doubled on each consecutive failure"""
+        retry_interval = self.flush_interval
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._dirty or self._closed)
+                self._condition.wait_for(
+                    lambda: len(
+                        self._dirty) >= self.flush_batch_size or self._closed,
+                    timeout=self.flush_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Conversations could not be flushed, retrying in %.1fs",
+                                 retry_interval)
+                # Failed conversations are dirty again, wait rather than
+                # retrying at once on a full batch
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: self._closed, timeout=retry_interval)
+                retry_interval = min(
+                    2 * retry_interval,
+                    Flusher.MAX_RETRY_INTERVAL)
+            else:
+                retry_interval = self.flush_interval
+
+    def flush(self):
+        """Store all dirty conversations, in a single transaction"""
+        with self._flush_lock:
+            with self._condition:
+                dirty, self._dirty = self._dirty, {}
+            if not dirty:
+                return
+
+            try:
+                Conversation.store_many(self.db, list(dirty.values()))
+            except Exception:
+                # Keep conversations dirty, for the next flush to retry
+                with self._condition:
+                    for conversation_id, conversation in dirty.items():
+                        self._dirty.setdefault(conversation_id, conversation)
+                raise
+
+    def close(self):
+        """Flush dirty conversations and stop the background thread"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
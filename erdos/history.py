@@ -0,0 +1,592 @@
+import array
+import asyncio
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import (BaseMessage, message_to_dict, messages_from_dict,
+                                     messages_to_dict)
+from .db import DB
+from typing import Callable, Hashable, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CompactHistory(BaseChatMessageHistory):
+
+    # Message types, stored as their position
+    TYPES = ("human", "ai", "system", "chat", "tool", "function")
+    # Approximate memory footprint of the record of a message besides its line, and of a message
+    # object built from it, in bytes
+    RECORD_OVERHEAD = 16
+    MESSAGE_OVERHEAD = 512
+
+    def __init__(self, messages: Iterable[BaseMessage] = ()):
+        """Session history storing its messages as compact records: the transcript of the
+        messages, one "Type: content" line per message, the offset and type of each line, and the
+        fields of the messages left to their default dropped. Appending renders the new messages
+        only, and the transcript is joined once on the next read, so that prompts and stringified
+        histories reuse it instead of rendering every message on each turn. Message objects are
+        built when messages are read, and kept until release()
+
+        Args:
+            messages (Iterable[BaseMessage], optional): messages. Defaults to ().
+        """
+        self._lock = threading.Lock()
+        self.clear()
+        self.add_messages(messages)
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        """Messages of the history, to be changed through add_messages only"""
+        with self._lock:
+            if self._messages is None:
+                self._messages = self._build()
+            return self._messages
+
+    @messages.setter
+    def messages(self, messages: Iterable[BaseMessage]):
+        self.clear()
+        self.add_messages(messages)
+
+    @staticmethod
+    def line(message: BaseMessage) -> str:
+        """Render a message as a line of the transcript
+
+        Args:
+            message (BaseMessage): message
+
+        Returns:
+            str: "Type: content" line
+        """
+        return f"{message.type.capitalize()}: {message.content}"
+
+    @staticmethod
+    def fields(message: BaseMessage) -> dict:
+        """Get the fields of a message besides its type and content, dropping those left to
+        their empty default
+
+        Args:
+            message (BaseMessage): message
+
+        Returns:
+            dict: fields
+        """
+        return {key: value for key, value in message_to_dict(message)["data"].items()
+                if key not in ("type", "content") and value is not None
+                and value is not False and value != {} and value != []}
+
+    def add_message(self, message: BaseMessage):
+        self.add_messages([message])
+
+    def add_messages(self, messages: Iterable[BaseMessage]):
+        with self._lock:
+            for message in messages:
+                line = self.line(message)
+                # Offset of the line in the transcript, past the newline
+                # separating it from the previous one
+                start = self._length + 1 if self._offsets else 0
+                self._offsets.append(start)
+                self._length = start + len(line)
+                self._pending.append(line)
+                position = len(self._types)
+                fields = self.fields(message)
+                if message.type in self.TYPES:
+                    self._types.append(self.TYPES.index(message.type))
+                else:
+                    self._types.append(len(self.TYPES))
+                    fields["type"] = message.type
+                if not isinstance(message.content, str):
+                    # Only text content can be read back from the line
+                    fields["content"] = message.content
+                if fields:
+                    self._fields[position] = fields
+                if self._messages is not None:
+                    self._messages.append(message)
+                self.content_length += len(str(message.content))
+
+    async def aget_messages(self) -> list[BaseMessage]:
+        return self.messages
+
+    async def aadd_messages(self, messages: Iterable[BaseMessage]):
+        # In memory, no need for the executor of the default implementation
+        self.add_messages(messages)
+
+    def clear(self):
+        with self._lock:
+            # Offsets and types of the lines of the messages in the transcript,
+            # and fields of the messages besides their type and content, by
+            # position
+            self._offsets = array.array("Q")
+            self._types = bytearray()
+            self._fields = {}
+            # Lines rendered since the transcript was last joined
+            self._pending = []
+            self._text = ""
+            self._length = 0
+            # Message objects built from the records, None until read
+            self._messages = None
+            self.content_length = 0
+
+    async def aclear(self):
+        self.clear()
+
+    def release(self):
+        """Drop the message objects built when messages were read, keeping the records only"""
+        with self._lock:
+            self._messages = None
+
+    def nbytes(self) -> int:
+        """Approximate memory footprint of the history
+
+        Returns:
+            int: size in bytes
+        """
+        size = self._length + len(self._types) * self.RECORD_OVERHEAD
+        size += len(self._fields) * self.MESSAGE_OVERHEAD
+        if self._messages is not None:
+            size += self.content_length + \
+                len(self._messages) * self.MESSAGE_OVERHEAD
+        return size
+
+    def _join(self) -> str:
+        """Join the lines rendered since the transcript was last joined. Must be called holding
+        the lock
+
+        Returns:
+            str: transcript
+        """
+        if self._pending:
+            self._text = "\n".join(
+                [self._text] + self._pending if self._text else self._pending)
+            self._pending = []
+        return self._text
+
+    def _build(self) -> list[BaseMessage]:
+        """Build the message objects from the records. Must be called holding the lock
+
+        Returns:
+            list[BaseMessage]: messages
+        """
+        text = self._join()
+        dicts = []
+        for position, code in enumerate(self._types):
+            fields = self._fields.get(position, {})
+            message_type = self.TYPES[code] if code < len(
+                self.TYPES) else fields["type"]
+            data = dict(fields)
+            if "content" not in data:
+                end = (self._offsets[position + 1] - 1 if position + 1 < len(self._offsets)
+                       else len(text))
+                data["content"] = text[
+                    self._offsets[position] + len(message_type) + 2:end]
+            dicts.append({"type": message_type, "data": data})
+        return messages_from_dict(dicts)
+
+    def transcript(self, start: int = 0) -> str:
+        """Get the transcript of the messages
+
+        Args:
+            start (int, optional): position of the first message. Defaults to 0.
+
+        Returns:
+            str: transcript, one line per message
+        """
+        with self._lock:
+            text = self._join()
+            if start <= 0:
+                return text
+            if start >= len(self._offsets):
+                return ""
+            return text[self._offsets[start]:]
+
+    def render(self, messages: list[BaseMessage]) -> str:
+        """Render messages of the history, e.g. a window of it, reusing the transcript for the
+        last messages of the history they end with
+
+        Args:
+            messages (list[BaseMessage]): messages
+
+        Returns:
+            str: transcript of the messages
+        """
+        history = self.messages
+        # Number of messages ending both lists, compared by identity since
+        # windows hold the history's own messages
+        common, limit = 0, min(len(messages), len(history))
+        while common < limit and messages[-1 - common] is history[-1 - common]:
+            common += 1
+        lines = [self.line(message)
+                 for message in messages[:len(messages) - common]]
+        if common:
+            lines.append(self.transcript(len(history) - common))
+        return "\n".join(lines)
+
+
+class HistoryStore(MutableMapping):
+
+    # Approximate memory footprint of a message besides its content, in bytes
+    MESSAGE_OVERHEAD = 512
+
+    def __init__(self, capacity: int = None, max_bytes: int = None,
+                 db_path: str = None,
+                 on_discard: Callable[[Hashable], None] = None):
+        """Session histories by conversation id. Beyond capacity or max_bytes, the least recently
+        used histories are evicted to SQLite, and loaded back on their next access. Histories
+        are written and read outside the lock of the store, evictions on the database thread
+
+        Args:
+            capacity (int, optional): maximum number of histories kept in memory. Defaults to
+            None, for no limit.
+            max_bytes (int, optional): approximate maximum size of the histories kept in memory.
+            Defaults to None, for no limit.
+            db_path (str, optional): path of the database to evict histories to, private to the
+            store. Defaults to a temporary file, created on first eviction.
+            on_discard (Callable[[Hashable], None], optional): function called with the id of
+            each history deleted, replaced or evicted, e.g. to drop state kept for it besides
+            the history. Defaults to None.
+        """
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.on_discard = on_discard
+        self._db_path = db_path
+        self._db = None
+        self._temporary = False
+        # Resident histories and their approximate size, least recently used
+        # first
+        self._resident = OrderedDict()
+        self._evicted = set()
+        # Evicted histories whose write is pending on the database thread,
+        # with a token of the eviction, taken back from memory if accessed
+        # meanwhile
+        self._storing = {}
+        # Futures of the evicted histories being loaded back
+        self._loading = {}
+        self._bytes = 0
+        # Number of running turns per conversation, pinned histories aren't
+        # evicted since turns append to them
+        self._pins = {}
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.reloads = 0
+
+    @property
+    def db(self) -> DB:
+        """Database histories are evicted to, created on first use
+
+        Returns:
+            DB: database object
+        """
+        if self._db is None:
+            if self._db_path is None:
+                fd, self._db_path = tempfile.mkstemp(
+                    prefix="erdos-history-", suffix=".db")
+                os.close(fd)
+                self._temporary = True
+            self._db = DB(self._db_path)
+            # Histories evicted by a previous store aren't known to this one
+            self._db.clear_evicted_histories()
+        return self._db
+
+    @staticmethod
+    def size(history: BaseChatMessageHistory) -> int:
+        """Approximate memory footprint of a history
+
+        Args:
+            history (BaseChatMessageHistory): conversation history
+
+        Returns:
+            int: size in bytes
+        """
+        if isinstance(history, CompactHistory):
+            # Kept up to date as messages are added, rather than summed on
+            # each access
+            return history.nbytes()
+        return sum(len(str(message.content)) + HistoryStore.MESSAGE_OVERHEAD
+                   for message in history.messages)
+
+    def __getitem__(self, conversation_id: Hashable) -> BaseChatMessageHistory:
+        with self._lock:
+            history, future, load = self._lookup(conversation_id)
+        if load:
+            self._load(conversation_id, future)
+        return history if future is None else future.result()
+
+    async def aget(self, conversation_id: Hashable) -> BaseChatMessageHistory:
+        """Get a history, as store[conversation_id] does. A history that was evicted is reloaded
+        from SQLite on the database thread, rather than blocking the event loop
+
+        Args:
+            conversation_id (Hashable): conversation id
+
+        Returns:
+            BaseChatMessageHistory: conversation history
+
+        Raises:
+            KeyError: no history of the conversation
+        """
+        with self._lock:
+            history, future, load = self._lookup(conversation_id)
+        if load:
+            await self.db.aio.run(self._load, conversation_id, future)
+        return history if future is None else await asyncio.wrap_future(future)
+
+    def _lookup(self, conversation_id: Hashable) -> tuple[
+            Optional[BaseChatMessageHistory], Optional[concurrent.futures.Future], bool]:
+        """Get a history in memory, or the future of an evicted one being loaded back. Must be
+        called holding the lock
+
+        Args:
+            conversation_id (Hashable): conversation id
+
+        Returns:
+            tuple[Optional[BaseChatMessageHistory], Optional[concurrent.futures.Future], bool]:
+            history in memory, future of the history being loaded back, and whether the caller
+            must load it with _load()
+
+        Raises:
+            KeyError: no history of the conversation
+        """
+        if conversation_id in self._resident:
+            history, size = self._resident[conversation_id]
+            self._resident.move_to_end(conversation_id)
+            # Histories grow in place, update their size on access
+            new_size = self.size(history)
+            self._resident[conversation_id] = (history, new_size)
+            self._bytes += new_size - size
+        elif conversation_id in self._storing:
+            # Not written yet, the write deletes it once done
+            history, _ = self._storing.pop(conversation_id)
+            self._evicted.discard(conversation_id)
+            self._insert(conversation_id, history)
+            self.reloads += 1
+        elif conversation_id in self._loading:
+            return None, self._loading[conversation_id], False
+        elif conversation_id in self._evicted:
+            self._evicted.discard(conversation_id)
+            future = concurrent.futures.Future()
+            self._loading[conversation_id] = future
+            return None, future, True
+        else:
+            raise KeyError(conversation_id)
+        self._evict()
+        return history, None, False
+
+    def _load(self, conversation_id: Hashable,
+              future: concurrent.futures.Future):
+        """Load an evicted history back from SQLite without holding the lock, resolving future
+        with it
+
+        Args:
+            conversation_id (Hashable): conversation id
+            future (concurrent.futures.Future): future of the history
+        """
+        try:
+            messages = self.db.pop_evicted_history(conversation_id)
+            history = CompactHistory(
+                messages_from_dict(
+                    json.loads(messages)))
+        except Exception as error:
+            with self._lock:
+                if self._loading.get(conversation_id) is future:
+                    del self._loading[conversation_id]
+                    self._evicted.add(conversation_id)
+            future.set_exception(error)
+            return
+        with self._lock:
+            # Unless it was replaced or deleted meanwhile
+            if self._loading.get(conversation_id) is future:
+                del self._loading[conversation_id]
+                self._insert(conversation_id, history)
+                self.reloads += 1
+                self._evict()
+        future.set_result(history)
+
+    def __setitem__(self, conversation_id: Hashable,
+                    history: BaseChatMessageHistory):
+        with self._lock:
+            self._discard(conversation_id)
+            self._insert(conversation_id, history)
+            self._evict()
+
+    def __delitem__(self, conversation_id: Hashable):
+        with self._lock:
+            if not self._discard(conversation_id):
+                raise KeyError(conversation_id)
+
+    def __contains__(self, conversation_id: Hashable) -> bool:
+        with self._lock:
+            return (conversation_id in self._resident or conversation_id in self._evicted
+                    or conversation_id in self._loading)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        with self._lock:
+            return iter(list(self._resident) +
+                        list(self._evicted) + list(self._loading))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._resident) + len(self._evicted) + \
+                len(self._loading)
+
+    @contextlib.contextmanager
+    def pinned(self, conversation_id: Hashable):
+        """Keep the conversation's history in memory, e.g. while a turn appends to it
+
+        Args:
+            conversation_id (Hashable): conversation id
+        """
+        with self._lock:
+            self._pins[conversation_id] = self._pins.get(
+                conversation_id, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pins[conversation_id] -= 1
+                unpinned = not self._pins[conversation_id]
+                if unpinned:
+                    del self._pins[conversation_id]
+                if conversation_id in self._resident:
+                    history, size = self._resident[conversation_id]
+                    if unpinned and isinstance(history, CompactHistory):
+                        # Idle histories keep their compact records only
+                        history.release()
+                    # The turn appended to the history, measure it again
+                    # for the eviction to account for it
+                    new_size = self.size(history)
+                    self._resident[conversation_id] = (history, new_size)
+                    self._bytes += new_size - size
+                self._evict()
+
+    def _insert(self, conversation_id: Hashable,
+                history: BaseChatMessageHistory):
+        """Keep a history in memory. Must be called holding the lock"""
+        size = self.size(history)
+        self._resident[conversation_id] = (history, size)
+        self._bytes += size
+
+    def _discard(self, conversation_id: Hashable) -> bool:
+        """Forget a history, in memory or evicted. Must be called holding the lock
+
+        Returns:
+            bool: whether there was a history
+        """
+        if self.on_discard and conversation_id in self:
+            self.on_discard(conversation_id)
+        if conversation_id in self._resident:
+            _, size = self._resident.pop(conversation_id)
+            self._bytes -= size
+            return True
+        if conversation_id in self._storing:
+            # The write deletes it once done
+            del self._storing[conversation_id]
+            self._evicted.discard(conversation_id)
+            return True
+        if conversation_id in self._evicted:
+            self._evicted.discard(conversation_id)
+            self.db.aio.executor.submit(
+                self.db.delete_evicted_history, conversation_id)
+            return True
+        if conversation_id in self._loading:
+            # Popped by the load, which drops it
+            del self._loading[conversation_id]
+            return True
+        return False
+
+    def _evict(self):
+        """Evict the least recently used histories that aren't pinned, until the store is within
+        capacity and max_bytes, writing them on the database thread. Must be called holding the
+        lock
+        """
+        def over_budget():
+            return ((self.capacity is not None and len(self._resident) > self.capacity)
+                    or (self.max_bytes is not None and self._bytes > self.max_bytes))
+
+        if not over_budget():
+            return
+        # Keep the most recently used history, which is being accessed
+        for conversation_id in list(self._resident)[:-1]:
+            if not over_budget():
+                return
+            if conversation_id in self._pins:
+                continue
+            history, size = self._resident.pop(conversation_id)
+            self._bytes -= size
+            token = object()
+            self._storing[conversation_id] = (history, token)
+            self._evicted.add(conversation_id)
+            self.db.aio.executor.submit(
+                self._store, conversation_id, history, token)
+            self.evictions += 1
+            if self.on_discard:
+                self.on_discard(conversation_id)
+
+    def _store(self, conversation_id: Hashable,
+               history: BaseChatMessageHistory, token: object):
+        """Write an evicted history to SQLite, on the database thread. Histories taken back or
+        deleted meanwhile are deleted once written, those that can't be written are kept in
+        memory
+
+        Args:
+            conversation_id (Hashable): conversation id
+            history (BaseChatMessageHistory): conversation history
+            token (object): token of the eviction
+        """
+        try:
+            self.db.store_evicted_history(
+                conversation_id, json.dumps(messages_to_dict(history.messages)))
+        except Exception:
+            logger.exception(
+                "History of conversation %s could not be evicted", conversation_id)
+            return
+        with self._lock:
+            if self._storing.get(conversation_id, (None, None))[1] is token:
+                del self._storing[conversation_id]
+                return
+        self.db.delete_evicted_history(conversation_id)
+
+    def close(self):
+        """Drop the evicted histories and close the database they were evicted to, deleting it if
+        it's a temporary file
+        """
+        with self._lock:
+            if self._db is None:
+                return
+            db = self._db
+            self._evicted.clear()
+            self._storing.clear()
+            self._loading.clear()
+        # After the writes pending on the database thread, which take the lock
+        db.aio.executor.submit(db.clear_evicted_histories).result()
+        with self._lock:
+            db.close()
+            if self._temporary:
+                db.aio.executor.shutdown(wait=False)
+                with DB.instances_lock:
+                    DB.instances.pop(self._db_path, None)
+                for suffix in ("", "-wal", "-shm"):
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self._db_path + suffix)
+                self._db_path, self._temporary = None, False
+            self._db = None
+
+    def stats(self) -> dict:
+        """Get the store metrics
+
+        Returns:
+            dict: number of histories in memory and evicted, approximate size of those in memory,
+            and number of evictions and reloads so far
+        """
+        with self._lock:
+            return {"resident": len(self._resident),
+                    "evicted": len(self._evicted),
+                    "resident_bytes": self._bytes,
+                    "evictions": self.evictions,
+                    "reloads": self.reloads}
@@ -0,0 +1,242 @@
+import asyncio
+import contextlib
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator
+
+
+class RateLimiter:
+
+    # Rough number of characters per token, to estimate the tokens of a
+    # prompt before sending it
+    CHARS_PER_TOKEN = 4
+
+    def __init__(self, max_concurrent: int = None,
+                 requests_per_minute: int = None,
+                 tokens_per_minute: int = None):
+        """Limits LLM calls across all event loops, to a number of concurrent calls and to
+        requests and tokens per minute buckets. Callers beyond the limits wait in a first in,
+        first out queue
+
+        Args:
+            max_concurrent (int, optional): maximum number of calls in flight. Defaults to None,
+            for no limit.
+            requests_per_minute (int, optional): maximum number of calls per minute. Defaults to
+            None, for no limit.
+            tokens_per_minute (int, optional): maximum number of tokens per minute. Defaults to
+            None, for no limit.
+        """
+        self.max_concurrent = max_concurrent
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # Buckets start full, allowing a minute's worth of burst
+        self._requests = requests_per_minute
+        self._tokens = tokens_per_minute
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        # Waiters, as [event loop, future, tokens, enqueue time, granted]
+        self._waiters = deque()
+        self._timer = None
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @staticmethod
+    def estimate_tokens(prompt: str) -> int:
+        """Estimate the number of tokens of a prompt
+
+        Args:
+            prompt (str): rendered prompt
+
+        Returns:
+            int: estimated number of tokens
+        """
+        return len(prompt) // RateLimiter.CHARS_PER_TOKEN + 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tokens: int = 0) -> AsyncIterator[None]:
+        """Wait for the limits to allow a call, and hold a concurrent call slot for its duration
+
+        Args:
+            tokens (int, optional): estimated number of tokens of the call. Defaults to 0.
+        """
+        await self.acquire(tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, tokens: int = 0):
+        """Wait for the limits to allow a call. Must be followed by release once the call is done
+
+        Args:
+            tokens (int, optional): estimated number of tokens of the call. Defaults to 0.
+        """
+        if self.tokens_per_minute is not None:
+            # Larger calls could never be allowed
+            tokens = min(tokens, self.tokens_per_minute)
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._refill()
+            if not self._waiters and self._allows(tokens):
+                self._grant(tokens, 0.0)
+                return
+            waiter = [loop, loop.create_future(), tokens, time.monotonic(),
+                      False]
+            self._waiters.append(waiter)
+            self._dispatch()
+
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter[4]:
+                    # Granted in the meantime, give the slot back
+                    self._in_flight -= 1
+                else:
+                    self._waiters.remove(waiter)
+                self._dispatch()
+            raise
+
+    def release(self):
+        """Give back the concurrent call slot of a finished call"""
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def adjust(self, tokens: int):
+        """Charge the tokens bucket for the difference between the actual and estimated tokens
+        of a call
+
+        Args:
+            tokens (int): tokens to charge, negative to give back
+        """
+        if self.tokens_per_minute is None:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens - tokens, self.tokens_per_minute)
+            self._dispatch()
+
+    def headroom(self) -> float:
+        """Get the share of the limits left for new calls, to send calls where quota remains
+
+        Returns:
+            float: smallest share left of the concurrent calls and of the buckets, 1.0 with no
+            limits, and below 0 while calls are waiting
+        """
+        with self._lock:
+            self._refill()
+            shares = [1.0]
+            if self.max_concurrent is not None:
+                shares.append(1 - self._in_flight / self.max_concurrent)
+            if self.requests_per_minute is not None:
+                shares.append(self._requests / self.requests_per_minute)
+            if self.tokens_per_minute is not None:
+                shares.append(self._tokens / self.tokens_per_minute)
+            return min(shares) - len(self._waiters)
+
+    def _refill(self):
+        """Refill the buckets for the time elapsed since the last refill. Must be called holding
+        the lock
+        """
+        now = time.monotonic()
+        elapsed, self._refilled_at = now - self._refilled_at, now
+        if self.requests_per_minute is not None:
+            self._requests = min(
+                self._requests + elapsed * self.requests_per_minute / 60,
+                self.requests_per_minute)
+        if self.tokens_per_minute is not None:
+            self._tokens = min(
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+                self.tokens_per_minute)
+
+    def _allows(self, tokens: int) -> bool:
+        """Whether the limits allow a call now. Must be called holding the lock
+
+        Args:
+            tokens (int): estimated number of tokens of the call
+
+        Returns:
+            bool: whether the call is allowed
+        """
+        return ((self.max_concurrent is None or self._in_flight < self.max_concurrent)
+                and (self.requests_per_minute is None or self._requests >= 1)
+                and (self.tokens_per_minute is None or self._tokens >= tokens))
+
+    def _grant(self, tokens: int, wait: float):
+        """Take a call's share of the limits. Must be called holding the lock
+
+        Args:
+            tokens (int): estimated number of tokens of the call
+            wait (float): number of seconds the call waited
+        """
+        self._in_flight += 1
+        if self.requests_per_minute is not None:
+            self._requests -= 1
+        if self.tokens_per_minute is not None:
+            self._tokens -= tokens
+        self.acquired += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def _dispatch(self):
+        """Grant waiters in order, as far as the limits allow. When the buckets hold back the
+        next waiter, schedule another dispatch for when they should have refilled. Must be
+        called holding the lock
+        """
+        self._refill()
+        now = time.monotonic()
+        while self._waiters and self._allows(self._waiters[0][2]):
+            waiter = self._waiters.popleft()
+            loop, future, tokens, enqueued_at, _ = waiter
+            self._grant(tokens, now - enqueued_at)
+            waiter[4] = True
+            loop.call_soon_threadsafe(RateLimiter._wake, future)
+
+        if not self._waiters or self._timer is not None or (
+                self.max_concurrent is not None and self._in_flight >= self.max_concurrent):
+            # Releases dispatch waiters held back by concurrency
+            return
+        delay = 0.0
+        if self.requests_per_minute is not None:
+            delay = max(delay, (1 - self._requests) *
+                        60 / self.requests_per_minute)
+        if self.tokens_per_minute is not None:
+            delay = max(delay, (self._waiters[0][2] - self._tokens)
+                        * 60 / self.tokens_per_minute)
+        self._timer = threading.Timer(delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _on_timer(self):
+        """Dispatch waiters once the buckets should have refilled"""
+        with self._lock:
+            self._timer = None
+            self._dispatch()
+
+    @staticmethod
+    def _wake(future: asyncio.Future):
+        """Wake a granted waiter, on its event loop
+
+        Args:
+            future (asyncio.Future): future the waiter awaits
+        """
+        if not future.done():
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        """Get the limiter metrics
+
+        Returns:
+            dict: number of calls in flight, waiting and granted so far, and their average and
+            maximum wait in seconds
+        """
+        with self._lock:
+            return {"in_flight": self._in_flight,
+                    "queue_depth": len(self._waiters),
+                    "acquired": self.acquired,
+                    "average_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+                    "max_wait": self.max_wait}
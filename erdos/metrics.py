@@ -0,0 +1,216 @@
+import bisect
+import contextlib
+import json
+import threading
+import time
+from typing import Callable, Iterator
+
+
+class MetricsRegistry:
+
+    # Upper bounds of histogram buckets, in seconds
+    BUCKETS = (
+        0.001,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+        60)
+
+    # Registry shared by all instrumented objects
+    instance = None
+    instance_lock = threading.Lock()
+
+    def __init__(self, tracer: Callable[[dict], None] = None):
+        """In-process counters, gauges and latency histograms, keyed by name and labels
+
+        Args:
+            tracer (Callable[[dict], None], optional): callback called with each span once it
+            ends, as a dict of its name, labels, monotonic start, duration in seconds and error.
+            Defaults to None.
+        """
+        self.tracer = tracer
+        self._lock = threading.Lock()
+        # Values by name, then by sorted label items
+        self._counters = {}
+        self._gauges = {}
+        # Histograms as [bucket counts, sum, count]
+        self._histograms = {}
+
+    @classmethod
+    def default(cls) -> 'MetricsRegistry':
+        """Get the registry shared by all instrumented objects, creating it on first use
+
+        Returns:
+            MetricsRegistry: shared registry
+        """
+        with cls.instance_lock:
+            if cls.instance is None:
+                cls.instance = cls()
+            return cls.instance
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment a counter
+
+        Args:
+            name (str): name of the counter
+            value (float, optional): increment. Defaults to 1.
+        """
+        key = self._key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels):
+        """Add to a gauge, which can go up and down
+
+        Args:
+            name (str): name of the gauge
+            value (float): value to add, negative to subtract
+        """
+        key = self._key(labels)
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Record a duration in a histogram
+
+        Args:
+            name (str): name of the histogram
+            seconds (float): duration
+        """
+        key = self._key(labels)
+        bucket = bisect.bisect_left(MetricsRegistry.BUCKETS, seconds)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = [
+                    [0] * (len(MetricsRegistry.BUCKETS) + 1), 0.0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    @contextlib.contextmanager
+    def span(self, name: str, **labels) -> Iterator[None]:
+        """Time a block into a histogram, and report it to the tracer
+
+        Args:
+            name (str): name of the histogram
+        """
+        start = time.monotonic()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            duration = time.monotonic() - start
+            self.observe(name, duration, **labels)
+            tracer = self.tracer
+            if tracer:
+                tracer({"name": name, "labels": labels, "start": start,
+                        "duration": duration, "error": error})
+
+    def reset(self):
+        """Drop all recorded values"""
+        with self._lock:
+            self._counters, self._gauges, self._histograms = {}, {}, {}
+
+    def snapshot(self) -> dict:
+        """Get the recorded values
+
+        Returns:
+            dict: counters, gauges and histograms by name, each as a list of series with their
+            labels. Histograms have cumulative bucket counts, keyed by upper bound
+        """
+        with self._lock:
+            counters = {name: dict(series)
+                        for name, series in self._counters.items()}
+            gauges = {name: dict(series)
+                      for name, series in self._gauges.items()}
+            histograms = {name: {key: (list(buckets), total, count)
+                                 for key, (buckets, total, count) in series.items()}
+                          for name, series in self._histograms.items()}
+        bounds = [str(bound) for bound in MetricsRegistry.BUCKETS] + ["+Inf"]
+        return {
+            "counters": {name: [{"labels": dict(key), "value": value}
+                                for key, value in series.items()]
+                         for name, series in counters.items()},
+            "gauges": {name: [{"labels": dict(key), "value": value}
+                              for key, value in series.items()]
+                       for name, series in gauges.items()},
+            "histograms": {name: [{"labels": dict(key),
+                                   "buckets": dict(zip(bounds, self._cumulative(buckets))),
+                                   "sum": total, "count": count}
+                                  for key, (buckets, total, count) in series.items()]
+                           for name, series in histograms.items()},
+        }
+
+    def json(self) -> str:
+        """Get the recorded values as JSON
+
+        Returns:
+            str: JSON document of snapshot()
+        """
+        return json.dumps(self.snapshot())
+
+    def prometheus(self) -> str:
+        """Get the recorded values in the Prometheus text exposition format
+
+        Returns:
+            str: exposition
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for kind in ("counters", "gauges"):
+            for name, series in sorted(snapshot[kind].items()):
+                lines.append(f"# TYPE {name} {kind[:-1]}")
+                lines += [
+                    f"{name}{self._labels(s['labels'])} {s['value']}" for s in series]
+        for name, series in sorted(snapshot["histograms"].items()):
+            lines.append(f"# TYPE {name} histogram")
+            for s in series:
+                for bound, count in s["buckets"].items():
+                    labels = self._labels({**s["labels"], "le": bound})
+                    lines.append(f"{name}_bucket{labels} {count}")
+                lines.append(
+                    f"{name}_sum{self._labels(s['labels'])} {s['sum']}")
+                lines.append(
+                    f"{name}_count{self._labels(s['labels'])} {s['count']}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _key(labels: dict) -> tuple:
+        """Get the key of a series from its labels, leaving out those set to None"""
+        return tuple(sorted((name, value) for name, value in labels.items()
+                            if value is not None))
+
+    @staticmethod
+    def _cumulative(buckets: list[int]) -> list[int]:
+        """Get cumulative bucket counts, as Prometheus histograms have"""
+        total, cumulative = 0, []
+        for count in buckets:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    @staticmethod
+    def _labels(labels: dict) -> str:
+        """Format labels for the Prometheus text exposition format"""
+        if not labels:
+            return ""
+        escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                    .replace("\n", "\\n")) for name, value in labels.items()]
+        return "{" + ",".join(f'{name}="{value}"' for name,
+                              value in escaped) + "}"
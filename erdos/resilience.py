@@ -0,0 +1,422 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from langchain_core.runnables import Runnable, RunnableConfig
+from .metrics import MetricsRegistry
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+
+class LLMError(Exception):
+
+    def __init__(self, message: str, model: str = None, kind: str = "error",
+                 attempts: int = 0):
+        """Failed LLM call, raised by a turn instead of answering it
+
+        Args:
+            message (str): description of the error
+            model (str, optional): name of the model called. Defaults to None.
+            kind (str, optional): "error", "timeout" or "circuit_open". Defaults to "error".
+            attempts (int, optional): number of attempts made. Defaults to 0.
+        """
+        super().__init__(message)
+        self.model = model
+        self.kind = kind
+        self.attempts = attempts
+
+    def __reduce__(self):
+        # Keep the attributes when sent back from a worker process
+        return type(self), (str(self), self.model, self.kind, self.attempts)
+
+
+class LLMTimeoutError(LLMError):
+    """LLM call that didn't answer within its deadline"""
+
+    def __init__(self, message: str, model: str = None, kind: str = "timeout",
+                 attempts: int = 0):
+        super().__init__(message, model, kind, attempts)
+
+
+class CircuitOpenError(LLMError):
+    """LLM call failed fast, the circuit breaker being open"""
+
+    def __init__(self, message: str, model: str = None, kind: str = "circuit_open",
+                 attempts: int = 0):
+        super().__init__(message, model, kind, attempts)
+
+
+class CircuitBreaker:
+
+    STATES = ("closed", "open", "half_open")
+
+    def __init__(self, failure_threshold: int = 5,
+                 reset_timeout: float = 30.0):
+        """Fails LLM calls fast while the provider is down. The circuit opens after
+        failure_threshold consecutive failures, and lets a single probe call through once
+        reset_timeout has passed, closing again if it succeeds
+
+        Args:
+            failure_threshold (int, optional): consecutive failures opening the circuit.
+            Defaults to 5.
+            reset_timeout (float, optional): seconds before a probe call is let through.
+            Defaults to 30.0.
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        # Time the probe call started at, None if none is in flight
+        self._probing = None
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        """Check whether a call may go through, and take the probe slot if half open
+
+        Returns:
+            bool: whether the call may go through
+        """
+        with self._lock:
+            if self.state == "open":
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self.state, self._probing = "half_open", None
+            if self.state == "half_open":
+                # A probe that never reported, e.g. cancelled, is given up on
+                # after reset_timeout
+                now = time.monotonic()
+                if self._probing is not None and now - self._probing < self.reset_timeout:
+                    self.rejected += 1
+                    return False
+                self._probing = now
+            return True
+
+    def record_success(self):
+        """Record a call that went through, closing the circuit"""
+        with self._lock:
+            self.state, self._failures, self._probing = "closed", 0, None
+
+    def record_failure(self):
+        """Record a failed call, opening the circuit past the threshold or if the probe failed
+        """
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or self._failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.opened += 1
+                self.state, self._opened_at, self._probing = "open", time.monotonic(), None
+
+    def stats(self) -> dict:
+        """Get the circuit breaker metrics
+
+        Returns:
+            dict: state, consecutive failures, number of times opened and of calls rejected
+        """
+        with self._lock:
+            return {"state": self.state, "failures": self._failures,
+                    "opened": self.opened, "rejected": self.rejected}
+
+
+class RetryPolicy:
+
+    # Errors worth retrying, by class name, so that the OpenAI client isn't
+    # imported to check them
+    RETRYABLE_ERRORS = ("TimeoutError", "APITimeoutError", "APIConnectionError",
+                        "RateLimitError", "InternalServerError", "FakeBackendError")
+    RETRYABLE_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+    # Number of latencies kept per model, for the hedging threshold
+    LATENCY_SAMPLES = 200
+
+    def __init__(self, attempt_timeout: float = 60.0, deadline: float = 180.0,
+                 max_attempts: int = 3, backoff: float = 0.5, max_backoff: float = 8.0,
+                 hedge_percentile: float = None, hedge_min_samples: int = 20,
+                 seed: int = None):
+        """Retries of LLM calls with jittered exponential backoff, and hedging of slow calls.
+        A hedged call sends a second request once the first has taken longer than a percentile
+        of the recent latencies of the model, and keeps the first to answer
+
+        Args:
+            attempt_timeout (float, optional): seconds an attempt may take, until its response
+            or first streamed chunk. Defaults to 60.0.
+            deadline (float, optional): seconds all attempts of a call may take, including the
+            backoff between them. Defaults to 180.0.
+            max_attempts (int, optional): maximum number of attempts, 1 for no retries.
+            Defaults to 3.
+            backoff (float, optional): upper bound of the first backoff, in seconds, doubling
+            with each retry. Defaults to 0.5.
+            max_backoff (float, optional): upper bound of the backoffs, in seconds.
+            Defaults to 8.0.
+            hedge_percentile (float, optional): percentile of the latencies after which a hedged
+            request is sent, e.g. 95. Defaults to None, for no hedging.
+            hedge_min_samples (int, optional): latencies recorded before hedging starts.
+            Defaults to 20.
+            seed (int, optional): seed of the backoff jitter. Defaults to None.
+        """
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._random = random.Random(seed)
+        # Latencies of the successful attempts, by model
+        self._latencies = {}
+        self._lock = threading.Lock()
+
+    def backoff_delay(self, attempt: int) -> float:
+        """Get the seconds to wait before retrying, with full jitter
+
+        Args:
+            attempt (int): number of the attempt that failed, from 1
+
+        Returns:
+            float: seconds to wait
+        """
+        bound = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        with self._lock:
+            return self._random.uniform(0, bound)
+
+    @staticmethod
+    def is_retryable(error: BaseException) -> bool:
+        """Check whether an error is transient, and the call worth retrying
+
+        Args:
+            error (BaseException): error raised by the call
+
+        Returns:
+            bool: whether to retry
+        """
+        if getattr(error, "status_code",
+                   None) in RetryPolicy.RETRYABLE_STATUSES:
+            return True
+        return any(
+            cls.__name__ in RetryPolicy.RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+    def record_latency(self, model: str, seconds: float):
+        """Record the latency of a successful attempt
+
+        Args:
+            model (str): name of the model
+            seconds (float): seconds until the response or first streamed chunk
+        """
+        with self._lock:
+            latencies = self._latencies.get(model)
+            if latencies is None:
+                latencies = self._latencies[model] = deque(
+                    maxlen=RetryPolicy.LATENCY_SAMPLES)
+            latencies.append(seconds)
+
+    def hedge_delay(self, model: str) -> float:
+        """Get the seconds after which to send a hedged request
+
+        Args:
+            model (str): name of the model
+
+        Returns:
+            float: seconds, None if hedging is off or too few latencies were recorded
+        """
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            latencies = sorted(self._latencies.get(model, ()))
+        if len(latencies) < max(self.hedge_min_samples, 1):
+            return None
+        rank = int(self.hedge_percentile / 100 * len(latencies) + 0.5)
+        return latencies[min(max(rank - 1, 0), len(latencies) - 1)]
+
+
+class ResilientModel(Runnable):
+
+    def __init__(self, llm: Runnable, model: str, policy: RetryPolicy,
+                 breaker: CircuitBreaker = None, metrics: MetricsRegistry = None):
+        """Chat model step of the LLM chain, calling the model under a retry policy and a
+        circuit breaker. A streamed call is retried or hedged until its first chunk only, once
+        chunks were passed on it runs to the end within the deadline
+
+        Args:
+            llm (Runnable): chat model
+            model (str): name of the model
+            policy (RetryPolicy): retry policy
+            breaker (CircuitBreaker, optional): circuit breaker of the provider. Defaults to
+            None.
+            metrics (MetricsRegistry, optional): registry of the retries and hedges.
+            Defaults to MetricsRegistry.default().
+        """
+        self.llm = llm
+        self.model = model
+        self.policy = policy
+        self.breaker = breaker
+        self.metrics = metrics or MetricsRegistry.default()
+
+    def invoke(self, input: Any, config: RunnableConfig = None,
+               **kwargs: Any) -> Any:
+        # The agent calls models asynchronously, synchronous calls go through
+        # as they are
+        return self.llm.invoke(input, config, **kwargs)
+
+    async def ainvoke(self, input: Any,
+                      config: RunnableConfig = None, **kwargs: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.policy.deadline
+        return await self._call(
+            lambda: self.llm.ainvoke(input, config, **kwargs), deadline)
+
+    async def astream(self, input: Any, config: RunnableConfig = None,
+                      **kwargs: Any) -> AsyncIterator[Any]:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.policy.deadline
+
+        async def start() -> tuple[Any, AsyncIterator[Any]]:
+            stream = self.llm.astream(input, config, **kwargs).__aiter__()
+            try:
+                return await stream.__anext__(), stream
+            except StopAsyncIteration:
+                return None, stream
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        first, stream = await self._call(start, deadline, self._close)
+        try:
+            if first is None:
+                return
+            yield first
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        stream.__anext__(), timeout=max(deadline - loop.time(), 0))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError as e:
+                    raise LLMTimeoutError(
+                        f"{self.model} stream exceeded its {self.policy.deadline}s deadline",
+                        self.model, attempts=1) from e
+                except Exception as e:
+                    raise LLMError(f"{self.model} stream failed: {e}", self.model,
+                                   attempts=1) from e
+                yield chunk
+        finally:
+            await stream.aclose()
+
+    @staticmethod
+    async def _close(result: tuple[Any, AsyncIterator[Any]]):
+        """Close the stream of a hedged attempt that lost the race"""
+        await result[1].aclose()
+
+    async def _call(self, start: Callable[[], Awaitable[Any]], deadline: float,
+                    discard: Callable[[Any], Awaitable[None]] = None) -> Any:
+        """Run attempts of a call until one succeeds, retrying transient errors
+
+        Args:
+            start (Callable[[], Awaitable[Any]]): function starting an attempt
+            deadline (float): event loop time by which the call must succeed
+            discard (Callable[[Any], Awaitable[None]], optional): coroutine function releasing
+            the result of an attempt that lost to a hedged one. Defaults to None.
+
+        Returns:
+            Any: result of the successful attempt
+
+        Raises:
+            LLMError: call failed, LLMTimeoutError if its last attempt timed out, and
+            CircuitOpenError if the circuit breaker rejected it
+        """
+        loop = asyncio.get_running_loop()
+        policy, breaker = self.policy, self.breaker
+        attempt = 0
+        while True:
+            if breaker and not breaker.allow():
+                raise CircuitOpenError(
+                    f"{self.model} circuit is open after repeated failures", self.model,
+                    attempts=attempt)
+            attempt += 1
+            started = loop.time()
+            timeout = min(policy.attempt_timeout, deadline - started)
+            try:
+                result = await self._attempt(start, timeout, discard)
+            except Exception as e:
+                if isinstance(e, LLMError):
+                    # Already structured, e.g. by a client pool with no client
+                    # left
+                    e.attempts = attempt
+                    raise
+                retryable = isinstance(
+                    e, asyncio.TimeoutError) or policy.is_retryable(e)
+                if breaker:
+                    # Only transient errors tell the provider is down
+                    if retryable:
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                delay = policy.backoff_delay(attempt)
+                if (not retryable or attempt >= policy.max_attempts
+                        or loop.time() + delay >= deadline):
+                    if isinstance(e, asyncio.TimeoutError):
+                        raise LLMTimeoutError(
+                            f"{self.model} didn't answer within {timeout:.3g}s", self.model,
+                            attempts=attempt) from e
+                    raise LLMError(f"{self.model} call failed: {e}", self.model,
+                                   attempts=attempt) from e
+                self.metrics.inc("erdos_llm_retries_total", model=self.model)
+                await asyncio.sleep(delay)
+            else:
+                if breaker:
+                    breaker.record_success()
+                policy.record_latency(self.model, loop.time() - started)
+                return result
+
+    async def _attempt(self, start: Callable[[], Awaitable[Any]], timeout: float,
+                       discard: Callable[[Any], Awaitable[None]] = None) -> Any:
+        """Run an attempt of a call, hedging it with a second request if it's slow
+
+        Args:
+            start (Callable[[], Awaitable[Any]]): function starting a request
+            timeout (float): seconds the attempt may take
+            discard (Callable[[Any], Awaitable[None]], optional): coroutine function releasing
+            the result of the request that lost the race. Defaults to None.
+
+        Returns:
+            Any: result of the first request to succeed
+
+        Raises:
+            asyncio.TimeoutError: no request succeeded within timeout
+        """
+        loop = asyncio.get_running_loop()
+        end = loop.time() + timeout
+        tasks = [asyncio.ensure_future(start())]
+        hedge = self.policy.hedge_delay(self.model)
+        try:
+            if hedge is not None and hedge < timeout:
+                done, _ = await asyncio.wait(tasks, timeout=hedge)
+                if not done:
+                    self.metrics.inc(
+                        "erdos_llm_hedges_total", model=self.model)
+                    tasks.append(asyncio.ensure_future(start()))
+            error = None
+            while True:
+                pending = [task for task in tasks if not task.done()]
+                done = [task for task in tasks if task.done()]
+                for task in done:
+                    if task.exception() is None:
+                        tasks.remove(task)
+                        return task.result()
+                    error = task.exception()
+                if not pending:
+                    raise error
+                remaining = end - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                await asyncio.wait(pending, timeout=remaining,
+                                   return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if discard:
+                for task in tasks:
+                    if not task.cancelled() and task.exception() is None:
+                        await discard(task.result())
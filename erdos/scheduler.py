@@ -0,0 +1,136 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import threading
+from typing import AsyncIterator, Hashable
+
+
+class WeightedFairScheduler:
+
+    def __init__(self, capacity: int):
+        """Dispatches LLM calls of all channels by weighted fair queueing. Up to capacity calls
+        run at once, and when channels compete for them, each gets a share of the dispatches
+        proportional to its weight, so that no channel starves
+
+        Args:
+            capacity (int): maximum number of calls dispatched at once. Should not exceed the
+            limiter's max_concurrent, for the scheduler to decide the order calls run in.
+        """
+        self.capacity = capacity
+        # Self-clocked virtual time: finish tag of the last dispatched call
+        self._virtual_time = 0.0
+        # Finish tag of the last queued call of each channel
+        self._finish_tags = {}
+        # Waiters, as [finish tag, arrival order, event loop, future, granted,
+        # channel]
+        self._waiters = []
+        self._arrivals = itertools.count()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.dispatched = {}
+
+    @contextlib.asynccontextmanager
+    async def slot(self, channel: Hashable,
+                   weight: float = 1.0) -> AsyncIterator[None]:
+        """Wait for the channel's turn, and hold a dispatch slot for the duration of the call
+
+        Args:
+            channel (Hashable): channel the call is made for
+            weight (float, optional): weight of the channel. Defaults to 1.0.
+        """
+        await self.acquire(channel, weight)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, channel: Hashable, weight: float = 1.0):
+        """Wait for the channel's turn. Must be followed by release once the call is done
+
+        Args:
+            channel (Hashable): channel the call is made for
+            weight (float, optional): weight of the channel. Defaults to 1.0.
+
+        Raises:
+            ValueError: weight isn't positive
+        """
+        if not weight > 0:
+            raise ValueError(f"Channel weight must be positive: {weight}")
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            # A channel idle for a while restarts at the current virtual time,
+            # rather than catching up on the share it didn't use
+            start = max(self._virtual_time,
+                        self._finish_tags.get(channel, 0.0))
+            finish = self._finish_tags[channel] = start + 1 / weight
+            self.dispatched[channel] = self.dispatched.get(channel, 0)
+            if not self._waiters and self._in_flight < self.capacity:
+                self._grant(channel, finish)
+                return
+            waiter = [finish, next(self._arrivals), loop, loop.create_future(),
+                      False, channel]
+            heapq.heappush(self._waiters, waiter)
+
+        try:
+            await waiter[3]
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter[4]:
+                    # Dispatched in the meantime, give the slot back
+                    self._in_flight -= 1
+                else:
+                    self._waiters.remove(waiter)
+                    heapq.heapify(self._waiters)
+                self._dispatch()
+            raise
+
+    def release(self):
+        """Give back the dispatch slot of a finished call"""
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def _grant(self, channel: Hashable, finish: float):
+        """Take a dispatch slot. Must be called holding the lock
+
+        Args:
+            channel (Hashable): channel the call is made for
+            finish (float): finish tag of the call
+        """
+        self._in_flight += 1
+        self._virtual_time = finish
+        self.dispatched[channel] += 1
+
+    def _dispatch(self):
+        """Grant waiters with the smallest finish tags, while slots are free. Must be called
+        holding the lock
+        """
+        while self._waiters and self._in_flight < self.capacity:
+            waiter = heapq.heappop(self._waiters)
+            finish, _, loop, future, _, channel = waiter
+            self._grant(channel, finish)
+            waiter[4] = True
+            loop.call_soon_threadsafe(WeightedFairScheduler._wake, future)
+
+    @staticmethod
+    def _wake(future: asyncio.Future):
+        """Wake a granted waiter, on its event loop
+
+        Args:
+            future (asyncio.Future): future the waiter awaits
+        """
+        if not future.done():
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        """Get the scheduler metrics
+
+        Returns:
+            dict: number of calls in flight and waiting, and number of calls dispatched per
+            channel
+        """
+        with self._lock:
+            return {"in_flight": self._in_flight,
+                    "queue_depth": len(self._waiters),
+                    "dispatched": dict(self.dispatched)}
@@ -0,0 +1,162 @@
+import threading
+from langchain_core.messages import BaseMessage, SystemMessage
+from .calculator import ArithmeticRouter
+from .limiter import RateLimiter
+from typing import Awaitable, Callable, Hashable
+
+# Folds messages into a summary, given the summary so far
+Summarizer = Callable[[str, list[BaseMessage]], Awaitable[str]]
+
+
+class HistoryWindow:
+
+    STRATEGIES = ("last", "tokens", "summary")
+
+    def __init__(self, strategy: str = "last", max_messages: int = 20,
+                 max_tokens: int = 2000, summarizer: Summarizer = None):
+        """Bounds the history injected into prompts, so that their size stays flat as
+        conversations grow. The last assistant reply ending with a numeric result is always kept,
+        for follow-ups on the previous result
+
+        Args:
+            strategy (str, optional): "last" keeps the last max_messages messages, "tokens" the
+            last messages within max_tokens, and "summary" the messages not summarized yet,
+            max_messages to 2 * max_messages - 1 of them, preceded by a rolling summary of the
+            older ones. Defaults to "last".
+            max_messages (int, optional): number of messages kept by the "last" and "summary"
+            strategies. Defaults to 20.
+            max_tokens (int, optional): estimated tokens kept by the "tokens" strategy.
+            Defaults to 2000.
+            summarizer (Summarizer, optional): coroutine function folding messages into the
+            summary so far, for the "summary" strategy. Defaults to None, for the agent's LLM.
+        """
+        if strategy not in HistoryWindow.STRATEGIES:
+            raise ValueError(f"Unknown history strategy: {strategy}")
+        self.strategy = strategy
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.summarizer = summarizer
+        # Rolling summaries, as conversation id -> [number of messages
+        # summarized, last message summarized, summary]
+        self._summaries = {}
+        self._lock = threading.Lock()
+        self.summarized = 0
+
+    async def apply(self, conversation_id: Hashable, messages: list[BaseMessage],
+                    summarizer: Summarizer = None) -> list[BaseMessage]:
+        """Window the history of a conversation
+
+        Args:
+            conversation_id (Hashable): conversation id
+            messages (list[BaseMessage]): whole history
+            summarizer (Summarizer, optional): summarizer used when the window has none.
+            Defaults to None.
+
+        Returns:
+            list[BaseMessage]: messages to inject into the prompt
+        """
+        if self.strategy == "summary":
+            # Every message is either summarized or in the window
+            count, summary = await self.summarize(
+                conversation_id, messages, self.summarizer or summarizer)
+            window = messages[count:]
+        elif self.strategy == "tokens":
+            window = self.within_tokens(messages, self.max_tokens)
+        else:
+            window = messages[-self.max_messages:] if self.max_messages else []
+        result = self.last_result(messages)
+        if result is not None and not any(
+                message is result for message in window):
+            window = [result] + window
+        if self.strategy == "summary":
+            if summary:
+                window = [SystemMessage(
+                    content=f"Summary of the earlier conversation: {summary}")] + window
+        return window
+
+    async def summarize(self, conversation_id: Hashable, messages: list[BaseMessage],
+                        summarizer: Summarizer) -> tuple[int, str]:
+        """Get the rolling summary of the messages older than the window. Messages are folded
+        into the summary by batches of max_messages, so that the summarizer runs every few turns
+        rather than on each. Messages not folded yet stay in the window
+
+        Args:
+            conversation_id (Hashable): conversation id
+            messages (list[BaseMessage]): whole history
+            summarizer (Summarizer): coroutine function folding messages into the summary
+
+        Returns:
+            tuple[int, str]: number of first messages summarized, and summary, empty if no
+            message was folded
+        """
+        with self._lock:
+            count, last, summary = self._summaries.get(
+                conversation_id, (0, None, ""))
+        # Start over if the history was replaced since it was summarized. Compared
+        # by value, histories build their message objects again once released
+        if count > len(messages) or (count and messages[count - 1] != last):
+            count, summary = 0, ""
+        older = len(messages) - self.max_messages
+        if older - count >= max(self.max_messages, 1):
+            summary = await summarizer(summary, messages[count:older])
+            count = older
+            with self._lock:
+                self._summaries[conversation_id] = (
+                    count, messages[count - 1], summary)
+                self.summarized += 1
+        return count, summary
+
+    def forget(self, conversation_id: Hashable):
+        """Drop the rolling summary of a conversation
+
+        Args:
+            conversation_id (Hashable): conversation id
+        """
+        with self._lock:
+            self._summaries.pop(conversation_id, None)
+
+    @staticmethod
+    def within_tokens(messages: list[BaseMessage],
+                      max_tokens: int) -> list[BaseMessage]:
+        """Get the last messages within a token budget
+
+        Args:
+            messages (list[BaseMessage]): whole history
+            max_tokens (int): estimated tokens of the messages kept
+
+        Returns:
+            list[BaseMessage]: last messages
+        """
+        tokens = 0
+        for position in range(len(messages) - 1, -1, -1):
+            tokens += RateLimiter.estimate_tokens(
+                str(messages[position].content))
+            if tokens > max_tokens:
+                return messages[position + 1:]
+        return messages
+
+    @staticmethod
+    def last_result(messages: list[BaseMessage]) -> BaseMessage:
+        """Get the last assistant reply ending with a numeric result
+
+        Args:
+            messages (list[BaseMessage]): whole history
+
+        Returns:
+            BaseMessage: assistant reply, None if no reply ends with a result
+        """
+        for message in reversed(messages):
+            if message.type == "ai" and ArithmeticRouter.RESULT.search(
+                    str(message.content)):
+                return message
+        return None
+
+    def stats(self) -> dict:
+        """Get the window metrics
+
+        Returns:
+            dict: number of summaries kept, and of summarizer runs
+        """
+        with self._lock:
+            return {"summaries": len(self._summaries),
+                    "summarized": self.summarized}
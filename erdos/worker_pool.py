@@ -0,0 +1,372 @@
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Hashable, Union
+
+if TYPE_CHECKING:
+    from .agent import Agent
+    from .history import CompactHistory
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+
+    # Seconds between checks that the workers are alive
+    POLL_INTERVAL = 0.5
+    # Seconds close() waits for each worker to stop before terminating it
+    CLOSE_TIMEOUT = 10.0
+
+    def __init__(self, processes: int, llm_api_key: str,
+                 agent_factory: Callable[[str], 'Agent'] = None):
+        """Pool of worker processes, each owning its own Agent and the session histories of the
+        conversations pinned to it. Conversations are pinned to a worker by id, so that their
+        messages keep being processed in order
+
+        Args:
+            processes (int): number of worker processes
+            llm_api_key (str): OpenAI API key
+            agent_factory (Callable[[str], Agent], optional): picklable function creating the
+            agent of a worker from the API key. Defaults to None, for Agent.
+        """
+        context = multiprocessing.get_context("spawn")
+        self._requests = [context.Queue() for _ in range(processes)]
+        self._responses = context.Queue()
+        self._processes = [
+            context.Process(
+                target=WorkerPool.run_worker,
+                args=(requests, self._responses, llm_api_key, agent_factory),
+                daemon=True)
+            for requests in self._requests]
+        for process in self._processes:
+            process.start()
+
+        # Workers and futures of the requests waiting for a response, by
+        # request id
+        self._futures = {}
+        self._closing = False
+        self._request_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(
+            target=self._read_responses, daemon=True)
+        self._reader.start()
+        self.agent = RemoteAgent(self)
+
+    def call(self, conversation_id: Hashable, operation: str,
+             *args) -> concurrent.futures.Future:
+        """Run an agent operation on the worker the conversation is pinned to
+
+        Args:
+            conversation_id (Hashable): conversation id
+            operation (str): name of the operation, one of WorkerPool.OPERATIONS
+
+        Returns:
+            concurrent.futures.Future: resolves to the result of the operation, or raises
+            RuntimeError if the worker died
+        """
+        future = concurrent.futures.Future()
+        worker = hash(conversation_id) % len(self._processes)
+        if not self._processes[worker].is_alive():
+            future.set_exception(self._dead(worker))
+            return future
+        with self._lock:
+            request_id = next(self._request_ids)
+            self._futures[request_id] = (worker, future)
+        self._requests[worker].put(
+            (request_id, operation, conversation_id, args))
+        return future
+
+    def _read_responses(self):
+        """Resolve the futures of requests as workers respond, and fail those of workers that
+        died"""
+        checked = time.monotonic()
+        while True:
+            try:
+                response = self._responses.get(
+                    timeout=WorkerPool.POLL_INTERVAL)
+            except queue.Empty:
+                response = False
+            except Exception:
+                # A response that can't be read has no future to fail, keep
+                # serving the others
+                logger.exception("Worker response could not be read")
+                continue
+            if response is None:
+                return
+            if response:
+                self._resolve(response)
+            if not response or time.monotonic() - checked >= WorkerPool.POLL_INTERVAL:
+                checked = time.monotonic()
+                self._check_workers()
+
+    def _resolve(self, response: tuple):
+        """Resolve the future of a request with its response
+
+        Args:
+            response (tuple): request id, whether the operation failed, and its result, or its
+            pickled error
+        """
+        request_id, error, result = response
+        with self._lock:
+            _, future = self._futures.pop(request_id, (None, None))
+        if future is None:
+            return
+        if error:
+            try:
+                result = pickle.loads(result)
+            except Exception as e:
+                result = RuntimeError(
+                    f"Worker error could not be unpickled: {e!r}")
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+    def _check_workers(self):
+        """Fail the futures of the requests of workers that died, once their last responses
+        are read"""
+        dead = {worker for worker, process in enumerate(self._processes)
+                if not process.is_alive()}
+        if not dead:
+            return
+        while True:
+            try:
+                response = self._responses.get_nowait()
+            except queue.Empty:
+                break
+            if response is None:
+                # Read again by _read_responses, to stop
+                self._responses.put(None)
+                break
+            self._resolve(response)
+        self._fail(dead)
+
+    def _fail(self, workers: set[int]):
+        """Fail the futures of the requests of workers
+
+        Args:
+            workers (set[int]): indices of the workers
+        """
+        with self._lock:
+            failed = [(request_id, worker, future)
+                      for request_id, (worker, future) in self._futures.items()
+                      if worker in workers]
+            for request_id, _, _ in failed:
+                del self._futures[request_id]
+        for _, worker, future in failed:
+            future.set_exception(self._dead(worker))
+
+    def _dead(self, worker: int) -> RuntimeError:
+        """Get the error of the requests of a worker that died
+
+        Args:
+            worker (int): index of the worker
+
+        Returns:
+            RuntimeError: error
+        """
+        if self._closing:
+            return RuntimeError("Worker pool closed")
+        return RuntimeError(
+            f"Worker {worker} died with exit code {self._processes[worker].exitcode}")
+
+    def close(self):
+        """Stop the worker processes, terminating those that don't stop within CLOSE_TIMEOUT.
+        Requests left unanswered fail"""
+        self._closing = True
+        for process, requests in zip(self._processes, self._requests):
+            if process.is_alive():
+                requests.put(None)
+        for process in self._processes:
+            process.join(WorkerPool.CLOSE_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._responses.put(None)
+        self._reader.join()
+        self._fail(set(range(len(self._processes))))
+
+    @staticmethod
+    def run_worker(requests: multiprocessing.Queue,
+                   responses: multiprocessing.Queue, llm_api_key: str,
+                   agent_factory: Callable[[str], 'Agent']):
+        """Entry point of a worker process: serve requests until told to stop
+
+        Args:
+            requests (multiprocessing.Queue): requests for the worker
+            responses (multiprocessing.Queue): responses of all workers
+            llm_api_key (str): OpenAI API key
+            agent_factory (Callable[[str], Agent]): function creating the agent of the worker,
+            None for Agent
+        """
+        if agent_factory is None:
+            # Imported in the worker, the parent process may not need the LLM
+            # stack
+            from .agent import Agent
+            agent_factory = Agent
+        asyncio.run(WorkerPool._serve(
+            requests, responses, agent_factory(llm_api_key)))
+
+    @staticmethod
+    async def _serve(requests: multiprocessing.Queue,
+                     responses: multiprocessing.Queue, agent: 'Agent'):
+        """Serve requests concurrently on the worker's event loop
+
+        Args:
+            requests (multiprocessing.Queue): requests for the worker
+            responses (multiprocessing.Queue): responses of all workers
+            agent (Agent): agent of the worker
+        """
+        loop = asyncio.get_running_loop()
+        tasks = set()
+        while True:
+            request = await loop.run_in_executor(None, requests.get)
+            if request is None:
+                break
+            task = loop.create_task(
+                WorkerPool._handle(request, responses, agent))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    @staticmethod
+    async def _handle(request: tuple, responses: multiprocessing.Queue,
+                      agent: 'Agent'):
+        """Run an agent operation, and respond with its result or error
+
+        Args:
+            request (tuple): request id, operation, conversation id and arguments
+            responses (multiprocessing.Queue): responses of all workers
+            agent (Agent): agent of the worker
+        """
+        request_id, operation, conversation_id, args = request
+        try:
+            result = await WorkerPool.OPERATIONS[operation](
+                agent, conversation_id, *args)
+        except Exception as e:
+            # Pickled here, so that an error the parent can't unpickle fails
+            # its request only
+            responses.put(
+                (request_id, True, pickle.dumps(
+                    WorkerPool._picklable(e))))
+        else:
+            responses.put((request_id, False, result))
+
+    @staticmethod
+    def _picklable(error: Exception) -> Exception:
+        """Get an error that can be sent back to the parent process
+
+        Args:
+            error (Exception): error raised by an operation
+
+        Returns:
+            Exception: the error, or a RuntimeError describing it if it can't be pickled and
+            unpickled
+        """
+        try:
+            pickle.loads(pickle.dumps(error))
+            return error
+        except Exception:
+            return RuntimeError(repr(error))
+
+    @staticmethod
+    async def _send_message(agent: 'Agent', conversation_id: Hashable,
+                            message: str, channel: Hashable,
+                            weight: float, model: str = None, client: str = None) -> str:
+        return await agent.send_message(
+            conversation_id, message, channel=channel, weight=weight, model=model,
+            client=client)
+
+    @staticmethod
+    async def _send_messages(agent: 'Agent', conversation_id: Hashable,
+                             messages: list[str], channel: Hashable,
+                             weight: float, model: str = None, client: str = None) -> str:
+        return await agent.send_messages(
+            conversation_id, messages, channel=channel, weight=weight, model=model,
+            client=client)
+
+    @staticmethod
+    async def _get_messages(agent: 'Agent', conversation_id: Hashable,
+                            stringified: bool) -> Union[list[str], str]:
+        from .agent import Agent
+        messages = agent.get_messages(conversation_id, stringified)
+        return messages if stringified else Agent.dump_messages(
+            messages.messages)
+
+    @staticmethod
+    async def _add_to_session_history(agent: 'Agent', conversation_id: Hashable,
+                                      messages: list[str]):
+        agent.add_to_session_history(conversation_id, messages)
+
+    # Agent operations workers run, with the conversation id as first
+    # argument. Messages cross process boundaries serialized
+    OPERATIONS = {
+        "send_message": _send_message.__func__,
+        "send_messages": _send_messages.__func__,
+        "get_messages": _get_messages.__func__,
+        "add_to_session_history": _add_to_session_history.__func__,
+    }
+
+
+class RemoteAgent:
+
+    def __init__(self, pool: WorkerPool):
+        """Stands in for the Agent of conversations whose session histories live in worker
+        processes, forwarding the agent operations conversations use to their worker
+
+        Args:
+            pool (WorkerPool): pool of worker processes
+        """
+        self.pool = pool
+
+    async def send_message(self, conversation_id: Hashable, message: str,
+                           channel: Hashable = None, weight: float = 1.0,
+                           on_chunk: Callable[[str], None] = None, model: str = None,
+                           client: str = None) -> str:
+        """Send message to the agent of the conversation's worker, as Agent.send_message does.
+        Callbacks can't cross processes, so the response is streamed as a single chunk
+        """
+        response = await asyncio.wrap_future(self.pool.call(
+            conversation_id, "send_message", message, channel, weight, model, client))
+        if on_chunk:
+            on_chunk(response)
+        return response
+
+    async def send_messages(self, conversation_id: Hashable, messages: list[str],
+                            channel: Hashable = None, weight: float = 1.0,
+                            on_chunk: Callable[[str], None] = None,
+                            model: str = None, client: str = None) -> str:
+        """Send messages as a single turn to the agent of the conversation's worker, as
+        Agent.send_messages does, streaming the response as a single chunk
+        """
+        response = await asyncio.wrap_future(self.pool.call(
+            conversation_id, "send_messages", messages, channel, weight, model, client))
+        if on_chunk:
+            on_chunk(response)
+        return response
+
+    def get_messages(self, conversation_id: Hashable,
+                     stringified: bool = False) -> Union['CompactHistory', str]:
+        """Get a copy of the conversation history from the conversation's worker, as
+        Agent.get_messages does
+        """
+        from .agent import Agent
+        from .history import CompactHistory
+        messages = self.pool.call(
+            conversation_id, "get_messages", stringified).result()
+        return messages if stringified else CompactHistory(
+            Agent.load_messages(messages))
+
+    def add_to_session_history(self, conversation_id: Hashable,
+                               messages: list[str]):
+        """Replace the conversation history in the conversation's worker, as
+        Agent.add_to_session_history does
+        """
+        self.pool.call(conversation_id, "add_to_session_history",
+                       messages).result()
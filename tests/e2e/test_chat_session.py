@@ -1,5 +1,4 @@
 
-import time
 import os
 from erdos.channel import Channel
 from dotenv import load_dotenv
@@ -21,7 +20,7 @@ def test_chat_session():
     second_conversation.add_message("What is 3*3?")
     second_conversation.add_message("Add 1 to the response")
 
-    time.sleep(5)
+    channel.gather(timeout=60)
 
     print(conversation.get_messages())
     assert '8' in conversation.get_messages().messages[-1].content
@@ -31,7 +30,7 @@ def test_chat_session():
     channel = Channel("channel_2", os.getenv("OPENAI_API_KEY"))
     conversation = channel.add_conversation(1)
     conversation.retrieve()
-    conversation.add_message("Add 7 to previous result")
+    reply = conversation.add_message("Add 7 to previous result")
 
-    time.sleep(5)
+    assert '15' in reply.result(timeout=60)
     assert '15' in conversation.get_messages().messages[-1].content
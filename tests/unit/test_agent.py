@@ -1,8 +1,21 @@
 import pytest
-from unittest.mock import patch
+import threading
+from unittest.mock import patch, AsyncMock, Mock
 from erdos.agent import Agent
+from erdos.backend import FakeBackend
+from erdos.cache import ResponseCache
+from erdos.calculator import ArithmeticRouter
+from erdos.db import DB
+from erdos.history import HistoryStore
+from erdos.limiter import RateLimiter
+from erdos.metrics import MetricsRegistry
+from erdos.resilience import LLMError
+from erdos.scheduler import WeightedFairScheduler
+from erdos.window import HistoryWindow
 from langchain.schema.runnable import Runnable
+from langchain_core.runnables import RunnableGenerator
 from langchain_core.runnables.history import RunnableWithMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage
 
 
 @pytest.fixture
@@ -11,14 +24,440 @@ def agent():
     yield agent
 
 
+@pytest.fixture
+def fake_agent(agent):
+    """Agent built on a fake backend"""
+    backend, llm, chat_model = agent.backend, agent.llm, agent.chat_model
+    agent.backend = FakeBackend()
+    agent.llm = agent.__initialize_llm__()
+    agent._chains = {}
+    yield agent
+    agent.backend, agent.llm, agent.chat_model = backend, llm, chat_model
+    agent._chains = {}
+
+
 @patch('erdos.agent.Agent.get_session_history')
 def test__initialize_llm__(get_session_history, agent):
     """Test __initialize_llm__ method of Agent class
     """
 
-    runnable = agent.__initialize_llm__('1')
+    runnable = agent.__initialize_llm__()
     # Ensure the returned object is a RunnableWithMessageHistory object
     assert isinstance(runnable, RunnableWithMessageHistory)
     # Ensure the runnable session getter is the same as the agent's session
     # getter
     assert runnable.get_session_history == get_session_history
+
+
+def test_add_to_session_history(agent):
+    """Test dump_messages, load_messages and add_to_session_history methods of Agent class
+    """
+
+    messages = [HumanMessage("What is 2+2?"), AIMessage("4")]
+    dumped = Agent.dump_messages(messages)
+    # Ensure messages are serialized one per document, and load back
+    assert len(dumped) == 2
+    assert Agent.load_messages(dumped) == messages
+
+    agent.add_to_session_history(7, dumped)
+    assert agent.get_session_history(7).messages == messages
+
+
+def test_init_history():
+    """Test __init__ method of Agent class keeps the given history store, even while empty
+    """
+
+    history = HistoryStore(capacity=1)
+    with patch.object(Agent, "instance", None):
+        agent = Agent('1', history=history)
+        assert agent.history is history
+        agent.add_to_session_history(81, [])
+        assert 81 in history
+
+
+@pytest.mark.asyncio
+async def test_send_message_cache(agent):
+    """Test send_message method of Agent class with a response cache
+    """
+
+    agent.response_cache = ResponseCache()
+    agent.router = None
+    try:
+        with patch.object(agent, "llm") as llm:
+            async def ainvoke(input, config):
+                history = agent.get_session_history(
+                    config["configurable"]["session_id"])
+                history.add_user_message(input["input"])
+                history.add_ai_message("4")
+                return Mock(content="4")
+            llm.ainvoke = AsyncMock(side_effect=ainvoke)
+
+            # Ensure the first call misses the cache, and the second hits it
+            assert await agent.send_message(21, "What is 2+2?") == "4"
+            assert await agent.send_message(22, "What is 2+2?") == "4"
+            llm.ainvoke.assert_awaited_once()
+    finally:
+        agent.response_cache = None
+        agent.router = ArithmeticRouter()
+
+    # Ensure the cached turn is recorded in the session history
+    assert agent.get_messages(22, stringified=True) == \
+        agent.get_messages(
+        21, stringified=True) == "Human: What is 2+2?\nAi: 4"
+
+
+@pytest.mark.asyncio
+async def test_send_message_router(agent):
+    """Test send_message method of Agent class answers plain arithmetic locally
+    """
+
+    agent.router = ArithmeticRouter()
+    with patch.object(agent, "llm") as llm:
+        llm.ainvoke = AsyncMock(return_value=Mock(content="Paris"))
+
+        assert await agent.send_message(31, "What is 2+2?") == "2+2 = 4"
+        assert await agent.send_message(
+            31, "Add 4 to the previous result") == "4 + 4 = 8"
+        llm.ainvoke.assert_not_awaited()
+
+        # Ensure anything else falls through to the LLM
+        assert await agent.send_message(
+            31, "What is the capital of France?") == "Paris"
+        llm.ainvoke.assert_awaited_once()
+
+    assert agent.get_messages(31, stringified=True) == (
+        "Human: What is 2+2?\nAi: 2+2 = 4\n"
+        "Human: Add 4 to the previous result\nAi: 4 + 4 = 8")
+    assert agent.router.stats() == {"short_circuited": 2, "fell_through": 1}
+
+
+@pytest.mark.asyncio
+async def test_send_message_limiter(agent):
+    """Test send_message method of Agent class with a limiter
+    """
+
+    agent.limiter = RateLimiter(max_concurrent=1, tokens_per_minute=10000)
+    try:
+        with patch.object(agent, "llm") as llm:
+            llm.ainvoke = AsyncMock(return_value=Mock(
+                content="Paris", usage_metadata={"total_tokens": 500}))
+            with patch.object(agent.limiter, "adjust") as adjust:
+                assert await agent.send_message(
+                    41, "What is the capital of France?") == "Paris"
+    finally:
+        limiter, agent.limiter = agent.limiter, None
+
+    # Ensure the call went through the limiter, and was charged for the
+    # tokens used beyond the estimate
+    assert limiter.stats()["acquired"] == 1
+    assert limiter.stats()["in_flight"] == 0
+    estimate = RateLimiter.estimate_tokens(agent.prompt.format(
+        history="", input="What is the capital of France?"))
+    adjust.assert_called_once_with(500 - estimate)
+
+
+@pytest.mark.asyncio
+async def test_send_message_scheduler(agent):
+    """Test send_message method of Agent class with a scheduler
+    """
+
+    agent.scheduler = WeightedFairScheduler(capacity=1)
+    try:
+        with patch.object(agent, "llm") as llm:
+            llm.ainvoke = AsyncMock(return_value=Mock(content="Paris"))
+            assert await agent.send_message(
+                51, "What is the capital of France?",
+                channel="premium", weight=3.0) == "Paris"
+    finally:
+        scheduler, agent.scheduler = agent.scheduler, None
+
+    # Ensure the call was dispatched for the conversation's channel
+    assert scheduler.stats() == {"in_flight": 0, "queue_depth": 0,
+                                 "dispatched": {"premium": 1}}
+
+
+@pytest.mark.asyncio
+async def test_summarize_limits(fake_agent):
+    """Test that summaries of the history window are dispatched and limited as turns are
+    """
+
+    agent = fake_agent
+    agent.window = HistoryWindow("summary", max_messages=2)
+    agent.scheduler = WeightedFairScheduler(capacity=1)
+    agent.limiter = RateLimiter(max_concurrent=1, requests_per_minute=600)
+    try:
+        agent.add_to_session_history(151, Agent.dump_messages(
+            [HumanMessage(content="Hi"), AIMessage(content="Hello"),
+             HumanMessage(content="Who are you?"), AIMessage(content="An assistant")]))
+        assert (await agent.send_message(
+            151, "What is the capital of France?", channel="premium")).startswith("Response")
+    finally:
+        window, agent.window = agent.window, None
+        scheduler, agent.scheduler = agent.scheduler, None
+        limiter, agent.limiter = agent.limiter, None
+
+    # Ensure the summary and the turn each took a slot of the channel, and
+    # counted against the limits
+    assert window.stats()["summarized"] == 1
+    assert scheduler.stats()["dispatched"] == {"premium": 2}
+    assert limiter.stats()["acquired"] == 2
+
+
+@pytest.mark.asyncio
+async def test_send_message_evicted_history(agent):
+    """Test send_message method of Agent class with the conversation's history evicted
+    """
+
+    history, agent.history = agent.history, HistoryStore(capacity=1)
+    store_evicted_history, threads = DB.store_evicted_history, []
+
+    def store(db, conversation_id, messages):
+        threads.append(threading.current_thread().name)
+        return store_evicted_history(db, conversation_id, messages)
+    try:
+        with patch.object(DB, "store_evicted_history", store):
+            agent.add_to_session_history(61, Agent.dump_messages(
+                [HumanMessage(content="2+2"), AIMessage(content="2+2 = 4")]))
+            agent.add_to_session_history(62, [])
+            assert agent.history.stats()["evicted"] == 1
+            # Wait for the write pending on the database thread
+            db = agent.history.db
+            db.aio.executor.submit(lambda: None).result()
+        assert len(threads) == 1 and threads[0].startswith("erdos-db")
+
+        # Ensure the history is reloaded off the event loop, without holding
+        # the lock of the store, for the follow-up to use it
+        threads = []
+
+        def pop_evicted_history(conversation_id):
+            locked = []
+
+            def probe():
+                locked.append(not agent.history._lock.acquire(blocking=False))
+                if not locked[0]:
+                    agent.history._lock.release()
+            prober = threading.Thread(target=probe)
+            prober.start()
+            prober.join()
+            assert locked == [False]
+            threads.append(threading.current_thread().name)
+            return DB.pop_evicted_history(db, conversation_id)
+        with patch.object(db, "pop_evicted_history", pop_evicted_history):
+            assert await agent.send_message(61, "Multiply the result by 3") == "4 * 3 = 12"
+        assert len(threads) == 1 and threads[0].startswith("erdos-db")
+        assert len(agent.get_session_history(61).messages) == 4
+        assert agent.history.stats()["reloads"] == 1
+    finally:
+        agent.history.close()
+        agent.history = history
+
+
+@pytest.mark.asyncio
+async def test_send_message_max_bytes(fake_agent):
+    """Test send_message method of Agent class keeps the histories within max_bytes
+    """
+
+    agent = fake_agent
+    history, agent.history = agent.history, HistoryStore(max_bytes=20000)
+    try:
+        for conversation_id in range(1000, 1030):
+            await agent.send_message(conversation_id, "Tell me about Paris " * 20)
+
+        # Ensure the turns count against max_bytes, evicting the least recently
+        # used
+        stats = agent.history.stats()
+        assert stats["evictions"] > 0 and stats["evicted"] > 0
+        assert 0 < stats["resident_bytes"] <= 20000
+        assert len(agent.get_session_history(1000).messages) == 2
+    finally:
+        agent.history.close()
+        agent.history = history
+
+
+@pytest.mark.asyncio
+async def test_forget_window():
+    """Test that the rolling summaries of the history window are dropped with the histories
+    """
+
+    window = HistoryWindow("summary", max_messages=2)
+    history = HistoryStore(capacity=1)
+    with patch.object(Agent, "instance", None):
+        agent = Agent('1', backend=FakeBackend(),
+                      history=history, window=window)
+        try:
+            agent.add_to_session_history(91, Agent.dump_messages(
+                [HumanMessage(content="Hi"), AIMessage(content="Hello"),
+                 HumanMessage(content="Who are you?"), AIMessage(content="An assistant")]))
+            await agent.send_message(91, "What is the capital of France?")
+            assert window.stats()["summaries"] == 1
+
+            # Ensure evicting the history drops its summary
+            agent.add_to_session_history(92, [])
+            assert history.stats()["evicted"] == 1
+            assert window.stats()["summaries"] == 0
+        finally:
+            history.close()
+
+
+@pytest.mark.asyncio
+async def test_send_message_window(agent):
+    """Test send_message method of Agent class with a history window
+    """
+
+    agent.window = HistoryWindow("last", max_messages=2)
+    agent.response_cache = ResponseCache()
+    try:
+        agent.add_to_session_history(71, Agent.dump_messages(
+            [HumanMessage(content="Hi"), AIMessage(content="Hello"),
+             HumanMessage(content="Who are you?"), AIMessage(content="An assistant")]))
+        with patch.object(agent, "llm") as llm:
+            llm.ainvoke = AsyncMock(return_value=Mock(content="Paris"))
+            assert await agent.send_message(
+                71, "What is the capital of France?") == "Paris"
+
+        # Ensure the chain step windows the injected history
+        inputs = await agent._prepare_inputs(
+            {"input": "x", "history": agent.get_session_history(
+                71).messages[:4]},
+            {"configurable": {"session_id": 71}})
+        assert [
+            m.content for m in inputs["history"]] == [
+            "Who are you?",
+            "An assistant"]
+    finally:
+        agent.window = None
+        cache, agent.response_cache = agent.response_cache, None
+
+    # Ensure the response was cached for the windowed prompt
+    assert await cache.get(agent.prompt.format(
+        history="Human: Who are you?\nAi: An assistant",
+        input="What is the capital of France?")) == "Paris"
+
+
+@pytest.mark.asyncio
+async def test_send_message_stream(fake_agent):
+    """Test send_message method of Agent class streaming the response
+    """
+
+    agent = fake_agent
+    agent.backend.responder = lambda model, prompt: "The capital of France is Paris"
+    chunks = []
+    assert await agent.send_message(
+        81, "What is the capital of France?",
+        on_chunk=chunks.append) == "The capital of France is Paris"
+    # Ensure answers without the LLM come as a single chunk
+    assert await agent.send_message(
+        81, "What is 2+2?", on_chunk=chunks.append) == "2+2 = 4"
+
+    assert "".join(chunks[:-1]) == "The capital of France is Paris"
+    assert len(chunks) > 2 and chunks[-1] == "2+2 = 4"
+    # Ensure the streamed response is recorded once in the session history
+    assert [m.content for m in agent.get_session_history(81).messages] == [
+        "What is the capital of France?", "The capital of France is Paris",
+        "What is 2+2?", "2+2 = 4"]
+
+
+@pytest.mark.asyncio
+async def test_send_message_empty_stream(fake_agent):
+    """Test send_message method of Agent class streaming a response without chunks
+    """
+
+    async def stream(prompts):
+        async for _ in prompts:
+            pass
+        return
+        yield
+
+    agent = fake_agent
+    agent.backend.chat_model = lambda model=None: RunnableGenerator(stream)
+    agent.llm = agent.__initialize_llm__()
+    chunks = []
+    # Ensure the empty response fails the turn as a structured error
+    with pytest.raises(LLMError, match="empty response") as error:
+        await agent.send_message(82, "What is the capital of France?", on_chunk=chunks.append)
+    assert error.value.model == "gpt-4" and chunks == []
+    assert agent.get_session_history(82).messages == []
+
+
+@pytest.mark.asyncio
+async def test_send_messages(fake_agent):
+    """Test send_messages method of Agent class
+    """
+
+    agent = fake_agent
+    agent.backend.responder = lambda model, prompt: "Paris and Rome"
+    assert await agent.send_messages(91, [
+        "What is the capital of France?",
+        "What is the capital of Italy?"]) == "Paris and Rome"
+
+    # Ensure both messages are sent in a single prompt
+    assert agent.backend.stats()["calls"] == 1
+    inputs = await agent._prepare_inputs(
+        {"input": agent.get_session_history(91).messages[:2], "history": []},
+        {"configurable": {"session_id": 91}})
+    assert inputs["input"] == "What is the capital of France?\nWhat is the capital of Italy?"
+    # Ensure each message is recorded in the session history
+    assert [m.content for m in agent.get_session_history(91).messages] == [
+        "What is the capital of France?", "What is the capital of Italy?",
+        "Paris and Rome"]
+
+
+@pytest.mark.asyncio
+async def test_send_message_model(fake_agent):
+    """Test send_message method of Agent class with a model other than the default
+    """
+
+    agent = fake_agent
+    agent.backend.responder = lambda model, prompt: f"Answered by {model}"
+    assert await agent.send_message(
+        111, "What is the capital of France?") == "Answered by gpt-4"
+    assert await agent.send_message(
+        111, "What is the capital of Italy?", model="gpt-4o-mini") == "Answered by gpt-4o-mini"
+
+    # Ensure the chain of each model is initialised once
+    assert agent.chain("gpt-4o-mini") is agent.chain("gpt-4o-mini")
+    assert agent.chain() is agent.llm
+
+
+@pytest.mark.asyncio
+async def test_send_message_metrics(fake_agent):
+    """Test that send_message method of Agent class records its metrics
+    """
+
+    agent = fake_agent
+    metrics, agent.metrics = agent.metrics, MetricsRegistry()
+    agent.response_cache = ResponseCache()
+    try:
+        await agent.send_message(121, "What is the capital of France?")
+        await agent.send_message(122, "What is the capital of France?")
+        await agent.send_message(122, "What is 2+2?")
+        snapshot = agent.metrics.snapshot()
+    finally:
+        agent.metrics, agent.response_cache = metrics, None
+
+    assert snapshot["counters"]["erdos_cache_requests_total"] == [
+        {"labels": {"result": "miss"}, "value": 1},
+        {"labels": {"result": "hit"}, "value": 1}]
+    assert snapshot["counters"]["erdos_local_answers_total"][0]["value"] == 1
+    [llm] = snapshot["histograms"]["erdos_llm_seconds"]
+    assert llm["labels"] == {"model": "gpt-4"} and llm["count"] == 1
+
+
+@pytest.mark.asyncio
+async def test_send_message_error(fake_agent):
+    """Test that send_message method of Agent class raises failed turns as structured errors
+    """
+
+    agent = fake_agent
+    agent.backend.error_rate = 1.0
+    backoff, agent.retry.backoff = agent.retry.backoff, 0.001
+    try:
+        with pytest.raises(LLMError) as error:
+            await agent.send_message(131, "What is the capital of France?")
+    finally:
+        agent.retry.backoff = backoff
+
+    assert error.value.model == "gpt-4" and error.value.attempts == agent.retry.max_attempts
+    assert "Injected error" in str(error.value)
+    # Ensure the failed turn isn't recorded in the session history
+    assert agent.get_session_history(131).messages == []
@@ -0,0 +1,77 @@
+import pytest
+import random
+import time
+from erdos.backend import FakeBackend, FakeBackendError, LLMBackend, OpenAIBackend
+from langchain_openai import ChatOpenAI
+
+
+def test_openai_backend():
+    """Test chat_model method of OpenAIBackend class
+    """
+    backend = OpenAIBackend('1')
+
+    assert isinstance(backend.chat_model(), ChatOpenAI)
+    assert backend.chat_model().model_name == LLMBackend.DEFAULT_MODEL
+    assert backend.chat_model("gpt-4o-mini").model_name == "gpt-4o-mini"
+    # Ensure backends must implement chat_model
+    with pytest.raises(TypeError):
+        LLMBackend()
+
+
+@pytest.mark.asyncio
+async def test_fake_backend():
+    """Test that FakeBackend chat models respond deterministically, with usage
+    """
+    model = FakeBackend().chat_model()
+
+    response = await model.ainvoke("What is 2+2?")
+    assert response.content == (await model.ainvoke("What is 2+2?")).content
+    assert response.content != (await model.ainvoke("What is 3+3?")).content
+    assert response.usage_metadata["total_tokens"] > 0
+    assert model.invoke("What is 2+2?").content == response.content
+
+
+@pytest.mark.asyncio
+async def test_fake_backend_stream():
+    """Test that FakeBackend chat models stream their response by chunks of words
+    """
+    backend = FakeBackend(chunk_size=2, chunk_latency=0.01,
+                          responder=lambda model, prompt: "one two three four five")
+
+    start = time.monotonic()
+    chunks = [chunk async for chunk in backend.chat_model().astream("Count")]
+    assert time.monotonic() - start >= 0.02
+    assert [chunk.content for chunk in chunks] == [
+        "one two ", "three four ", "five", ""]
+    # Ensure the usage is reported once
+    assert sum(chunks[1:], chunks[0]).usage_metadata["output_tokens"] > 0
+
+
+@pytest.mark.asyncio
+async def test_fake_backend_errors_latency():
+    """Test that FakeBackend injects errors and latency, reproducibly for a seed
+    """
+    def outcomes(seed):
+        backend = FakeBackend(latency=FakeBackend.lognormal(0.1, 0.5), error_rate=0.3,
+                              seed=seed)
+        return [round(backend.latency(backend._random), 6) for _ in range(5)]
+
+    assert outcomes(1) == outcomes(1)
+    assert outcomes(1) != outcomes(2)
+
+    backend = FakeBackend(error_rate=0.5, seed=3)
+    model = backend.chat_model()
+    errors = 0
+    for _ in range(100):
+        try:
+            await model.ainvoke("What is 2+2?")
+        except FakeBackendError:
+            errors += 1
+    assert 30 < errors < 70
+    assert backend.stats() == {"calls": 100, "errors": errors}
+
+    latency = FakeBackend.uniform(0.01, 0.02)(random.Random(0))
+    assert 0.01 <= latency <= 0.02
+    start = time.monotonic()
+    await FakeBackend(latency=FakeBackend.constant(0.05)).chat_model().ainvoke("Hi")
+    assert time.monotonic() - start >= 0.05
@@ -0,0 +1,60 @@
+import pytest
+from unittest.mock import patch
+from erdos.cache import ResponseCache
+from erdos.db import DB
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / "conversations.db")
+    yield db_path
+    DB(db_path).close()
+
+
+@pytest.mark.asyncio
+async def test_get_put():
+    """Test get and put methods of ResponseCache class
+    """
+    cache = ResponseCache(max_size=2)
+
+    assert await cache.get("What is 2+2?") is None
+    await cache.put("What is 2+2?", "4")
+    await cache.put("What is 3+3?", "6")
+    assert await cache.get("What is 2+2?") == "4"
+
+    # Ensure the least recently used response is evicted
+    await cache.put("What is 4+4?", "8")
+    assert await cache.get("What is 3+3?") is None
+    assert await cache.get("What is 2+2?") == "4"
+
+    assert cache.stats() == {"hits": 2, "misses": 2, "size": 2}
+
+
+@pytest.mark.asyncio
+async def test_ttl():
+    """Test responses expire after the cache ttl
+    """
+    cache = ResponseCache(ttl=10)
+
+    with patch("time.time", return_value=100):
+        await cache.put("What is 2+2?", "4")
+    with patch("time.time", return_value=110):
+        assert await cache.get("What is 2+2?") == "4"
+    with patch("time.time", return_value=111):
+        assert await cache.get("What is 2+2?") is None
+
+
+@pytest.mark.asyncio
+async def test_db_tier(db_path):
+    """Test responses are kept in the database tier
+    """
+    await ResponseCache(db_path=db_path).put("What is 2+2?", "4")
+
+    # Ensure another cache, e.g. after a restart, finds the response in the
+    # database, and keeps it in memory
+    cache = ResponseCache(db_path=db_path)
+    assert await cache.get("What is 2+2?") == "4"
+    assert cache.stats() == {"hits": 1, "misses": 0, "size": 1}
+
+    # Ensure expired responses aren't returned from the database
+    assert await ResponseCache(ttl=-1, db_path=db_path).get("What is 2+2?") is None
@@ -0,0 +1,78 @@
+import pytest
+from erdos.calculator import ArithmeticRouter
+from langchain_community.chat_message_histories import ChatMessageHistory
+
+
+@pytest.fixture
+def router():
+    router = ArithmeticRouter()
+    yield router
+
+
+@pytest.mark.parametrize("message, answer", [
+    ("What is 2+2?", "2+2 = 4"),
+    ("what is (3 + 4) * 2", "(3 + 4) * 2 = 14"),
+    ("Calculate 2^10.", "2^10 = 1024"),
+    ("7 ÷ 2", "7 ÷ 2 = 3.5"),
+    ("1/3", "1/3 = 0.333333333333"),
+    ("What is 10 % 3?", "10 % 3 = 1"),
+])
+def test_route(router, message, answer):
+    """Test route method of ArithmeticRouter class answers plain arithmetic
+
+    Args:
+        router (ArithmeticRouter): router object
+    """
+    assert router.route(message, ChatMessageHistory()) == answer
+
+
+@pytest.mark.parametrize("message", [
+    "What is the capital of France?",
+    "2024",
+    "What is 1/0?",
+    "(-8)**0.5",
+    "9**9**9",
+    "What is 999999999999999^64?",
+    "__import__('os')",
+    "2 3",
+    "Add 4 to the previous result",
+])
+def test_route_fall_through(router, message):
+    """Test route method of ArithmeticRouter class leaves anything else to the LLM
+
+    Args:
+        router (ArithmeticRouter): router object
+    """
+    assert router.route(message, ChatMessageHistory()) is None
+
+
+def test_route_follow_ups(router):
+    """Test route method of ArithmeticRouter class answers follow-ups on the previous result
+
+    Args:
+        router (ArithmeticRouter): router object
+    """
+    history = ChatMessageHistory()
+    history.add_user_message("What is 2+2?")
+    history.add_ai_message("2 + 2 equals 4.")
+
+    assert router.route("Add 4 to previous result", history) == "4 + 4 = 8"
+    assert router.route("Subtract 1 from the last answer",
+                        history) == "4 - 1 = 3"
+    assert router.route("Multiply the previous result by 3",
+                        history) == "4 * 3 = 12"
+    assert router.route("Divide the result by 8", history) == "4 / 8 = 0.5"
+
+    # Ensure replies without a final numeric result fall through
+    history.add_ai_message("It depends on the base you count in")
+    assert router.route("Add 1 to the response", history) is None
+
+    # Ensure follow-ups can be disabled, and routing altogether
+    history.add_ai_message("The result is 10")
+    assert router.route("Add 1 to the response", history) == "10 + 1 = 11"
+    router.follow_ups = False
+    assert router.route("Add 1 to the response", history) is None
+    router.enabled = False
+    assert router.route("What is 2+2?", history) is None
+
+    assert router.stats() == {"short_circuited": 5, "fell_through": 2}
@@ -1,12 +1,20 @@
 import asyncio
+import concurrent.futures
 import pytest
-from unittest.mock import patch
+from unittest.mock import patch, Mock
+from erdos.agent import Agent
+from erdos.backend import FakeBackend
 from erdos.channel import Channel
 
 
+def fake_agent(llm_api_key):
+    """Agent factory of the workers, answering on FakeBackend"""
+    return Agent(llm_api_key, backend=FakeBackend())
+
+
 @pytest.fixture
-def channel():
-    channel = Channel(1, '5')
+def channel(tmp_path):
+    channel = Channel(1, '5', db_path=str(tmp_path / "conversations.db"))
     yield channel
 
 
@@ -19,19 +27,28 @@ def test_add_conversation(MockConversation, channel):
     """
 
     channel.add_conversation(3)
-    MockConversation.assert_called_with(3, channel.event_loop, '5')
+    MockConversation.assert_called_with(
+        3, channel.event_loop_pool.get_loop((1, 3)), '5',
+        db=channel.db, flusher=None, channel=1, weight=1.0, agent=None,
+        coalesce=1, linger=0.0, model=None, client=None)
     # Ensure conversation_id is set from the argument
     assert channel.conversations[3] == MockConversation(
         3, channel.event_loop, '5')
 
     channel.add_conversation()
-    MockConversation.assert_called_with(4, channel.event_loop, '5')
+    MockConversation.assert_called_with(
+        4, channel.event_loop_pool.get_loop((1, 4)), '5',
+        db=channel.db, flusher=None, channel=1, weight=1.0, agent=None,
+        coalesce=1, linger=0.0, model=None, client=None)
     # Ensure conversation_id is set to the next available id
     assert channel.conversations[4] == MockConversation(
         4, channel.event_loop, '5')
 
     channel.add_conversation(6)
-    MockConversation.assert_called_with(6, channel.event_loop, '5')
+    MockConversation.assert_called_with(
+        6, channel.event_loop_pool.get_loop((1, 6)), '5',
+        db=channel.db, flusher=None, channel=1, weight=1.0, agent=None,
+        coalesce=1, linger=0.0, model=None, client=None)
     # Ensure conversation_id is set from the argument
     assert channel.conversations[6] == MockConversation(
         6, channel.event_loop, '5')
@@ -41,19 +58,149 @@ def test_add_conversation(MockConversation, channel):
         channel.add_conversation(6)
 
 
-@patch('erdos.channel.Channel.start_event_loop')
-@patch('threading.Thread')
-def test__init_event_loop__(Thread, start_event_loop, channel):
-    """Test __init_event_loop__ method of Channel class
+def test_gather(channel):
+    """Test gather method of Channel class
+
+    Args:
+    channel (Channel): Channel object
+    """
+
+    replies = [concurrent.futures.Future() for _ in range(2)]
+    channel.conversations = {
+        1: Mock(last_reply=replies[0]),
+        2: Mock(last_reply=replies[1]),
+        3: Mock(last_reply=None),
+    }
+
+    # Ensure TimeoutError is raised when replies are pending
+    replies[0].set_result("4")
+    with pytest.raises(TimeoutError):
+        channel.gather(timeout=0)
+
+    # Ensure last replies are returned, skipping conversations without
+    # messages
+    replies[1].set_result("10")
+    assert channel.gather() == {1: "4", 2: "10"}
+    assert channel.gather([2]) == {2: "10"}
+
+
+def test_store_all_retrieve_many(channel):
+    """Test store_all and retrieve_many methods of Channel class
+
+    Args:
+    channel (Channel): Channel object
+    """
+
+    for conversation_id in (11, 12):
+        conversation = channel.add_conversation(conversation_id)
+        conversation.get_messages().add_user_message(
+            f"Hello {conversation_id}")
+        conversation.get_messages().add_ai_message("Hi")
+
+    # Ensure all conversations are stored in a single transaction
+    with patch.object(channel.db, "store_many", wraps=channel.db.store_many) as store_many:
+        channel.store_all()
+    store_many.assert_called_once()
+    assert channel.db.conversation_ids() == [11, 12]
+
+    # Ensure stored conversations are added to a new channel, with their
+    # history
+    restored = Channel(2, '5', db_path=channel.db.path)
+    conversations = restored.retrieve_many(last=1)
+    assert [conversation._conversation_id for conversation in conversations] == [
+        11, 12]
+    assert restored.conversations[12].get_messages(
+        stringified=True) == "Ai: Hi"
+
+    # Ensure new messages are stored after the retrieved ones
+    restored.conversations[12].get_messages().add_user_message("Bye")
+    restored.store_all()
+    assert channel.db.retrieve(12)[-1][0] == 2
+
+
+def test_close(channel):
+    """Test close method of Channel class
 
     Args:
     channel (Channel): Channel object
     """
 
-    loop = channel.__init_event_loop__()
+    conversation = channel.add_conversation(21)
+    # Ensure the channel runs on the shared event loops
+    assert channel.event_loop is channel.event_loop_pool.get_loop(1)
+    assert conversation.event_loop.is_running()
+
+    async def send_message(*args, **kwargs):
+        await asyncio.sleep(60)
+
+    with patch.object(conversation.agent, "send_message", send_message):
+        processing = conversation.add_message("What is the meaning of life?")
+        pending = conversation.add_message("And of everything else?")
+        channel.close(timeout=1)
+
+    # Ensure the replies of the message being processed and of the pending
+    # one are cancelled
+    with pytest.raises(concurrent.futures.CancelledError):
+        processing.result(1)
+    assert pending.cancelled()
+    assert channel.conversations == {}
+
+
+def test_weight(tmp_path):
+    """Test Channel class refuses weights that aren't positive
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+
+    for weight in (0, -1.0):
+        with pytest.raises(ValueError):
+            Channel(
+                2,
+                '5',
+                db_path=str(
+                    tmp_path /
+                    "conversations.db"),
+                weight=weight)
+
+
+def test_processes(tmp_path):
+    """Test Channel class fans conversations out to worker processes
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+
+    channel = Channel(2, '5', db_path=str(
+        tmp_path / "conversations.db"), processes=1)
+    try:
+        conversation = channel.add_conversation(101)
+        # Ensure the conversation API is unchanged
+        assert conversation.add_message("What is 2+2?").result(60) == "2+2 = 4"
+        assert conversation.get_messages(stringified=True) == \
+            "Human: What is 2+2?\nAi: 2+2 = 4"
+        conversation.store()
+        assert len(channel.db.retrieve(101)) == 2
+        # Ensure the history lives in the worker, not in this process
+        assert 101 not in Agent('5').history
+    finally:
+        channel.close()
+
+
+def test_processes_agent_factory(tmp_path):
+    """Test Channel class builds the agent of its workers with agent_factory
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
 
-    assert isinstance(loop, asyncio.AbstractEventLoop)
-    # Ensure thread is created with the correct arguments
-    Thread.assert_called_with(
-        target=start_event_loop, args=(
-            loop,), daemon=True)
+    channel = Channel(3, '5', db_path=str(
+        tmp_path / "conversations.db"), processes=1, agent_factory=fake_agent)
+    try:
+        conversation = channel.add_conversation(102)
+        assert conversation.add_message(
+            "Hello").result(60).startswith("Response ")
+        assert "of the fake gpt-4 model." in conversation.get_messages(
+            stringified=True)
+    finally:
+        channel.close()
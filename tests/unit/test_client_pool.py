@@ -0,0 +1,109 @@
+import asyncio
+import pytest
+from erdos.agent import Agent
+from erdos.backend import FakeBackend, FakeBackendError
+from erdos.client_pool import ClientPool
+from erdos.resilience import CircuitOpenError, LLMError
+from langchain_core.prompt_values import StringPromptValue
+
+PROMPT = StringPromptValue(text="What is the capital of France?")
+
+
+@pytest.fixture
+def agent():
+    return Agent('1').instance
+
+
+def pool_of(*backends: FakeBackend, **kwargs) -> ClientPool:
+    """Pool of clients a, b... on fake backends"""
+    pool = ClientPool(**kwargs)
+    for name, backend in zip("abcdefgh", backends):
+        pool.add(None, name=name, backend=backend)
+    return pool
+
+
+@pytest.mark.asyncio
+async def test_distribution():
+    """Test that ClientPool class spreads calls over its clients by quota left
+    """
+    a, b = FakeBackend(latency=FakeBackend.constant(0.01)), FakeBackend(
+        latency=FakeBackend.constant(0.01))
+    pool = pool_of(a, b, requests_per_minute=60)
+    model = pool.chat_model()
+    await asyncio.gather(*[model.ainvoke(PROMPT) for _ in range(10)])
+    # Ensure each key takes its share of the calls
+    assert a.stats()["calls"] == b.stats()["calls"] == 5
+    assert pool.stats()["a"]["headroom"] == pytest.approx(55 / 60, abs=0.01)
+
+    # Ensure the client with the most quota left is selected
+    pool.add(None, name="c", backend=FakeBackend(), requests_per_minute=600)
+    assert pool.select().name == "c"
+    # Ensure pinned calls go to their client only
+    await model.ainvoke(PROMPT, {"configurable": {"client": "a"}})
+    assert a.stats()["calls"] == 6
+    with pytest.raises(LLMError):
+        await model.ainvoke(PROMPT, {"configurable": {"client": "d"}})
+
+
+@pytest.mark.asyncio
+async def test_failover():
+    """Test that ClientPool class fails over to healthy clients
+    """
+    a, b = FakeBackend(error_rate=1.0), FakeBackend()
+    pool = pool_of(a, b, failure_threshold=2, reset_timeout=60)
+    model = pool.chat_model()
+    for _ in range(3):
+        response = await model.ainvoke(PROMPT)
+        assert response.content.startswith("Response")
+    # Ensure the failing client is taken out of the pool after
+    # failure_threshold errors
+    assert a.stats() == {"calls": 2, "errors": 2}
+    assert pool.stats()["a"]["state"] == "open"
+    assert pool.stats()["b"]["calls"] == 3
+
+    # Ensure streams fail over before their first chunk
+    c = FakeBackend()
+    pool.add(None, name="c", backend=c, requests_per_minute=4)
+    await model.ainvoke(PROMPT, {"configurable": {"client": "c"}})
+    b.error_rate = 1.0
+    chunks = [chunk.content async for chunk in model.astream(PROMPT)]
+    assert "".join(chunks).startswith("Response")
+    assert b.stats()["errors"] == 1 and c.stats()["calls"] == 2
+    # Ensure the last error is raised when every client fails, and calls fail fast
+    # once no client is healthy
+    pool.remove("c")
+    with pytest.raises(FakeBackendError):
+        await model.ainvoke(PROMPT)
+    with pytest.raises(CircuitOpenError):
+        await model.ainvoke(PROMPT)
+
+
+def test_agent_keys(agent):
+    """Test that the keys Agent class is initialised with join its client pool
+    """
+    pool = agent.backend
+    assert isinstance(pool, ClientPool)
+    Agent("2")
+    try:
+        assert ClientPool.name_of("2") in pool.stats()
+        assert ClientPool.name_of("2") != ClientPool.name_of("3")
+    finally:
+        pool.remove(ClientPool.name_of("2"))
+
+
+@pytest.mark.asyncio
+async def test_agent_pinned(agent):
+    """Test that send_message method of Agent class pins LLM calls to a client of the pool
+    """
+    pool = pool_of(FakeBackend(responder=lambda model, prompt: "Answered with a"),
+                   FakeBackend(responder=lambda model, prompt: "Answered with b"))
+    backend, llm, chat_model = agent.backend, agent.llm, agent.chat_model
+    agent.backend = pool
+    agent.llm = agent.__initialize_llm__()
+    try:
+        assert {await agent.send_message(141, f"Question {i}", client="b")
+                for i in range(3)} == {"Answered with b"}
+        assert {await agent.send_message(142, f"Question {i}")
+                for i in range(6)} == {"Answered with a", "Answered with b"}
+    finally:
+        agent.backend, agent.llm, agent.chat_model = backend, llm, chat_model
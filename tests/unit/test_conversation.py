@@ -1,86 +1,201 @@
 import asyncio
+import concurrent.futures
 import pytest
-from unittest.mock import patch, Mock, AsyncMock
+from unittest.mock import patch, Mock, AsyncMock, call
+from erdos.agent import Agent
 from erdos.conversation import Conversation
-from queue import Queue
-
-
-@pytest.fixture
-def event_loop():
-    loop = asyncio.new_event_loop()
-    yield loop
-    loop.close()
+from erdos.db import DB
+from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.messages import AIMessage, HumanMessage
 
 
 @pytest.fixture
 def conversation():
     with patch("erdos.agent.Agent.instance") as agent:
         agent.return_value.send_message = AsyncMock()
-        conversation = Conversation(1, event_loop, '1')
+        conversation = Conversation(1, Mock(), '1')
         conversation.agent = agent.return_value
         yield conversation
 
 
-@patch("asyncio.run_coroutine_threadsafe")
-def test_add_message(mock_run_threadsafe, conversation):
+def test_add_message(conversation):
     """Test add_message method of Conversation class
 
     Args:
-        mock_run_threadsafe (asyncio.run_coroutine_threadsafe): thread safe coroutine runner
         conversation (Conversation): Conversation object
     """
 
-    _consume_message_mock = Mock()
-    conversation._consume_message = _consume_message_mock
+    reply = conversation.add_message("What is 2+2?")
 
-    conversation.add_message("What is 2+2?")
+    # Ensure a future is returned for the reply
+    assert isinstance(reply, concurrent.futures.Future)
+    assert conversation.last_reply is reply
+    # Ensure the message is handed over to the conversation's event loop
+    conversation.event_loop.call_soon_threadsafe.assert_called_once_with(
+        conversation._enqueue_message, "What is 2+2?", reply, None)
 
-    # Ensure the coroutine is scheduled on the event loop
-    mock_run_threadsafe.assert_called_once()
 
-    called_coroutine = mock_run_threadsafe.call_args[0][0]
+@pytest.mark.asyncio(loop_scope="module")
+async def test__consume_message(conversation):
+    """Test _consume_message method of Conversation class
 
-    # Ensure the coroutine scheduled matches the mocked _consume_message
-    assert called_coroutine.cr_code is conversation._consume_message().cr_code
+    Args:
+        conversation (Conversation): Conversation object
+    """
 
-    # Ensure the event loop is the same as the conversation's event loop
-    called_event_loop = mock_run_threadsafe.call_args[0][1]
-    assert called_event_loop == conversation.event_loop
+    conversation.event_loop = asyncio.get_running_loop()
+    conversation.agent.send_message.side_effect = ["4", "6", "8"]
+    replies = [concurrent.futures.Future() for _ in range(3)]
+    conversation._enqueue_message("What is 2+2?", replies[0])
+    consumer = conversation._consumer
+    conversation._enqueue_message("What is 3+3?", replies[1])
+    conversation._enqueue_message("What is 4+4?", replies[2])
+
+    await asyncio.wait_for(conversation.conversation_queue.join(), 1)
+
+    # Ensure a single consumer task handles all queued messages
+    assert conversation._consumer is consumer
+    # Ensure agent.send_message is called with the messages, in order
+    assert conversation.agent.send_message.await_args_list == [
+        call(conversation._conversation_id, "What is 2+2?",
+             channel=None, weight=1.0, on_chunk=None, model=None, client=None),
+        call(conversation._conversation_id, "What is 3+3?",
+             channel=None, weight=1.0, on_chunk=None, model=None, client=None),
+        call(conversation._conversation_id, "What is 4+4?",
+             channel=None, weight=1.0, on_chunk=None, model=None, client=None),
+    ]
+    # Ensure each future resolves to its reply
+    assert [reply.result() for reply in replies] == ["4", "6", "8"]
+
+    # Ensure a failing message doesn't stop the consumer, and its error is
+    # set on the reply
+    conversation.agent.send_message.side_effect = [ValueError, "12"]
+    failed, replied = concurrent.futures.Future(), concurrent.futures.Future()
+    conversation._enqueue_message("What is 5+5?", failed)
+    conversation._enqueue_message("What is 6+6?", replied)
+    await asyncio.wait_for(conversation.conversation_queue.join(), 1)
+    assert isinstance(failed.exception(), ValueError)
+    assert replied.result() == "12"
+    assert not consumer.done()
+
+    # Ensure the conversation is marked dirty after each turn, with a flusher
+    conversation.flusher = Mock()
+    conversation.agent.send_message.side_effect = None
+    conversation._enqueue_message("What is 6+6?", concurrent.futures.Future())
+    await asyncio.wait_for(conversation.conversation_queue.join(), 1)
+    conversation.flusher.mark_dirty.assert_called_once_with(conversation)
+
+    # Ensure a cancelled message is skipped
+    cancelled = concurrent.futures.Future()
+    cancelled.cancel()
+    conversation._enqueue_message("What is 7+7?", cancelled)
+    await asyncio.wait_for(conversation.conversation_queue.join(), 1)
+    conversation.agent.send_message.assert_awaited_with(
+        conversation._conversation_id, "What is 6+6?",
+        channel=None, weight=1.0, on_chunk=None, model=None, client=None)
+
+    consumer.cancel()
 
 
 @pytest.mark.asyncio(loop_scope="module")
-async def test__consume_message(conversation):
-    """Test _consume_message method of Conversation class
+async def test__consume_message_coalesce(conversation):
+    """Test _consume_message method of Conversation class coalescing pending messages
+
+    Args:
+        conversation (Conversation): Conversation object
+    """
+
+    conversation.event_loop = asyncio.get_running_loop()
+    conversation.coalesce, conversation.linger = 3, 0.05
+    conversation.agent.send_messages = AsyncMock(return_value="4, 6 and 8")
+    conversation.agent.send_message.side_effect = ["10"]
+    chunks = []
+    replies = [concurrent.futures.Future() for _ in range(4)]
+    replies[1].cancel()
+    for number, reply in enumerate(replies):
+        conversation._enqueue_message(
+            f"What is {number}+{number}?", reply, chunks.append if number == 0 else None)
+    await asyncio.wait_for(conversation.conversation_queue.join(), 1)
+
+    # Ensure up to coalesce pending messages are sent as a single turn,
+    # skipping cancelled ones
+    conversation.agent.send_messages.assert_awaited_once()
+    args, kwargs = conversation.agent.send_messages.await_args
+    assert args == (
+        conversation._conversation_id, [
+            "What is 0+0?", "What is 2+2?"])
+    assert kwargs["channel"] is None and kwargs["weight"] == 1.0
+    kwargs["on_chunk"]("4")
+    assert chunks == ["4"]
+    assert [
+        reply.result() for reply in [
+            replies[0],
+            replies[2]]] == ["4, 6 and 8"] * 2
+    # Ensure a single message left is sent on its own
+    assert replies[3].result() == "10"
+    conversation.agent.send_message.assert_awaited_with(
+        conversation._conversation_id, "What is 3+3?",
+        channel=None, weight=1.0, on_chunk=None, model=None, client=None)
+    conversation.agent.send_messages.reset_mock()
+
+    # Ensure messages arriving within the linger window join the turn
+    conversation.agent.send_messages.return_value = "12 and 14"
+    late = [concurrent.futures.Future() for _ in range(2)]
+    conversation._enqueue_message("What is 6+6?", late[0])
+    conversation.event_loop.call_later(
+        0.01, conversation._enqueue_message, "What is 7+7?", late[1])
+    await asyncio.wait_for(asyncio.wrap_future(late[1]), 1)
+    conversation.agent.send_messages.assert_awaited_once()
+    assert late[0].result() == "12 and 14"
+    await conversation._close()
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_asend(conversation):
+    """Test asend method of Conversation class
+
+    Args:
+        conversation (Conversation): Conversation object
+    """
+
+    def reply(callback, message, future, on_chunk):
+        future.set_running_or_notify_cancel()
+        future.set_result("4")
+
+    conversation.event_loop.call_soon_threadsafe.side_effect = reply
+
+    # Ensure the assistant reply is returned once available
+    assert await conversation.asend("What is 2+2?") == "4"
+
+
+@pytest.mark.asyncio(loop_scope="module")
+async def test_astream(conversation):
+    """Test astream method of Conversation class
 
     Args:
         conversation (Conversation): Conversation object
     """
 
-    conversation.conversation_queue = Queue()
-    conversation.conversation_queue.put("What is 2+2?")
-    await conversation._consume_message()
-    # Ensure agent.send_message is called with the correct arguments
-    conversation.agent.send_message.assert_called_once_with(
-        conversation._conversation_id, "What is 2+2?")
-
-    conversation.conversation_queue.put("What is 3+3?")
-    conversation.conversation_queue_lock.acquire()
-    # Ensure agent.send_message is not called since lock not acquired
-
-    lock_acquire_delay = Conversation.LOCK_ACQUIRE_DELAY
-    Conversation.LOCK_ACQUIRE_DELAY = 0
-    try:
-        await conversation._consume_message()
-    except Exception as e:
-        assert isinstance(e, RecursionError)
-    Conversation.LOCK_ACQUIRE_DELAY = lock_acquire_delay
-
-    # Ensure agent.send_message is called with the correct arguments after
-    # lock is released
-    conversation.conversation_queue_lock.release()
-    await conversation._consume_message()
-    conversation.agent.send_message.assert_called_with(
-        conversation._conversation_id, "What is 3+3?")
+    async def send_message(conversation_id, message, on_chunk, **kwargs):
+        for chunk in ["2 + 2", " = ", "4"]:
+            on_chunk(chunk)
+        return "2 + 2 = 4"
+
+    conversation.event_loop = asyncio.get_running_loop()
+    conversation.agent.send_message.side_effect = send_message
+
+    # Ensure the chunks are iterated in order, then the iteration ends
+    assert [chunk async for chunk in conversation.astream("What is 2+2?")] == [
+        "2 + 2", " = ", "4"]
+    assert conversation.last_reply.result() == "2 + 2 = 4"
+
+    # Ensure the error of a failed reply is raised once the chunks are
+    # iterated
+    conversation.agent.send_message.side_effect = ValueError
+    with pytest.raises(ValueError):
+        async for _ in conversation.astream("What is 2+2?"):
+            pass
+    await conversation._close()
 
 
 def test_get_messages(conversation):
@@ -91,3 +206,86 @@ def test_get_messages(conversation):
     """
     conversation.get_messages()
     conversation.agent.get_messages.assert_called_once()
+
+
+def test_store(conversation, tmp_path):
+    """Test store method of Conversation class
+
+    Args:
+        conversation (Conversation): conversation object
+    """
+    conversation.db = DB(str(tmp_path / "conversations.db"))
+    conversation.db.store(1, ["stale", "messages", "to replace"])
+    history = ChatMessageHistory(
+        messages=[HumanMessage("What is 2+2?"), AIMessage("4")])
+    conversation.agent.get_messages.return_value = history
+
+    # Ensure the first store replaces previously stored messages
+    conversation.store()
+    assert [message for _, message in conversation.db.retrieve(1)] == \
+        Agent.dump_messages(history.messages)
+
+    # Ensure only new messages are written afterwards
+    history.add_user_message("Add 4 to the previous result")
+    with patch.object(conversation.db, "store_many") as store_many:
+        conversation.store()
+    store_many.assert_called_once_with(
+        [(1, Agent.dump_messages(history.messages[2:]), 2, False)])
+
+    # Ensure a message appended while the store serializes is stored next
+    dump = Agent.dump_messages
+
+    def dump_messages(messages):
+        history.add_ai_message("8")
+        return dump(messages)
+    with patch("erdos.agent.Agent.dump_messages", dump_messages):
+        conversation.store()
+    with patch.object(conversation.db, "store_many") as store_many:
+        conversation.store()
+    store_many.assert_called_once_with(
+        [(1, Agent.dump_messages([AIMessage("8")]), 3, False)])
+
+
+def test_retrieve(conversation, tmp_path):
+    """Test retrieve method of Conversation class
+
+    Args:
+        conversation (Conversation): conversation object
+    """
+    conversation.db = DB(str(tmp_path / "conversations.db"))
+    conversation.db.store(1, ["a", "b", "c"])
+    conversation.agent.get_messages.return_value = ChatMessageHistory(
+        messages=Agent.load_messages(Agent.dump_messages([AIMessage("c")])))
+
+    # Ensure the tail window is added to the session history
+    conversation.retrieve(last=1)
+    conversation.agent.add_to_session_history.assert_called_once_with(
+        1, ["c"])
+
+    # Ensure new messages are stored after the last stored one
+    conversation.agent.get_messages.return_value.add_user_message("d")
+    with patch.object(conversation.db, "store_many") as store_many:
+        conversation.store()
+    store_many.assert_called_once_with(
+        [(1, Agent.dump_messages([HumanMessage("d")]), 3, False)])
+
+
+@pytest.mark.asyncio
+async def test_astore_aretrieve(conversation, tmp_path):
+    """Test astore and aretrieve methods of Conversation class
+
+    Args:
+        conversation (Conversation): conversation object
+    """
+    conversation.db = DB(str(tmp_path / "conversations.db"))
+    conversation.agent.get_messages.return_value = ChatMessageHistory(
+        messages=[HumanMessage("What is 2+2?"), AIMessage("4")])
+
+    # Ensure concurrent stores of the conversation write its messages once
+    await asyncio.gather(conversation.astore(), conversation.astore())
+    assert [message for _, message in conversation.db.retrieve(1)] == \
+        Agent.dump_messages(conversation.get_messages().messages)
+
+    await conversation.aretrieve(last=1)
+    conversation.agent.add_to_session_history.assert_called_once_with(
+        1, Agent.dump_messages([AIMessage("4")]))
@@ -1,42 +1,226 @@
-from erdos.db import DB
+import asyncio
+import json
+import pytest
 import sqlite3
+import threading
+from unittest.mock import patch
+from erdos.db import DB, zstandard
+from erdos.metrics import MetricsRegistry
 
 
-def test_store():
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path / "conversations.db"))
+    yield db
+    db.close()
+
+
+def test_store(db):
     """Test if the store method inserts and updates correctly."""
-    DB._init_conversations_tbl()
 
-    # Store a conversation
-    DB.store(1, "Hello, World!")
+    # Store messages of a conversation
+    db.store(1, ["Hello", "World!"])
+
+    # Verify the records
+    with sqlite3.connect(db.path) as conn:
+        rows = conn.execute(
+            "SELECT seq, message FROM messages WHERE conversation_id = ?",
+            (1,)).fetchall()
+
+    assert [(seq, DB.decode(message)) for seq, message in rows] == [
+        (0, "Hello"), (1, "World!")]
 
-    # Verify the record
-    with sqlite3.connect(".conversations.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT conversation FROM conversations WHERE conversation_id = ?", (1,))
-        row = cursor.fetchone()
+    # Append a message, and overwrite one
+    db.store(1, ["Goodbye", "World!"], start=1)
 
-    DB.store(1, "Goodbye, World!")
+    # Verify the updated records
+    with sqlite3.connect(db.path) as conn:
+        rows = conn.execute(
+            "SELECT seq, message FROM messages WHERE conversation_id = ?",
+            (1,)).fetchall()
 
-    # Verify the updated record
-    with sqlite3.connect(".conversations.db") as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT conversation FROM conversations WHERE conversation_id = ?", (1,))
-        row = cursor.fetchone()
+    assert [(seq, DB.decode(message)) for seq, message in rows] == [
+        (0, "Hello"), (1, "Goodbye"), (2, "World!")]
 
-    assert row is not None
-    assert row[0] == "Goodbye, World!"
+    # Replace the conversation
+    db.store(1, ["Hi"], replace=True)
+    assert db.retrieve(1) == [(0, "Hi")]
 
 
-def test_retrieve_existing_record():
+def test_retrieve_existing_record(db):
     """Test if the retrieve method retrieves an existing record."""
-    DB._init_conversations_tbl()
 
-    # Store a conversation
-    DB.store(1, "Hello, World!")
+    # Store conversations
+    db.store(1, ["a", "b", "c", "d"])
+    db.store(2, ["e"])
 
     # Retrieve the conversation
-    conversation = DB.retrieve(1)
+    assert db.retrieve(1) == [(0, "a"), (1, "b"), (2, "c"), (3, "d")]
+    # Retrieve a tail window, a range, and a tail window within a range
+    assert db.retrieve(1, last=2) == [(2, "c"), (3, "d")]
+    assert db.retrieve(1, start=1, end=3) == [(1, "b"), (2, "c")]
+    assert db.retrieve(1, last=1, end=3) == [(2, "c")]
+    assert db.retrieve(3) == []
+
+    assert db.next_seq(1) == 4
+    assert db.next_seq(3) == 0
+
+
+def test_retrieve_many(db):
+    """Test if the retrieve_many method retrieves many conversations at once."""
+
+    db.store(1, ["a", "b", "c"])
+    db.store(2, ["d"])
+
+    assert db.conversation_ids() == [1, 2]
+    assert db.retrieve_many([1, 2, 3]) == {
+        1: [(0, "a"), (1, "b"), (2, "c")], 2: [(0, "d")]}
+    # Ensure tail windows are per conversation
+    assert db.retrieve_many([1, 2], last=2) == {
+        1: [(1, "b"), (2, "c")], 2: [(0, "d")]}
+
+    # Ensure ids are queried in chunks
+    with patch.object(DB, "MAX_IDS_PER_QUERY", 1):
+        assert db.retrieve_many([1, 2], last=1) == {
+            1: [(2, "c")], 2: [(0, "d")]}
+
+
+def test_init_conversations_tbl(tmp_path):
+    """Test if conversations stored in the legacy format are migrated."""
+
+    path = str(tmp_path / "legacy.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE conversations (conversation_id INTEGER PRIMARY KEY NOT NULL, "
+            "conversation TEXT)")
+        conn.execute(
+            "INSERT INTO conversations VALUES (?, ?)",
+            (1, json.dumps({"messages": [{"type": "human", "content": "Hi"}]})))
+    conn.close()
+
+    db = DB(path)
+    # Ensure messages are moved to the messages table
+    assert [json.loads(message) for _, message in db.retrieve(1)] == [
+        {"type": "human", "data": {"type": "human", "content": "Hi"}}]
+    assert db.connection().execute(
+        "SELECT name FROM sqlite_master WHERE name = 'conversations'").fetchone() is None
+    db.close()
+
+
+def test_storage_format(tmp_path):
+    """Test if messages are stored compressed, and read back whatever their format version."""
+
+    message = json.dumps({"type": "ai", "data": {"content": "2+2 = 4" * 20}})
+    for compression in ["none", "zlib"] + (["zstd"] if zstandard else []):
+        stored = DB.encode(message, compression)
+        assert stored[0] == DB.FORMAT_VERSION and DB.decode(stored) == message
+        if compression != "none":
+            assert len(stored) < len(message) / 4
+    # Ensure short messages aren't grown by compression
+    assert DB.encode("Hi") == bytes(
+        (DB.FORMAT_VERSION, DB.CODECS["none"])) + b"Hi"
+    with pytest.raises(ValueError):
+        DB.decode(bytes((DB.FORMAT_VERSION + 1, 0)) + b"Hi")
+
+    # Ensure messages stored as text are migrated once, and read back meanwhile
+    path = str(tmp_path / "text.db")
+    with sqlite3.connect(path) as conn:
+        conn.execute(
+            "CREATE TABLE messages (conversation_id INTEGER NOT NULL, seq INTEGER NOT NULL, "
+            "message TEXT NOT NULL, PRIMARY KEY (conversation_id, seq)) WITHOUT ROWID")
+        conn.executemany("INSERT INTO messages VALUES (?, ?, ?)",
+                         [(1, 0, message), (1, 1, "Hi"), (2, 0, message)])
+    conn.close()
+    assert DB.decode(message) == message
+    db = DB(path, compression="zlib")
+    # Ensure the codec of an open database can't be changed silently
+    assert DB(path) is db and DB(path, compression="zlib") is db
+    with pytest.raises(ValueError):
+        DB(path, compression="none")
+    assert db.retrieve(1) == [(0, message), (1, "Hi")]
+    assert db.retrieve(2, last=1) == [(0, message)]
+    conn = db.connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[
+        0] == DB.FORMAT_VERSION
+    assert conn.execute(
+        "SELECT COUNT(*) FROM messages WHERE typeof(message) = 'text'").fetchone()[0] == 0
+    db.close()
+
+
+def test_connection(db, tmp_path):
+    """Test if connections are kept per thread and per database path."""
+
+    conn = db.connection()
+    # Ensure the same connection is reused by the thread, in WAL mode
+    assert db.connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    # Ensure instances are shared per path
+    assert DB(db.path) is db
+    assert DB(str(tmp_path / "other.db")) is not db
+
+    # Ensure other threads get their own connection
+    connections = []
+    thread = threading.Thread(
+        target=lambda: connections.append(db.connection()))
+    thread.start()
+    thread.join()
+    assert connections[0] is not conn
+
+    # Ensure connections are reopened after closing
+    db.close()
+    assert db.connection() is not conn
+
+
+def test_metrics(db):
+    """Test if database operations are timed into the metrics registry."""
+
+    metrics, db.metrics = db.metrics, MetricsRegistry()
+    try:
+        db.store(1, ["Hi"])
+        db.retrieve(1)
+        db.retrieve(1, last=1)
+        histograms = db.metrics.snapshot()["histograms"]["erdos_db_seconds"]
+    finally:
+        db.metrics = metrics
+
+    assert {histogram["labels"]["op"]: histogram["count"] for histogram in histograms} == {
+        "store_many": 1, "retrieve": 2}
+
+
+@pytest.mark.asyncio
+async def test_async_db(db):
+    """Test if the async facade runs SQLite work on its thread, coalescing stores."""
+
+    aio = db.aio
+    assert db.aio is aio
+
+    # Ensure stores submitted while the thread is busy are written in a
+    # single transaction
+    busy = threading.Event()
+    aio.executor.submit(busy.wait)
+    with patch.object(db, "store_many", wraps=db.store_many) as store_many:
+        stores = asyncio.gather(aio.store(1, ["a", "b"]), aio.store(2, ["c"]),
+                                aio.store(1, ["d"], start=2))
+        await asyncio.sleep(0)
+        busy.set()
+        await stores
+    store_many.assert_called_once()
+
+    assert await aio.retrieve(1, last=2) == [(1, "b"), (2, "d")]
+    assert await aio.retrieve_many([1, 2]) == {
+        1: [(0, "a"), (1, "b"), (2, "d")], 2: [(0, "c")]}
+    # Ensure work runs on the database thread
+    assert await aio.run(lambda: threading.current_thread().name) != \
+        threading.current_thread().name
 
-    assert conversation == "Hello, World!"
+    # Ensure errors are raised to every caller of the batch
+    busy.clear()
+    aio.executor.submit(busy.wait)
+    with patch.object(db, "store_many", side_effect=sqlite3.OperationalError):
+        stores = asyncio.gather(aio.store(1, ["e"]), aio.store(2, ["f"]),
+                                return_exceptions=True)
+        await asyncio.sleep(0)
+        busy.set()
+        results = await stores
+    assert all(isinstance(result, sqlite3.OperationalError)
+               for result in results)
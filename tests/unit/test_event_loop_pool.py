@@ -0,0 +1,68 @@
+import asyncio
+import pytest
+from unittest.mock import patch
+from erdos.event_loop_pool import EventLoopPool
+
+
+@pytest.fixture
+def pool():
+    pool = EventLoopPool(2)
+    yield pool
+    pool.close()
+
+
+def test_get_loop(pool):
+    """Test get_loop method of EventLoopPool class
+
+    Args:
+        pool (EventLoopPool): event loop pool
+    """
+
+    loops = [pool.get_loop(key) for key in range(4)]
+
+    # Ensure keys are sharded onto a bounded number of running loops
+    assert loops[0] is loops[2] and loops[1] is loops[3]
+    assert loops[0] is not loops[1]
+    assert all(loop.is_running() for loop in loops)
+    assert asyncio.run_coroutine_threadsafe(
+        asyncio.sleep(0, "done"), loops[0]).result(1) == "done"
+
+
+@patch('erdos.event_loop_pool.EventLoopPool.start_event_loop')
+@patch('threading.Thread')
+def test_get_loop_thread(Thread, start_event_loop, pool):
+    """Test get_loop method of EventLoopPool class starts loops in daemon threads
+
+    Args:
+        pool (EventLoopPool): event loop pool
+    """
+
+    loop = pool.get_loop(0)
+
+    assert isinstance(loop, asyncio.AbstractEventLoop)
+    # Ensure thread is created with the correct arguments
+    Thread.assert_called_once_with(
+        target=start_event_loop, args=(
+            loop,), daemon=True)
+    # Ensure the loop is started only once
+    pool.get_loop(2)
+    Thread.assert_called_once()
+    pool._loops = [None] * pool.size
+
+
+def test_close(pool):
+    """Test close method of EventLoopPool class
+
+    Args:
+        pool (EventLoopPool): event loop pool
+    """
+
+    loop = pool.get_loop(0)
+    thread = pool._threads[0]
+    pool.close()
+
+    # Ensure loops and threads are stopped, and started again on next use
+    assert loop.is_closed()
+    assert not thread.is_alive()
+    assert pool.get_loop(0) is not loop
+    assert EventLoopPool.default() is EventLoopPool.default()
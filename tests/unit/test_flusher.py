@@ -0,0 +1,124 @@
+import pytest
+import time
+from unittest.mock import patch, Mock
+from erdos.conversation import Conversation
+from erdos.db import DB
+from erdos.flusher import Flusher
+from langchain_community.chat_message_histories import ChatMessageHistory
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = DB(str(tmp_path / "conversations.db"))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def conversations(db):
+    with patch("erdos.agent.Agent.instance") as agent:
+        conversations = []
+        for conversation_id in (1, 2, 3):
+            conversation = Conversation(conversation_id, Mock(), '1', db=db)
+            conversation.agent = Mock()
+            conversation.agent.get_messages.return_value = ChatMessageHistory()
+            conversation.agent.get_messages.return_value.add_user_message(
+                f"Hello {conversation_id}")
+            conversations.append(conversation)
+        yield conversations
+
+
+def wait_until(predicate, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_flush(db, conversations):
+    """Test flush method of Flusher class
+
+    Args:
+        db (DB): database object
+        conversations (list[Conversation]): conversation objects
+    """
+    flusher = Flusher(db, flush_interval=60)
+    for conversation in conversations:
+        flusher.mark_dirty(conversation)
+
+    # Ensure all dirty conversations are stored in a single transaction
+    with patch.object(db, "store_many", wraps=db.store_many) as store_many:
+        flusher.flush()
+    store_many.assert_called_once()
+    assert len(
+        db.retrieve(1)) == len(
+        db.retrieve(2)) == len(
+            db.retrieve(3)) == 1
+
+    # Ensure only conversations marked dirty since are stored, with their new
+    # messages
+    conversations[0].get_messages().add_ai_message("Hi")
+    flusher.mark_dirty(conversations[0])
+    with patch.object(db, "store_many", wraps=db.store_many) as store_many:
+        flusher.flush()
+    [(conversation_id, messages, start, replace)] = store_many.call_args[0][0]
+    assert (conversation_id, len(messages), start, replace) == (1, 1, 1, False)
+    assert len(db.retrieve(1)) == 2
+
+    flusher.close()
+
+
+def test_flush_triggers(db, conversations):
+    """Test batches of dirty conversations are flushed on size and on time
+
+    Args:
+        db (DB): database object
+        conversations (list[Conversation]): conversation objects
+    """
+    flusher = Flusher(db, flush_interval=60, flush_batch_size=2)
+    flusher.mark_dirty(conversations[0])
+    time.sleep(0.05)
+    assert db.retrieve(1) == []
+
+    # Ensure a full batch is flushed right away
+    flusher.mark_dirty(conversations[1])
+    assert wait_until(lambda: len(db.retrieve(2)) == 1)
+    assert len(db.retrieve(1)) == 1
+
+    # Ensure a dirty conversation is flushed once the interval elapses
+    flusher.flush_interval = 0.05
+    conversations[2].get_messages().add_ai_message("Hi")
+    flusher.mark_dirty(conversations[2])
+    assert wait_until(lambda: len(db.retrieve(3)) == 2)
+
+    flusher.close()
+
+
+def test_flush_failure(db, conversations):
+    """Test conversations stay dirty when they can't be stored
+
+    Args:
+        db (DB): database object
+        conversations (list[Conversation]): conversation objects
+    """
+    flusher = Flusher(db, flush_interval=60)
+    flusher.mark_dirty(conversations[0])
+
+    with patch.object(db, "store_many", side_effect=Exception):
+        with pytest.raises(Exception):
+            flusher.flush()
+
+    # Ensure the conversation is stored by the next flush
+    flusher.close()
+    assert len(db.retrieve(1)) == 1
+
+    # Ensure the background thread backs off while flushes fail, rather than
+    # retrying a full batch at once
+    flusher = Flusher(db, flush_interval=0.05, flush_batch_size=1)
+    with patch.object(db, "store_many", side_effect=Exception) as store_many, \
+            patch("erdos.flusher.logger"):
+        flusher.mark_dirty(conversations[1])
+        time.sleep(0.5)
+    assert 2 <= store_many.call_count <= 5
+    flusher.close()
+    assert len(db.retrieve(2)) == 1
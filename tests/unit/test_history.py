@@ -0,0 +1,169 @@
+import asyncio
+import os
+import pytest
+from erdos.db import DB
+from erdos.history import CompactHistory, HistoryStore
+from langchain_community.chat_message_histories import ChatMessageHistory
+from langchain_core.messages import AIMessage, ChatMessage, HumanMessage, SystemMessage
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    db_path = str(tmp_path / "histories.db")
+    yield db_path
+    DB(db_path).close()
+
+
+def history(content: str) -> ChatMessageHistory:
+    return ChatMessageHistory(messages=[HumanMessage(content=content),
+                                        AIMessage(content=content)])
+
+
+def test_eviction(db_path):
+    """Test that HistoryStore evicts the least recently used histories beyond capacity, and
+    reloads them transparently
+    """
+    store = HistoryStore(capacity=2, db_path=db_path)
+    store[1], store[2] = history("one"), history("two")
+    # Using 1 makes 2 the least recently used
+    assert store[1].messages[0].content == "one"
+    store[3] = history("three")
+
+    assert store.stats() == {"resident": 2, "evicted": 1,
+                             "resident_bytes": (HistoryStore.size(history("one"))
+                                                + HistoryStore.size(history("three"))),
+                             "evictions": 1, "reloads": 0}
+    assert 2 in store and len(store) == 3 and set(store) == {1, 2, 3}
+
+    # Ensure the evicted history is reloaded unchanged, evicting 1 in turn
+    assert store[2].messages == history("two").messages
+    assert store.stats()["evictions"] == 2
+    assert store.stats()["reloads"] == 1
+    # Ensure the history taken back before its write completed isn't left in
+    # the database
+    store.db.aio.executor.submit(lambda: None).result()
+    assert DB(db_path).pop_evicted_history(2) is None
+
+    del store[1]
+    assert 1 not in store and len(store) == 2
+    with pytest.raises(KeyError):
+        store[1]
+
+
+def test_max_bytes(db_path):
+    """Test that HistoryStore evicts histories beyond max_bytes, always keeping the one in use
+    """
+    size = HistoryStore.size(history("x" * 100))
+    store = HistoryStore(max_bytes=size, db_path=db_path)
+    store[1] = history("x" * 100)
+    store[2] = history("x" * 1000)
+
+    assert store.stats()["resident"] == 1
+    assert store.stats()["evicted"] == 1
+
+    # Ensure histories growing in place are accounted for on access
+    store[2].add_user_message("y" * 1000)
+    assert store[2].messages[-1].content == "y" * 1000
+    assert store.stats()["resident_bytes"] == HistoryStore.size(store[2])
+
+
+def test_pinned(db_path):
+    """Test that HistoryStore doesn't evict pinned histories
+    """
+    store = HistoryStore(capacity=1, db_path=db_path)
+    with store.pinned(1):
+        store[1] = history("one")
+        store[2] = history("two")
+        assert store.stats()["resident"] == 2
+
+    # Ensure the store is back within capacity once unpinned
+    assert store.stats()["resident"] == 1
+    assert store.stats()["evicted"] == 1
+
+
+def test_on_discard(db_path):
+    """Test that HistoryStore calls on_discard for the histories deleted, replaced or evicted
+    """
+    discarded = []
+    store = HistoryStore(capacity=1, db_path=db_path,
+                         on_discard=discarded.append)
+    store[1] = history("one")
+    store[1] = history("uno")
+    store[2] = history("two")
+    del store[2]
+    del store[1]
+    assert discarded == [1, 1, 2, 1]
+    with pytest.raises(KeyError):
+        del store[1]
+    assert discarded == [1, 1, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_aget(db_path):
+    """Test that HistoryStore loads an evicted history back once for concurrent accesses
+    """
+    store = HistoryStore(capacity=1, db_path=db_path)
+    store[1], store[2] = history("one"), history("two")
+    store.db.aio.executor.submit(lambda: None).result()
+
+    first, second = await asyncio.gather(store.aget(1), store.aget(1))
+    assert first is second and first.messages == history("one").messages
+    assert store.stats()["reloads"] == 1
+    assert store[1] is first
+    with pytest.raises(KeyError):
+        await store.aget(3)
+
+
+def test_close():
+    """Test that HistoryStore deletes its temporary database on close
+    """
+    store = HistoryStore(capacity=1)
+    store[1], store[2] = history("one"), history("two")
+    path = store.db.path
+    assert os.path.exists(path)
+
+    store.close()
+    assert not os.path.exists(path)
+    assert 1 not in store and 2 in store
+
+
+def test_compact_history():
+    """Test that CompactHistory class keeps the transcript of its messages rendered
+    """
+    history = CompactHistory(
+        [HumanMessage(content="What is 2+2?"), AIMessage(content="4")])
+    history.add_messages(
+        [HumanMessage(content="Add 1"), AIMessage(content="5")])
+    assert history.transcript() == "Human: What is 2+2?\nAi: 4\nHuman: Add 1\nAi: 5"
+    assert history.transcript(2) == "Human: Add 1\nAi: 5"
+    # Ensure the transcript renders as the messages' lines
+    assert history.transcript() == "\n".join(
+        map(CompactHistory.line, history.messages))
+
+    # Ensure windows reuse the transcript for the messages ending the history,
+    # and render the others
+    summary = SystemMessage(content="Summary")
+    window = [summary, history.messages[1]] + history.messages[3:]
+    assert history.render(window) == "System: Summary\nAi: 4\nAi: 5"
+    assert history.render(history.messages[-2:]) == "Human: Add 1\nAi: 5"
+    assert history.render([]) == ""
+
+    # Ensure messages are stored as compact records, and built back alike
+    # once released
+    messages = history.messages
+    history.release()
+    assert history.messages == messages and history.messages is not messages
+    assert HistoryStore.size(history) == 19 + 4 * CompactHistory.MESSAGE_OVERHEAD + len(
+        history.transcript()) + 4 * CompactHistory.RECORD_OVERHEAD
+    history.release()
+    assert HistoryStore.size(history) == 44 + 4 * \
+        CompactHistory.RECORD_OVERHEAD
+    # Ensure the fields of messages besides their type and text content are
+    # kept
+    extra = [ChatMessage(content="Hi\nthere", role="user"),
+             AIMessage(content=[{"type": "text", "text": "4"}], id="run-1")]
+    history.add_messages(extra)
+    history.release()
+    assert history.messages == messages + extra
+    history.clear()
+    assert history.transcript() == "" and HistoryStore.size(history) == 0
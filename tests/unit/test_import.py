@@ -0,0 +1,29 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(
+    os.path.dirname(
+        os.path.dirname(
+            os.path.abspath(__file__))))
+
+
+def test_import(tmp_path):
+    """Test that importing erdos is free of side effects and leaves the LLM stack unloaded
+    """
+    script = (
+        "import json, sys\n"
+        "import erdos\n"
+        "from erdos.channel import Channel\n"
+        "assert erdos.Channel is Channel\n"
+        "print(json.dumps(sorted(m for m in sys.modules\n"
+        "                        if m.split('.')[0] in ('langchain', 'langchain_openai',\n"
+        "                                               'langchain_community', 'openai'))))\n")
+    output = subprocess.run(
+        [sys.executable, "-c", script], cwd=tmp_path, capture_output=True, text=True,
+        check=True, env=dict(os.environ, PYTHONPATH=ROOT)).stdout
+    # Ensure the LLM clients are only imported once an agent is created
+    assert json.loads(output) == []
+    # Ensure no database nor other file was created
+    assert os.listdir(tmp_path) == []
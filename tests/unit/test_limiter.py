@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+import threading
+import time
+from erdos.limiter import RateLimiter
+
+
+@pytest.mark.asyncio
+async def test_max_concurrent():
+    """Test calls beyond max_concurrent wait, and are granted in order
+    """
+    limiter = RateLimiter(max_concurrent=2)
+    release = asyncio.Event()
+    granted = []
+
+    async def call(i):
+        async with limiter.slot():
+            granted.append(i)
+            await release.wait()
+
+    calls = [asyncio.create_task(call(i)) for i in range(4)]
+    await asyncio.sleep(0.01)
+    assert granted == [0, 1]
+    assert limiter.stats()["in_flight"] == 2
+    assert limiter.stats()["queue_depth"] == 2
+
+    release.set()
+    await asyncio.gather(*calls)
+    assert granted == [0, 1, 2, 3]
+    stats = limiter.stats()
+    assert (stats["in_flight"], stats["queue_depth"],
+            stats["acquired"]) == (0, 0, 4)
+    assert stats["max_wait"] > 0
+
+
+@pytest.mark.asyncio
+async def test_tokens_per_minute():
+    """Test calls wait for the tokens bucket to refill
+    """
+    limiter = RateLimiter(tokens_per_minute=600)
+
+    start = time.monotonic()
+    async with limiter.slot(600):
+        pass
+    # Ensure the bucket refills at 10 tokens per second
+    async with limiter.slot(3):
+        pass
+    assert 0.2 < time.monotonic() - start < 1
+
+    # Ensure tokens used beyond the estimate are charged
+    limiter.adjust(3)
+    assert limiter._tokens < 0
+
+
+@pytest.mark.asyncio
+async def test_requests_per_minute():
+    """Test calls wait for the requests bucket to refill
+    """
+    limiter = RateLimiter(requests_per_minute=600)
+    limiter._requests = 0
+
+    start = time.monotonic()
+    async with limiter.slot():
+        pass
+    assert 0.05 < time.monotonic() - start < 1
+
+
+@pytest.mark.asyncio
+async def test_cancel():
+    """Test cancelled waiters leave the queue
+    """
+    limiter = RateLimiter(max_concurrent=1)
+    await limiter.acquire()
+
+    waiter = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert limiter.stats()["queue_depth"] == 1
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert limiter.stats()["queue_depth"] == 0
+
+    # Ensure the slot goes to the next waiter
+    limiter.release()
+    await asyncio.wait_for(limiter.acquire(), 1)
+
+
+def test_event_loops():
+    """Test the limiter is shared by calls on different event loops
+    """
+    limiter = RateLimiter(max_concurrent=1)
+    held, granted = threading.Event(), threading.Event()
+
+    async def hold():
+        await limiter.acquire()
+        held.set()
+        await asyncio.sleep(0.1)
+        limiter.release()
+
+    async def wait():
+        held.wait()
+        await limiter.acquire()
+        granted.set()
+        limiter.release()
+
+    threads = [threading.Thread(target=asyncio.run, args=(coroutine,))
+               for coroutine in (hold(), wait())]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert granted.is_set()
+    assert limiter.stats()["acquired"] == 2
+
+
+@pytest.mark.asyncio
+async def test_headroom():
+    """Test headroom method of RateLimiter class
+    """
+    assert RateLimiter().headroom() == 1.0
+    limiter = RateLimiter(max_concurrent=4, tokens_per_minute=1000)
+    await limiter.acquire(100)
+    # Ensure the tightest limit is reported
+    assert limiter.headroom() == pytest.approx(0.75)
+    limiter.adjust(400)
+    assert limiter.headroom() == pytest.approx(0.5, abs=0.01)
+    limiter.release()
@@ -0,0 +1,75 @@
+import json
+import pytest
+from erdos.metrics import MetricsRegistry
+
+
+def test_counters_gauges():
+    """Test inc and add methods of MetricsRegistry class
+    """
+    metrics = MetricsRegistry()
+    metrics.inc("requests_total", result="hit")
+    metrics.inc("requests_total", 2, result="hit")
+    metrics.inc("requests_total", result="miss", channel=None)
+    metrics.add("queue_depth", 3, channel="premium")
+    metrics.add("queue_depth", -1, channel="premium")
+
+    snapshot = metrics.snapshot()
+    # Ensure labels set to None are left out
+    assert snapshot["counters"]["requests_total"] == [
+        {"labels": {"result": "hit"}, "value": 3},
+        {"labels": {"result": "miss"}, "value": 1}]
+    assert snapshot["gauges"]["queue_depth"] == [
+        {"labels": {"channel": "premium"}, "value": 2}]
+
+    metrics.reset()
+    assert metrics.snapshot() == {
+        "counters": {},
+        "gauges": {},
+        "histograms": {}}
+
+
+def test_histograms_spans():
+    """Test observe and span methods of MetricsRegistry class
+    """
+    spans = []
+    metrics = MetricsRegistry(tracer=spans.append)
+    metrics.observe("llm_seconds", 0.003, model="gpt-4")
+    metrics.observe("llm_seconds", 0.7, model="gpt-4")
+    with metrics.span("llm_seconds", model="gpt-4"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.span("db_seconds", op="store"):
+            raise ValueError
+
+    [histogram] = metrics.snapshot()["histograms"]["llm_seconds"]
+    assert histogram["count"] == 3
+    assert histogram["sum"] >= 0.703
+    # Ensure bucket counts are cumulative
+    assert histogram["buckets"]["0.005"] == 2
+    assert histogram["buckets"]["1"] == 3
+    assert histogram["buckets"]["+Inf"] == 3
+
+    # Ensure spans are reported to the tracer once they end
+    assert [(span["name"], span["labels"], span["error"]) for span in spans] == [
+        ("llm_seconds", {"model": "gpt-4"}, None),
+        ("db_seconds", {"op": "store"}, "ValueError")]
+    assert all(span["duration"] >= 0 for span in spans)
+
+
+def test_exposition():
+    """Test prometheus and json methods of MetricsRegistry class
+    """
+    metrics = MetricsRegistry()
+    metrics.inc("errors_total", kind='time"out')
+    metrics.add("queue_depth", 1)
+    metrics.observe("turn_seconds", 0.2, channel="bulk")
+
+    text = metrics.prometheus()
+    assert '# TYPE errors_total counter\nerrors_total{kind="time\\"out"} 1\n' in text
+    assert "# TYPE queue_depth gauge\nqueue_depth 1\n" in text
+    assert 'turn_seconds_bucket{channel="bulk",le="0.1"} 0\n' in text
+    assert 'turn_seconds_bucket{channel="bulk",le="0.25"} 1\n' in text
+    assert 'turn_seconds_count{channel="bulk"} 1\n' in text
+
+    assert json.loads(metrics.json()) == metrics.snapshot()
+    assert MetricsRegistry.default() is MetricsRegistry.default()
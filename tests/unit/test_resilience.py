@@ -0,0 +1,143 @@
+import asyncio
+import pickle
+import pytest
+from erdos.backend import FakeBackendError
+from erdos.metrics import MetricsRegistry
+from erdos.resilience import (CircuitBreaker, CircuitOpenError, LLMError, LLMTimeoutError,
+                              ResilientModel, RetryPolicy)
+from langchain_core.runnables import RunnableGenerator, RunnableLambda
+
+
+def flaky(delays: list, errors: list = ()) -> tuple[RunnableLambda, list]:
+    """Model answering its nth call after delays[n] seconds, or raising errors[n]"""
+    calls = []
+
+    async def call(prompt: str) -> str:
+        position = len(calls)
+        calls.append(prompt)
+        await asyncio.sleep(delays[position])
+        if position < len(errors) and errors[position]:
+            raise errors[position]
+        return f"Answer {position}"
+    return RunnableLambda(call), calls
+
+
+@pytest.mark.asyncio
+async def test_retry():
+    """Test retries of ResilientModel class
+    """
+    metrics = MetricsRegistry()
+    policy = RetryPolicy(attempt_timeout=0.05, backoff=0.01, seed=0)
+    llm, calls = flaky(
+        [0, 0, 0], [FakeBackendError("down"), FakeBackendError("down")])
+    model = ResilientModel(llm, "gpt-4", policy, metrics=metrics)
+    # Ensure transient errors are retried
+    assert await model.ainvoke("What is 2+2?") == "Answer 2"
+    assert metrics.snapshot()["counters"]["erdos_llm_retries_total"] == [
+        {"labels": {"model": "gpt-4"}, "value": 2}]
+
+    # Ensure other errors fail the call at once
+    llm, calls = flaky([0, 0], [ValueError("bad request")])
+    with pytest.raises(LLMError) as error:
+        await ResilientModel(llm, "gpt-4", policy, metrics=metrics).ainvoke("What is 2+2?")
+    assert error.value.kind == "error" and error.value.attempts == 1
+    assert isinstance(error.value.__cause__, ValueError) and len(calls) == 1
+
+    # Ensure hung attempts time out, and the call fails after max_attempts
+    llm, calls = flaky([1, 1, 1, 1])
+    with pytest.raises(LLMTimeoutError) as error:
+        await ResilientModel(llm, "gpt-4", policy, metrics=metrics).ainvoke("What is 2+2?")
+    assert error.value.kind == "timeout" and error.value.attempts == 3 and len(
+        calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    """Test CircuitBreaker class failing calls fast while the model is down
+    """
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+    policy = RetryPolicy(max_attempts=1)
+    llm, calls = flaky([0] * 4, [FakeBackendError("down")] * 2)
+    model = ResilientModel(llm, "gpt-4", policy, breaker, MetricsRegistry())
+    for _ in range(2):
+        with pytest.raises(LLMError):
+            await model.ainvoke("What is 2+2?")
+    # Ensure the open circuit rejects calls without sending them
+    with pytest.raises(CircuitOpenError) as error:
+        await model.ainvoke("What is 2+2?")
+    assert error.value.kind == "circuit_open" and len(calls) == 2
+    assert breaker.stats() == {
+        "state": "open",
+        "failures": 2,
+        "opened": 1,
+        "rejected": 1}
+
+    # Ensure a successful probe closes the circuit
+    await asyncio.sleep(0.1)
+    assert await model.ainvoke("What is 2+2?") == "Answer 2"
+    assert breaker.state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_hedge():
+    """Test hedged requests of ResilientModel class
+    """
+    metrics = MetricsRegistry()
+    policy = RetryPolicy(hedge_percentile=95, hedge_min_samples=1)
+    # Ensure no request is hedged before latencies are recorded
+    assert policy.hedge_delay("gpt-4") is None
+    policy.record_latency("gpt-4", 0.02)
+    assert policy.hedge_delay("gpt-4") == 0.02
+
+    llm, calls = flaky([1, 0])
+    model = ResilientModel(llm, "gpt-4", policy, metrics=metrics)
+    # Ensure the hedged request answers in place of the slow one
+    assert await asyncio.wait_for(model.ainvoke("What is 2+2?"), 0.5) == "Answer 1"
+    assert len(calls) == 2
+    assert metrics.snapshot(
+    )["counters"]["erdos_llm_hedges_total"][0]["value"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stream():
+    """Test that ResilientModel class retries streams until their first chunk only
+    """
+    attempts = []
+
+    async def stream(prompts):
+        async for _ in prompts:
+            pass
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise FakeBackendError("down")
+        yield "Answer "
+        if len(attempts) == 2:
+            raise FakeBackendError("down")
+        yield "4"
+
+    model = ResilientModel(RunnableGenerator(stream), "gpt-4",
+                           RetryPolicy(backoff=0.01), metrics=MetricsRegistry())
+    # Ensure errors before the first chunk are retried, and errors after it fail
+    # the call without repeating the chunks
+    chunks = []
+    with pytest.raises(LLMError):
+        async for chunk in model.astream("What is 2+2?"):
+            chunks.append(chunk)
+    assert chunks == ["Answer "] and len(attempts) == 2
+    assert [chunk async for chunk in model.astream("What is 2+2?")] == ["Answer ", "4"]
+
+
+def test_llm_error_pickle():
+    """Test that LLMError class keeps its attributes across processes
+    """
+    error = pickle.loads(
+        pickle.dumps(
+            LLMTimeoutError(
+                "timed out",
+                "gpt-4",
+                attempts=3)))
+    assert isinstance(error, LLMTimeoutError) and str(error) == "timed out"
+    assert (error.model, error.kind, error.attempts) == ("gpt-4", "timeout", 3)
+    # Ensure transient errors are told apart by class name and status code
+    assert RetryPolicy.is_retryable(FakeBackendError())
+    assert not RetryPolicy.is_retryable(ValueError())
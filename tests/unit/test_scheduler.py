@@ -0,0 +1,88 @@
+import asyncio
+import pytest
+from erdos.scheduler import WeightedFairScheduler
+
+
+@pytest.mark.asyncio
+async def test_weighted_fair_dispatch():
+    """Test competing channels are dispatched in proportion to their weight
+    """
+    scheduler = WeightedFairScheduler(capacity=1)
+    await scheduler.acquire("blocker")
+    dispatched = []
+
+    async def call(channel, weight):
+        async with scheduler.slot(channel, weight):
+            dispatched.append(channel)
+
+    # A bulk channel floods the scheduler before a premium one
+    calls = [asyncio.create_task(call("bulk", 1.0)) for _ in range(6)]
+    calls += [asyncio.create_task(call("premium", 3.0)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    assert scheduler.stats()["queue_depth"] == 9
+
+    scheduler.release()
+    await asyncio.gather(*calls)
+
+    # Ensure the premium channel gets three dispatches for each bulk one,
+    # without the bulk channel starving
+    assert dispatched[:4].count("premium") == 3
+    assert dispatched[4:] == ["bulk"] * 5
+    assert scheduler.stats() == {"in_flight": 0, "queue_depth": 0,
+                                 "dispatched": {"blocker": 1, "bulk": 6, "premium": 3}}
+
+
+@pytest.mark.asyncio
+async def test_idle_channel():
+    """Test an idle channel doesn't bank its unused share
+    """
+    scheduler = WeightedFairScheduler(capacity=1)
+    for _ in range(10):
+        async with scheduler.slot("busy"):
+            pass
+
+    await scheduler.acquire("blocker")
+    dispatched = []
+
+    async def call(channel):
+        async with scheduler.slot(channel):
+            dispatched.append(channel)
+
+    calls = [asyncio.create_task(call(channel))
+             for channel in ("busy", "busy", "idle", "idle")]
+    await asyncio.sleep(0.01)
+    scheduler.release()
+    await asyncio.gather(*calls)
+
+    # Ensure the channels alternate, rather than the idle one going first
+    # for all its calls
+    assert dispatched == ["busy", "idle", "busy", "idle"]
+
+
+@pytest.mark.asyncio
+async def test_cancel():
+    """Test cancelled waiters leave the queue
+    """
+    scheduler = WeightedFairScheduler(capacity=1)
+    await scheduler.acquire("a")
+
+    waiter = asyncio.create_task(scheduler.acquire("b"))
+    await asyncio.sleep(0.01)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert scheduler.stats()["queue_depth"] == 0
+
+    scheduler.release()
+    await asyncio.wait_for(scheduler.acquire("c"), 1)
+
+
+@pytest.mark.asyncio
+async def test_weight():
+    """Test that channels without a positive weight are refused
+    """
+    scheduler = WeightedFairScheduler(capacity=1)
+    for weight in (0, -1.0):
+        with pytest.raises(ValueError):
+            await scheduler.acquire("bulk", weight)
+    assert scheduler.stats()["queue_depth"] == 0
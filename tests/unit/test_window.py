@@ -0,0 +1,108 @@
+import pytest
+from unittest.mock import AsyncMock
+from erdos.window import HistoryWindow
+from langchain_core.messages import AIMessage, HumanMessage
+
+
+def turns(count: int) -> list:
+    messages = []
+    for turn in range(count):
+        messages += [HumanMessage(content=f"Question {turn}"),
+                     AIMessage(content=f"Answer {turn}")]
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_last():
+    """Test the last messages strategy of HistoryWindow class
+    """
+    window = HistoryWindow("last", max_messages=4)
+    messages = turns(5)
+
+    assert await window.apply(1, messages) == messages[-4:]
+    assert await window.apply(1, messages[:2]) == messages[:2]
+    with pytest.raises(ValueError):
+        HistoryWindow("first")
+
+
+@pytest.mark.asyncio
+async def test_tokens():
+    """Test the token budget strategy of HistoryWindow class
+    """
+    # Each message is estimated at 3 tokens
+    window = HistoryWindow("tokens", max_tokens=12)
+    messages = turns(5)
+
+    assert await window.apply(1, messages) == messages[-4:]
+    assert HistoryWindow.within_tokens(messages, 0) == []
+
+
+@pytest.mark.asyncio
+async def test_last_result():
+    """Test that HistoryWindow keeps the last reply ending with a numeric result
+    """
+    window = HistoryWindow("last", max_messages=2)
+    result = AIMessage(content="2 + 2 = 4")
+    messages = [HumanMessage(content="2+2"), result] + turns(2)
+
+    assert await window.apply(1, messages) == [result] + messages[-2:]
+    assert HistoryWindow.last_result(turns(2)) is None
+
+
+@pytest.mark.asyncio
+async def test_summary():
+    """Test the rolling summary strategy of HistoryWindow class
+    """
+    summarizer = AsyncMock(side_effect=lambda summary,
+                           messages: summary + str(len(messages)))
+    window = HistoryWindow("summary", max_messages=4, summarizer=summarizer)
+    messages = turns(4)
+
+    # Ensure nothing is summarized until a batch of messages is older than
+    # the window, and messages not summarized stay in the window
+    assert await window.apply(1, messages[:6]) == messages[:6]
+    summarizer.assert_not_called()
+
+    window_messages = await window.apply(1, messages)
+    assert window_messages[1:] == messages[-4:]
+    assert window_messages[0].content.endswith(": 4")
+    summarizer.assert_awaited_once_with("", messages[:4])
+
+    # Ensure the summary is cached, and updated incrementally
+    messages += turns(1)
+    window_messages = await window.apply(1, messages)
+    assert window_messages[0].content.endswith(
+        ": 4") and window_messages[1:] == messages[4:]
+    messages += turns(1)
+    assert (await window.apply(1, messages))[0].content.endswith(": 44")
+    summarizer.assert_awaited_with("4", messages[4:8])
+    assert window.stats() == {"summaries": 1, "summarized": 2}
+
+    # Ensure the summary starts over if the history was replaced
+    replaced = [
+        HumanMessage(
+            content=f"Other question {turn}") for turn in range(10)]
+    await window.apply(1, replaced)
+    summarizer.assert_awaited_with("", replaced[:6])
+
+
+@pytest.mark.asyncio
+async def test_summary_covers_history():
+    """Test that every message is either summarized or in the window of the summary strategy
+    """
+    summarized = []
+
+    async def summarizer(summary: str, messages: list) -> str:
+        summarized.extend(messages)
+        return f"{len(summarized)} messages"
+
+    window = HistoryWindow("summary", max_messages=2, summarizer=summarizer)
+    messages = turns(6)
+    for length in range(1, len(messages) + 1):
+        window_messages = await window.apply(1, messages[:length])
+        if summarized:
+            assert window_messages[0].content.endswith(
+                f"{len(summarized)} messages")
+            window_messages = window_messages[1:]
+        assert summarized + window_messages == messages[:length]
+        assert len(window_messages) < 2 * 2
@@ -0,0 +1,121 @@
+import os
+import pytest
+from erdos.agent import Agent
+from erdos.worker_pool import WorkerPool
+from langchain_core.messages import AIMessage, HumanMessage
+
+
+class UnpicklableError(Exception):
+    """Error that pickles, but fails to unpickle"""
+
+    def __init__(self, code, detail):
+        super().__init__(code)
+
+
+def failing_agent(llm_api_key):
+    """Agent factory failing at worker startup"""
+    raise RuntimeError("No agent")
+
+
+def pid_agent(llm_api_key):
+    """Agent whose LLM responses are the id of its worker process"""
+    agent = Agent(llm_api_key)
+    agent.router = None
+
+    async def send_message(conversation_id, message, channel=None, weight=1.0, model=None,
+                           client=None):
+        if message == "raise":
+            raise UnpicklableError(1, "detail")
+        if message == "exit":
+            os._exit(3)
+        history = agent.get_session_history(conversation_id)
+        Agent.record_turn(history, message, str(os.getpid()))
+        return str(os.getpid())
+    agent.send_message = send_message
+    return agent
+
+
+@pytest.fixture(scope="module")
+def pool():
+    pool = WorkerPool(2, '1', agent_factory=pid_agent)
+    yield pool
+    pool.close()
+
+
+def test_call(pool):
+    """Test call method of WorkerPool class pins conversations to workers
+
+    Args:
+        pool (WorkerPool): worker pool
+    """
+
+    pids = {
+        conversation_id: {
+            pool.call(
+                conversation_id,
+                "send_message",
+                "Hi",
+                None,
+                1.0).result(60)
+            for _ in range(3)}
+        for conversation_id in range(4)}
+
+    # Ensure each conversation is processed by a single worker, and
+    # conversations are spread over workers
+    assert all(len(conversation_pids) ==
+               1 for conversation_pids in pids.values())
+    assert len(set.union(*pids.values())) == 2
+    assert str(os.getpid()) not in set.union(*pids.values())
+
+
+def test_remote_agent(pool):
+    """Test RemoteAgent class forwards agent operations to the conversation's worker
+
+    Args:
+        pool (WorkerPool): worker pool
+    """
+
+    agent = pool.agent
+    agent.add_to_session_history(11, Agent.dump_messages(
+        [HumanMessage("Hi"), AIMessage("Hello")]))
+    pid = pool.call(11, "send_message", "What is 2+2?", None, 1.0).result(60)
+
+    assert agent.get_messages(11, stringified=True) == \
+        f"Human: Hi\nAi: Hello\nHuman: What is 2+2?\nAi: {pid}"
+    assert [message.content for message in agent.get_messages(11).messages] == [
+        "Hi", "Hello", "What is 2+2?", pid]
+
+    # Ensure errors are raised in the parent
+    with pytest.raises(TypeError):
+        pool.call(11, "add_to_session_history").result(60)
+
+
+def test_worker_failures():
+    """Test that WorkerPool class fails the requests of workers that died, and keeps serving
+    after errors it can't unpickle
+    """
+    pool = WorkerPool(1, '1', agent_factory=pid_agent)
+    try:
+        with pytest.raises(RuntimeError, match="UnpicklableError"):
+            pool.call(1, "send_message", "raise", None, 1.0).result(60)
+        assert pool.call(
+            1,
+            "send_message",
+            "Hi",
+            None,
+            1.0).result(60).isdigit()
+        # Ensure requests of a worker that died fail, pending and later ones
+        with pytest.raises(RuntimeError, match="exit code 3"):
+            pool.call(1, "send_message", "exit", None, 1.0).result(60)
+        with pytest.raises(RuntimeError, match="exit code 3"):
+            pool.call(1, "send_message", "Hi", None, 1.0).result(0)
+    finally:
+        pool.close()
+
+    # Ensure requests fail when the agent of a worker can't be created
+    pool = WorkerPool(1, '1', agent_factory=failing_agent)
+    try:
+        with pytest.raises(RuntimeError, match="died"):
+            pool.agent.get_messages(1)
+    finally:
+        pool.close()